@@ -7,17 +7,27 @@ import asyncio
 from datetime import datetime
 from jose import JWTError, jwt
 
-from models import get_db, Call, User, Consultation
+from models import get_db, SessionLocal, Call, User, Consultation
 from auth import get_current_user, SECRET_KEY, ALGORITHM
 from schemas import CallCreate, CallResponse, CallUpdate, CallListResponse
 from call_service import CallService
+from websocket_manager import connection_manager, KIND_CALL, KIND_INCOMING_CALL
+from event_bus import event_bus, user_channel, call_channel
 
 router = APIRouter(prefix="/api/calls", tags=["calls"])
 
-# Хранилище WebSocket соединений для звонков
-call_websocket_connections = {}
-# Хранилище WebSocket соединений для входящих звонков
-incoming_call_connections = {}
+# WebSocket соединения звонков и входящих звонков хранятся в общем реестре connection_manager,
+# а события между ними передаются через шину событий (соединения могут быть на разных воркерах)
+
+
+async def send_incoming_call_event(user_id: int, payload) -> int:
+    """Отправляет событие во все соединения пользователя для входящих звонков"""
+    return await event_bus.publish(user_channel(user_id), payload, kinds=(KIND_INCOMING_CALL,))
+
+
+async def send_call_event(call_id: int, user_id: int, payload) -> int:
+    """Отправляет сигнальное сообщение участнику звонка"""
+    return await event_bus.publish(call_channel(call_id), payload, user_id=user_id)
 
 @router.post("/initiate", response_model=CallResponse)
 async def initiate_call(
@@ -86,24 +96,23 @@ async def accept_call(
     await notify_call_caller(call.caller_id, call, "accepted")
     
     # Уведомляем через WebSocket для входящих звонков
-    if call.caller_id in incoming_call_connections:
-        try:
-            await incoming_call_connections[call.caller_id].send_text(json.dumps({
-                "type": "call_accepted",
-                "call_id": call.id,
-                "call": {
-                    "id": call.id,
-                    "caller_id": call.caller_id,
-                    "receiver_id": call.receiver_id,
-                    "call_type": call.call_type,
-                    "status": call.status,
-                    "created_at": call.created_at.isoformat(),
-                    "accepted_at": call.accepted_at.isoformat() if call.accepted_at else None
-                }
-            }))
-            print(f"Уведомление о принятии звонка отправлено инициатору {call.caller_id}")
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления о принятии звонка: {e}")
+    try:
+        await send_incoming_call_event(call.caller_id, json.dumps({
+            "type": "call_accepted",
+            "call_id": call.id,
+            "call": {
+                "id": call.id,
+                "caller_id": call.caller_id,
+                "receiver_id": call.receiver_id,
+                "call_type": call.call_type,
+                "status": call.status,
+                "created_at": call.created_at.isoformat(),
+                "accepted_at": call.accepted_at.isoformat() if call.accepted_at else None
+            }
+        }))
+        print(f"Уведомление о принятии звонка отправлено инициатору {call.caller_id}")
+    except Exception as e:
+        print(f"Ошибка при отправке уведомления о принятии звонка: {e}")
     
     return CallResponse(
         id=call.id,
@@ -146,38 +155,36 @@ async def end_call(
     other_user_id = call.receiver_id if current_user.id == call.caller_id else call.caller_id
     
     # Отправляем уведомление через WebSocket для входящих звонков
-    if other_user_id in incoming_call_connections:
-        try:
-            await incoming_call_connections[other_user_id].send_text(json.dumps({
-                "type": "call_ended",
-                "call": {
-                    "id": call.id,
-                    "caller_id": call.caller_id,
-                    "receiver_id": call.receiver_id,
-                    "call_type": call.call_type,
-                    "status": call.status
-                }
-            }))
-            print(f"Уведомление о завершении звонка отправлено пользователю {other_user_id} через WebSocket для входящих звонков")
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления о завершении звонка через WebSocket: {e}")
+    try:
+        await send_incoming_call_event(other_user_id, json.dumps({
+            "type": "call_ended",
+            "call": {
+                "id": call.id,
+                "caller_id": call.caller_id,
+                "receiver_id": call.receiver_id,
+                "call_type": call.call_type,
+                "status": call.status
+            }
+        }))
+        print(f"Уведомление о завершении звонка отправлено пользователю {other_user_id} через WebSocket для входящих звонков")
+    except Exception as e:
+        print(f"Ошибка при отправке уведомления о завершении звонка через WebSocket: {e}")
     
     # Также уведомляем звонящего о завершении
-    if call.caller_id in incoming_call_connections:
-        try:
-            await incoming_call_connections[call.caller_id].send_text(json.dumps({
-                "type": "call_ended",
-                "call": {
-                    "id": call.id,
-                    "caller_id": call.caller_id,
-                    "receiver_id": call.receiver_id,
-                    "call_type": call.call_type,
-                    "status": call.status
-                }
-            }))
-            print(f"Уведомление о завершении звонка отправлено звонящему {call.caller_id} через WebSocket для входящих звонков")
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления о завершении звонка звонящему через WebSocket: {e}")
+    try:
+        await send_incoming_call_event(call.caller_id, json.dumps({
+            "type": "call_ended",
+            "call": {
+                "id": call.id,
+                "caller_id": call.caller_id,
+                "receiver_id": call.receiver_id,
+                "call_type": call.call_type,
+                "status": call.status
+            }
+        }))
+        print(f"Уведомление о завершении звонка отправлено звонящему {call.caller_id} через WebSocket для входящих звонков")
+    except Exception as e:
+        print(f"Ошибка при отправке уведомления о завершении звонка звонящему через WebSocket: {e}")
     
     return call
 
@@ -222,8 +229,7 @@ async def get_active_call(
 async def websocket_endpoint(
     websocket: WebSocket,
     call_id: int,
-    token: str = Query(...),
-    db: Session = Depends(get_db)
+    token: str = Query(...)
 ):
     await websocket.accept()
     
@@ -240,14 +246,15 @@ async def websocket_endpoint(
             await websocket.close(code=4001, reason="Invalid token")
             return
         
-        # Получаем пользователя
-        user = db.query(User).filter(User.email == user_email).first()
+        # Получаем пользователя и звонок в короткой сессии: открытый WebSocket не держит подключение к БД
+        with SessionLocal() as db:
+            user = db.query(User).filter(User.email == user_email).first()
+            call = db.query(Call).filter(Call.id == call_id).first()
+        
         if not user:
             await websocket.close(code=4002, reason="User not found")
             return
         
-        # Получаем звонок
-        call = db.query(Call).filter(Call.id == call_id).first()
         if not call:
             await websocket.close(code=4003, reason="Call not found")
             return
@@ -259,22 +266,21 @@ async def websocket_endpoint(
         
         print(f"WebSocket соединение добавлено для звонка {call_id}, пользователь {user.id}")
         
-        # Добавляем соединение в словарь
-        if call_id not in call_websocket_connections:
-            call_websocket_connections[call_id] = {}
-        call_websocket_connections[call_id][user.id] = websocket
+        # Регистрируем соединение звонка
+        connection_manager.connect(websocket, user.id, KIND_CALL, call_id=call_id)
         
         # Отправляем подтверждение подключения
-        await websocket.send_text(json.dumps({
+        connection_manager.enqueue(websocket, {
             "type": "connection-established",
             "call_id": call_id,
             "user_id": user.id
-        }))
+        })
         
         try:
             while True:
                 # Получаем сообщение
                 data = await websocket.receive_text()
+                connection_manager.touch(websocket)
                 
                 if not data:
                     print(f"Получено пустое сообщение от пользователя {user.id}")
@@ -302,52 +308,39 @@ async def websocket_endpoint(
                     # Пересылаем сообщение другому участнику звонка
                     other_user_id = call.receiver_id if user.id == call.caller_id else call.caller_id
                     
-                    if call_id in call_websocket_connections and other_user_id in call_websocket_connections[call_id]:
-                        other_websocket = call_websocket_connections[call_id][other_user_id]
-                        try:
-                            # Пересылаем исходное сообщение без изменений
-                            await other_websocket.send_text(data)
-                            print(f"Сообщение {message_type} переслано пользователю {other_user_id}")
-                        except Exception as e:
-                            print(f"Ошибка при пересылке сообщения {message_type}: {e}")
+                    # Пересылаем исходное сообщение без изменений
+                    if await send_call_event(call_id, other_user_id, data):
+                        print(f"Сообщение {message_type} переслано пользователю {other_user_id}")
                     else:
                         print(f"Другой участник {other_user_id} не подключен к звонку {call_id}")
-                        print(f"Доступные соединения для звонка {call_id}: {list(call_websocket_connections.get(call_id, {}).keys())}")
                 
                 elif message_type == "call-accepted":
                     # Уведомляем другого участника о принятии звонка
                     other_user_id = call.receiver_id if user.id == call.caller_id else call.caller_id
                     
-                    if call_id in call_websocket_connections and other_user_id in call_websocket_connections[call_id]:
-                        other_websocket = call_websocket_connections[call_id][other_user_id]
-                        try:
-                            await other_websocket.send_text(json.dumps({
-                                "type": "call-accepted",
-                                "call_id": call_id
-                            }))
-                            print(f"Уведомление о принятии звонка отправлено пользователю {other_user_id}")
-                        except Exception as e:
-                            print(f"Ошибка при отправке уведомления о принятии звонка: {e}")
+                    if await send_call_event(call_id, other_user_id, json.dumps({
+                        "type": "call-accepted",
+                        "call_id": call_id
+                    })):
+                        print(f"Уведомление о принятии звонка отправлено пользователю {other_user_id}")
                 
                 elif message_type == "call-ended":
                     # Уведомляем другого участника о завершении звонка
                     other_user_id = call.receiver_id if user.id == call.caller_id else call.caller_id
                     
-                    if call_id in call_websocket_connections and other_user_id in call_websocket_connections[call_id]:
-                        other_websocket = call_websocket_connections[call_id][other_user_id]
-                        try:
-                            await other_websocket.send_text(json.dumps({
-                                "type": "call-ended",
-                                "call_id": call_id
-                            }))
-                            print(f"Уведомление о завершении звонка отправлено пользователю {other_user_id}")
-                        except Exception as e:
-                            print(f"Ошибка при отправке уведомления о завершении звонка: {e}")
+                    if await send_call_event(call_id, other_user_id, json.dumps({
+                        "type": "call-ended",
+                        "call_id": call_id
+                    })):
+                        print(f"Уведомление о завершении звонка отправлено пользователю {other_user_id}")
                     
                     # Обновляем статус звонка
-                    call.status = "ended"
-                    call.ended_at = datetime.utcnow()
-                    db.commit()
+                    with SessionLocal() as db:
+                        db.query(Call).filter(Call.id == call_id).update(
+                            {"status": "ended", "ended_at": datetime.utcnow()},
+                            synchronize_session=False
+                        )
+                        db.commit()
                     break
                 
         except WebSocketDisconnect:
@@ -355,11 +348,8 @@ async def websocket_endpoint(
         except Exception as e:
             print(f"Ошибка в WebSocket соединении: {e}")
         finally:
-            # Удаляем соединение из словаря
-            if call_id in call_websocket_connections and user.id in call_websocket_connections[call_id]:
-                del call_websocket_connections[call_id][user.id]
-                if not call_websocket_connections[call_id]:
-                    del call_websocket_connections[call_id]
+            # Удаляем соединение из реестра
+            if connection_manager.disconnect(websocket):
                 print(f"WebSocket соединение удалено для пользователя {user.id} в звонке {call_id}")
     
     except Exception as e:
@@ -370,7 +360,6 @@ async def websocket_endpoint(
 async def websocket_incoming_calls_endpoint(
     websocket: WebSocket,
     user_id: int,
-    db: Session = Depends(get_db),
     token: str = None
 ):
     """WebSocket endpoint для уведомлений о входящих звонках"""
@@ -386,7 +375,8 @@ async def websocket_incoming_calls_endpoint(
         try:
             payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
             user_email = payload.get("sub")
-            user = db.query(User).filter(User.email == user_email).first()
+            with SessionLocal() as db:
+                user = db.query(User).filter(User.email == user_email).first()
             
             if not user or user.id != user_id:
                 await websocket.close(code=4001, reason="Invalid user")
@@ -398,8 +388,8 @@ async def websocket_incoming_calls_endpoint(
         
         print(f"WebSocket для входящих звонков подключен для пользователя {user_id}")
         
-        # Добавляем соединение в хранилище для входящих звонков
-        incoming_call_connections[user_id] = websocket
+        # Регистрируем соединение для входящих звонков
+        connection_manager.connect(websocket, user_id, KIND_INCOMING_CALL)
         
         try:
             # Просто держим соединение открытым
@@ -407,6 +397,7 @@ async def websocket_incoming_calls_endpoint(
                 # Ждем любые сообщения от клиента
                 try:
                     data = await websocket.receive_text()
+                    connection_manager.touch(websocket)
                     
                     if not data:
                         continue
@@ -416,7 +407,7 @@ async def websocket_incoming_calls_endpoint(
                         message = json.loads(data)
                         if message and isinstance(message, dict) and message.get("type") == "keep-alive":
                             # Отвечаем на keep-alive
-                            await websocket.send_text(json.dumps({"type": "keep-alive-ack"}))
+                            connection_manager.enqueue(websocket, {"type": "keep-alive-ack"})
                     except json.JSONDecodeError:
                         # Игнорируем некорректные JSON сообщения
                         pass
@@ -425,9 +416,8 @@ async def websocket_incoming_calls_endpoint(
         except WebSocketDisconnect:
             pass
         finally:
-            # Удаляем соединение из хранилища
-            if user_id in incoming_call_connections:
-                del incoming_call_connections[user_id]
+            # Удаляем соединение из реестра
+            connection_manager.disconnect(websocket)
             print(f"WebSocket для входящих звонков закрыт для пользователя {user_id}")
                 
     except Exception as e:
@@ -450,74 +440,67 @@ async def handle_call_message(call_id: int, user_id: int, message: dict, db: Ses
     
     if message_type == "offer":
         # Пересылаем offer получателю
-        if call_id in call_websocket_connections and other_user_id in call_websocket_connections[call_id]:
-            await call_websocket_connections[call_id][other_user_id].send_text(json.dumps({
-                "type": "offer",
-                "caller_id": user_id,
-                "sdp": message.get("sdp"),
-                "call_type": call.call_type
-            }))
+        if await send_call_event(call_id, other_user_id, json.dumps({
+            "type": "offer",
+            "caller_id": user_id,
+            "sdp": message.get("sdp"),
+            "call_type": call.call_type
+        })):
             print(f"Offer переслан пользователю {other_user_id}")
     
     elif message_type == "answer":
         # Пересылаем answer звонящему
-        if call_id in call_websocket_connections and other_user_id in call_websocket_connections[call_id]:
-            await call_websocket_connections[call_id][other_user_id].send_text(json.dumps({
-                "type": "answer",
-                "receiver_id": user_id,
-                "sdp": message.get("sdp")
-            }))
+        if await send_call_event(call_id, other_user_id, json.dumps({
+            "type": "answer",
+            "receiver_id": user_id,
+            "sdp": message.get("sdp")
+        })):
             print(f"Answer переслан пользователю {other_user_id}")
     
     elif message_type == "ice-candidate":
         # Пересылаем ICE candidate
-        if call_id in call_websocket_connections and other_user_id in call_websocket_connections[call_id]:
-            await call_websocket_connections[call_id][other_user_id].send_text(json.dumps({
-                "type": "ice-candidate",
-                "from_id": user_id,
-                "candidate": message.get("candidate")
-            }))
+        if await send_call_event(call_id, other_user_id, json.dumps({
+            "type": "ice-candidate",
+            "from_id": user_id,
+            "candidate": message.get("candidate")
+        })):
             print(f"ICE candidate переслан пользователю {other_user_id}")
 
 async def notify_call_receiver(receiver_id: int, call: Call):
     """Уведомление получателя о входящем звонке"""
     print(f"Попытка уведомить пользователя {receiver_id} о звонке {call.id}")
-    print(f"Доступные соединения: {list(incoming_call_connections.keys())}")
     
-    if receiver_id in incoming_call_connections:
-        try:
-            message = {
-                "type": "incoming_call",
-                "call": {
-                    "id": call.id,
-                    "caller_id": call.caller_id,
-                    "call_type": call.call_type,
-                    "consultation_id": call.consultation_id
-                }
+    try:
+        message = {
+            "type": "incoming_call",
+            "call": {
+                "id": call.id,
+                "caller_id": call.caller_id,
+                "call_type": call.call_type,
+                "consultation_id": call.consultation_id
             }
-            await incoming_call_connections[receiver_id].send_text(json.dumps(message))
+        }
+        if await send_incoming_call_event(receiver_id, json.dumps(message)):
             print(f"Уведомление отправлено пользователю {receiver_id}")
-        except Exception as e:
-            print(f"Ошибка отправки уведомления пользователю {receiver_id}: {e}")
-    else:
-        print(f"Пользователь {receiver_id} не подключен к WebSocket")
+        else:
+            print(f"Пользователь {receiver_id} не подключен к WebSocket")
+    except Exception as e:
+        print(f"Ошибка отправки уведомления пользователю {receiver_id}: {e}")
 
 async def notify_call_caller(caller_id: int, call: Call, action: str):
     """Уведомление звонящего о действии с звонком"""
     try:
-        if caller_id in incoming_call_connections:
-            await incoming_call_connections[caller_id].send_text(json.dumps({
-                "type": f"call_{action}",
-                "call_id": call.id
-            }))
+        if await send_incoming_call_event(caller_id, json.dumps({
+            "type": f"call_{action}",
+            "call_id": call.id
+        })):
             print(f"Уведомление {action} отправлено звонящему {caller_id}")
     except Exception as e:
         print(f"Ошибка при отправке уведомления звонящему {caller_id}: {e}")
 
 async def notify_call_participant(user_id: int, call: Call, action: str):
     """Уведомление участника о действии с звонком"""
-    if user_id in incoming_call_connections:
-        await incoming_call_connections[user_id].send_text(json.dumps({
-            "type": f"call_{action}",
-            "call_id": call.id
-        })) 
\ No newline at end of file
+    await send_incoming_call_event(user_id, json.dumps({
+        "type": f"call_{action}",
+        "call_id": call.id
+    })) 
\ No newline at end of file
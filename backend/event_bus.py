@@ -0,0 +1,420 @@
+# backend/event_bus.py
+
+import os
+import abc
+import time
+import uuid
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+from sqlalchemy import func, or_
+from models import RealtimeEvent, SessionLocal
+from fast_json import dumps, loads
+from websocket_manager import connection_manager, ConnectionManager, USER_EVENT_KINDS
+from replay_buffer import ReplayRegistry, with_seq
+
+# redis - необязательная зависимость: нужна только для EVENT_BUS_BACKEND=redis
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+# Бэкенд шины: memory (один процесс), redis (pub/sub) или mysql (опрос таблицы realtime_events)
+EVENT_BUS_BACKEND = os.getenv("EVENT_BUS_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_CHANNEL_PREFIX = os.getenv("EVENT_BUS_REDIS_PREFIX", "healzy:ws:")
+
+# Параметры опроса таблицы для бэкенда mysql
+MYSQL_POLL_INTERVAL_SECONDS = float(os.getenv("EVENT_BUS_POLL_INTERVAL", "0.2"))
+MYSQL_POLL_BATCH_SIZE = 500
+MYSQL_EVENT_RETENTION_SECONDS = 300
+# id выдается при вставке, а строка видна после коммита: события становятся видимыми
+# не в порядке id. Пропущенные id ("дыры") перечитываются, пока не истечет это окно
+# (после него дыра считается откатанной транзакцией), но не больше MYSQL_MAX_GAPS штук
+MYSQL_GAP_WINDOW_SECONDS = float(os.getenv("EVENT_BUS_GAP_WINDOW", "5"))
+MYSQL_MAX_GAPS = 1000
+MYSQL_CLEANUP_INTERVAL_SECONDS = 60
+
+Payload = Union[str, Dict[str, Any]]
+
+
+def user_channel(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def consultation_channel(consultation_id: int) -> str:
+    return f"consultation:{consultation_id}"
+
+
+def call_channel(call_id: int) -> str:
+    return f"call:{call_id}"
+
+
+def broadcast_channel(broadcast_id: int) -> str:
+    return f"broadcast:{broadcast_id}"
+
+
+def is_consultation_channel(channel: str) -> bool:
+    return channel.startswith("consultation:")
+
+
+class EventBus(abc.ABC):
+    """
+    Шина событий реального времени. Отправитель публикует событие в канал
+    (пользователь, консультация или звонок), а каждый воркер доставляет его
+    в свои локальные WebSocket соединения через ConnectionManager.
+
+    События консультаций получают монотонно растущий номер seq и сохраняются
+    в буфере повтора (replay), чтобы переподключившийся клиент получил пропущенное.
+    Эфемерные события (ephemeral=True: набор текста, присутствие, отметки о прочтении)
+    доставляются без seq и в буфер не попадают - повторять устаревшее состояние незачем.
+
+    Событие может нести подтверждения доставки (acks): их обрабатывает только воркер,
+    который действительно отправил событие в свои соединения (см. delivery_handler).
+    """
+
+    # True - publish лишь передает событие в общую шину и не знает, доставлено ли оно
+    distributed = False
+
+    def __init__(self, manager: ConnectionManager = connection_manager):
+        self.manager = manager
+        self.replay = ReplayRegistry()
+        # Обработчик подтверждений доставки (устанавливает диспетчер уведомлений)
+        self.delivery_handler: Optional[Callable[[List[list]], Awaitable[None]]] = None
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    @staticmethod
+    def build_event(
+        channel: str,
+        payload: Payload,
+        kinds: Optional[Iterable[str]] = None,
+        user_id: Optional[int] = None,
+        acks: Optional[List[list]] = None,
+        ephemeral: bool = False,
+    ) -> Dict[str, Any]:
+        # Полезная нагрузка кодируется один раз у отправителя: воркеры и соединения
+        # получают готовую JSON-строку и не сериализуют ее повторно
+        event = {
+            "channel": channel,
+            "payload": payload if isinstance(payload, str) else dumps(payload),
+            "kinds": list(kinds) if kinds is not None else None,
+            "user_id": user_id,
+        }
+        if acks:
+            event["acks"] = acks
+        if ephemeral:
+            event["ephemeral"] = True
+        return event
+
+    @staticmethod
+    def is_sequenced(event: Dict[str, Any]) -> bool:
+        """Событие консультации получает seq и сохраняется в буфере повтора"""
+        return is_consultation_channel(event["channel"]) and not event.get("ephemeral")
+
+    @abc.abstractmethod
+    async def publish(
+        self,
+        channel: str,
+        payload: Payload,
+        kinds: Optional[Iterable[str]] = None,
+        user_id: Optional[int] = None,
+        acks: Optional[List[list]] = None,
+        ephemeral: bool = False,
+    ) -> int:
+        """
+        Публикует событие в канал.
+
+        Args:
+            channel: user:<id>, consultation:<id>, call:<id> или broadcast:<id>
+            payload: словарь (отправляется как JSON) или готовая строка
+            kinds: типы соединений пользователя, которым адресовано событие (для user:<id>)
+            user_id: участник звонка, которому адресовано событие (для call:<id>)
+            acks: подтверждения доставки для delivery_handler воркера, доставившего событие
+            ephemeral: событие консультации без seq и без записи в буфер повтора
+
+        Returns:
+            int: для локальной шины - число соединений, получивших событие;
+                 для распределенной - 1, если событие передано в шину, иначе 0
+        """
+
+    async def deliver_local(self, event: Dict[str, Any]) -> int:
+        """Доставляет событие в WebSocket соединения текущего процесса"""
+        scope, _, key = event["channel"].partition(":")
+        payload = event["payload"]
+        target_id = int(key)
+
+        if scope == "user":
+            delivered = await self.manager.send_to_user(target_id, payload, kinds=event.get("kinds") or USER_EVENT_KINDS)
+            if delivered and event.get("acks"):
+                await self.confirm_delivery(event["acks"])
+            return delivered
+        if scope == "consultation":
+            if event.get("seq") is not None:
+                payload = with_seq(payload, event["seq"])
+                self.replay.record(target_id, event["seq"], payload)
+            return await self.manager.send_to_consultation(target_id, payload)
+        if scope == "call":
+            return await self.manager.send_to_call(target_id, event["user_id"], payload)
+        if scope == "broadcast":
+            return await self._deliver_broadcast(loads(payload))
+
+        print(f"[EventBus] Неизвестный канал: {event['channel']}")
+        return 0
+
+    async def confirm_delivery(self, acks: List[list]) -> None:
+        """Передает подтверждения доставки в соединения этого воркера обработчику"""
+        if self.delivery_handler is None:
+            return
+        try:
+            await self.delivery_handler(acks)
+        except Exception as e:
+            print(f"[EventBus] Ошибка подтверждения доставки: {str(e)}")
+
+    async def _deliver_broadcast(self, chunk: Dict[str, Any]) -> int:
+        """
+        Пачка массовой рассылки - одно событие на много получателей:
+        {"notification": {...}, "recipients": [[user_id, notification_id, unread_count, outbox_id], ...]}.
+        Каждый воркер отправляет уведомление только своим подключенным получателям
+        и подтверждает эти доставки (строки очереди получают статус sent).
+        """
+        notification = chunk["notification"]
+        delivered = 0
+        acks = []
+        for user_id, notification_id, unread_count, outbox_id in chunk["recipients"]:
+            connections = self.manager.user_connections(user_id)
+            if not connections:
+                continue
+            message = {
+                "type": "new_notification",
+                "notification": {**notification, "id": notification_id},
+            }
+            if unread_count is not None:
+                message["unread_count"] = unread_count
+            sent = await self.manager.send_to_connections(connections, message)
+            if sent:
+                acks.append([outbox_id, notification_id, 1, None])
+            delivered += sent
+        if acks:
+            await self.confirm_delivery(acks)
+        return delivered
+
+
+class InProcessEventBus(EventBus):
+    """Шина для одного процесса: событие сразу доставляется в локальные соединения"""
+
+    def __init__(self, manager: ConnectionManager = connection_manager):
+        super().__init__(manager)
+        # Номера начинаются с текущего времени в мс: после перезапуска они больше
+        # всех выданных ранее, и устаревший last_seq клиента распознается как разрыв
+        self._seq = int(time.time() * 1000)
+        self.replay.reset(self._seq)
+
+    async def publish(self, channel, payload, kinds=None, user_id=None, acks=None, ephemeral=False) -> int:
+        event = self.build_event(channel, payload, kinds, user_id, acks, ephemeral)
+        if self.is_sequenced(event):
+            self._seq += 1
+            event["seq"] = self._seq
+        return await self.deliver_local(event)
+
+
+class RedisEventBus(EventBus):
+    """
+    Шина на Redis pub/sub: канал Redis на каждого пользователя, консультацию и звонок.
+    Каждый воркер подписан на все каналы по шаблону и доставляет события своим соединениям,
+    включая события, опубликованные им самим.
+    """
+
+    distributed = True
+
+    def __init__(self, client=None, url: str = REDIS_URL, prefix: str = REDIS_CHANNEL_PREFIX, manager: ConnectionManager = connection_manager):
+        super().__init__(manager)
+        if client is None:
+            if aioredis is None:
+                raise RuntimeError("Для EVENT_BUS_BACKEND=redis требуется пакет redis")
+            client = aioredis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        # Общий счетчик seq событий консультаций для всех воркеров
+        self.replay.reset(int(await self.client.get(f"{self.prefix}seq") or 0))
+        self._pubsub = self.client.pubsub()
+        await self._pubsub.psubscribe(f"{self.prefix}*")
+        self._listener = asyncio.create_task(self._listen())
+        print(f"[EventBus] Redis: подписка на {self.prefix}*")
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.punsubscribe()
+            await self._pubsub.close()
+
+    async def publish(self, channel, payload, kinds=None, user_id=None, acks=None, ephemeral=False) -> int:
+        event = self.build_event(channel, payload, kinds, user_id, acks, ephemeral)
+        try:
+            if self.is_sequenced(event):
+                event["seq"] = await self.client.incr(f"{self.prefix}seq")
+            await self.client.publish(f"{self.prefix}{channel}", dumps(event))
+            return 1
+        except Exception as e:
+            print(f"[EventBus] Redis: ошибка публикации в {channel}: {str(e)}")
+            return 0
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    if message.get("type") not in ("message", "pmessage"):
+                        continue
+                    await self.deliver_local(loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[EventBus] Redis: ошибка чтения событий: {str(e)}")
+                await asyncio.sleep(1)
+
+
+class MySQLPollingEventBus(EventBus):
+    """
+    Шина на таблице realtime_events: публикация - вставка строки,
+    каждый воркер опрашивает таблицу по возрастанию id и доставляет новые события.
+    Не требует дополнительной инфраструктуры; задержка доставки - до интервала опроса.
+    Строка с меньшим id может закоммититься позже уже прочитанной: такие id запоминаются
+    как дыры и перечитываются в течение MYSQL_GAP_WINDOW_SECONDS.
+    """
+
+    distributed = True
+
+    def __init__(
+        self,
+        session_factory: Callable = SessionLocal,
+        poll_interval: float = MYSQL_POLL_INTERVAL_SECONDS,
+        manager: ConnectionManager = connection_manager,
+    ):
+        super().__init__(manager)
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        # Идентификатор воркера - только для логов
+        self.worker_id = uuid.uuid4().hex[:8]
+        self._last_id = 0
+        # Пропущенные id ниже _last_id -> момент обнаружения (time.monotonic)
+        self._gaps: Dict[int, float] = {}
+        self._last_cleanup = datetime.utcnow()
+        self._poller: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        # Начинаем с текущего конца таблицы: старые события уже неактуальны
+        self._last_id = await asyncio.to_thread(self._max_id)
+        # seq событий консультаций - id строки realtime_events, общий для всех воркеров
+        self.replay.reset(self._last_id)
+        self._poller = asyncio.create_task(self._poll_loop())
+        print(f"[EventBus] MySQL: воркер {self.worker_id} опрашивает realtime_events с id > {self._last_id}")
+
+    async def stop(self) -> None:
+        if self._poller is not None:
+            self._poller.cancel()
+
+    def _max_id(self) -> int:
+        with self.session_factory() as db:
+            return db.query(func.max(RealtimeEvent.id)).scalar() or 0
+
+    def _insert(self, event: Dict[str, Any]) -> None:
+        with self.session_factory() as db:
+            db.add(RealtimeEvent(channel=event["channel"], event=dumps(event)))
+            db.commit()
+
+    def _fetch(self, after_id: int, gap_ids: List[int]):
+        condition = RealtimeEvent.id > after_id
+        if gap_ids:
+            condition = or_(condition, RealtimeEvent.id.in_(gap_ids))
+        with self.session_factory() as db:
+            return (
+                db.query(RealtimeEvent.id, RealtimeEvent.event)
+                .filter(condition)
+                .order_by(RealtimeEvent.id)
+                .limit(MYSQL_POLL_BATCH_SIZE)
+                .all()
+            )
+
+    def _cleanup(self) -> None:
+        cutoff = datetime.utcnow() - timedelta(seconds=MYSQL_EVENT_RETENTION_SECONDS)
+        with self.session_factory() as db:
+            db.query(RealtimeEvent).filter(RealtimeEvent.created_at < cutoff).delete(synchronize_session=False)
+            db.commit()
+
+    async def publish(self, channel, payload, kinds=None, user_id=None, acks=None, ephemeral=False) -> int:
+        event = self.build_event(channel, payload, kinds, user_id, acks, ephemeral)
+        try:
+            await asyncio.to_thread(self._insert, event)
+            return 1
+        except Exception as e:
+            print(f"[EventBus] MySQL: ошибка публикации в {channel}: {str(e)}")
+            return 0
+
+    async def poll_once(self) -> int:
+        """Забирает и доставляет новые события и события из дыр. Возвращает их количество."""
+        now = time.monotonic()
+        # Дыры старше окна - откатанные транзакции, больше не ждем
+        self._gaps = {gap_id: seen_at for gap_id, seen_at in self._gaps.items() if now - seen_at < MYSQL_GAP_WINDOW_SECONDS}
+
+        rows = await asyncio.to_thread(self._fetch, self._last_id, list(self._gaps))
+        for event_id, raw_event in rows:
+            if event_id in self._gaps:
+                del self._gaps[event_id]
+            elif event_id > self._last_id:
+                for gap_id in range(max(self._last_id + 1, event_id - MYSQL_MAX_GAPS), event_id):
+                    self._gaps[gap_id] = now
+                self._last_id = event_id
+            else:
+                continue
+            try:
+                event = loads(raw_event)
+                if self.is_sequenced(event):
+                    event["seq"] = event_id
+                await self.deliver_local(event)
+            except Exception as e:
+                print(f"[EventBus] MySQL: ошибка доставки события {event_id}: {str(e)}")
+
+        if len(self._gaps) > MYSQL_MAX_GAPS:
+            # Ждем только самые свежие дыры
+            self._gaps = dict(sorted(self._gaps.items())[-MYSQL_MAX_GAPS:])
+        return len(rows)
+
+    async def _poll_loop(self) -> None:
+        while True:
+            try:
+                fetched = await self.poll_once()
+
+                if (datetime.utcnow() - self._last_cleanup).total_seconds() >= MYSQL_CLEANUP_INTERVAL_SECONDS:
+                    self._last_cleanup = datetime.utcnow()
+                    await asyncio.to_thread(self._cleanup)
+
+                # Если пришла полная пачка, сразу забираем следующую
+                if fetched < MYSQL_POLL_BATCH_SIZE:
+                    await asyncio.sleep(self.poll_interval)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[EventBus] MySQL: ошибка опроса событий: {str(e)}")
+                await asyncio.sleep(1)
+
+
+def create_event_bus(backend: str = EVENT_BUS_BACKEND) -> EventBus:
+    """Создает шину событий по имени бэкенда"""
+    if backend == "redis":
+        return RedisEventBus()
+    if backend == "mysql":
+        return MySQLPollingEventBus()
+    return InProcessEventBus()
+
+
+# Шина событий процесса: через нее рассылаются события чата, уведомлений и звонков
+event_bus = create_event_bus()
@@ -0,0 +1,148 @@
+# backend/event_coalescer.py
+
+import os
+import asyncio
+from typing import Any, Dict, Optional
+from sqlalchemy import update
+from models import Consultation, Message, SessionLocal
+from sync_service import record_consultation_change, CHANGE_READ
+from event_bus import event_bus, consultation_channel
+
+# Окно слияния эфемерных событий консультации (мс)
+COALESCE_WINDOW_SECONDS = int(os.getenv("WS_COALESCE_WINDOW_MS", "100")) / 1000
+
+
+class EventCoalescer:
+    """
+    Сливает эфемерные события консультации (прочтение, набор текста, присутствие)
+    за короткое окно в один кадр:
+    {"type": "ephemeral_update", "consultation_id": ..., "read": [...], "typing": [...], "presence": [...]}.
+
+    Прочтение хранится как водяной знак "прочитано до сообщения X": из многих отметок
+    за окно остается одна, и в БД она записывается одним UPDATE.
+    Для набора текста и присутствия остается последнее состояние пользователя.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW_SECONDS, session_factory=SessionLocal, bus=event_bus):
+        self.window = window
+        self.session_factory = session_factory
+        self.bus = bus
+        # consultation_id -> {"read": {reader_id: message_id}, "typing": {...}, "presence": {...}}
+        self._pending: Dict[int, Dict[str, Dict[int, Any]]] = {}
+        self._timers: Dict[int, asyncio.Task] = {}
+        self._counters = {
+            "events_in": 0,     # входящие эфемерные события
+            "frames_out": 0,    # разосланные объединенные кадры
+            "read_updates": 0,  # сообщения, отмеченные прочитанными
+        }
+
+    # --- Входящие события ---
+
+    def read_up_to(self, consultation_id: int, reader_id: int, message_id: int) -> None:
+        reads = self._state(consultation_id)["read"]
+        if message_id > reads.get(reader_id, 0):
+            reads[reader_id] = message_id
+
+    def typing(self, consultation_id: int, user_id: int, is_typing: bool) -> None:
+        self._state(consultation_id)["typing"][user_id] = bool(is_typing)
+
+    def presence(self, consultation_id: int, user_id: int, online: bool) -> None:
+        self._state(consultation_id)["presence"][user_id] = bool(online)
+
+    def _state(self, consultation_id: int) -> Dict[str, Dict[int, Any]]:
+        self._counters["events_in"] += 1
+        state = self._pending.get(consultation_id)
+        if state is None:
+            state = {"read": {}, "typing": {}, "presence": {}}
+            self._pending[consultation_id] = state
+        if consultation_id not in self._timers:
+            self._timers[consultation_id] = asyncio.create_task(self._flush_later(consultation_id))
+        return state
+
+    # --- Сброс ---
+
+    async def _flush_later(self, consultation_id: int) -> None:
+        await asyncio.sleep(self.window)
+        self._timers.pop(consultation_id, None)
+        try:
+            await self.flush(consultation_id)
+        except Exception as e:
+            print(f"[Coalescer] Ошибка сброса событий консультации {consultation_id}: {str(e)}")
+
+    async def flush(self, consultation_id: int) -> Optional[Dict[str, Any]]:
+        """Сохраняет водяные знаки прочтения и рассылает один кадр. Возвращает кадр или None."""
+        state = self._pending.pop(consultation_id, None)
+        if state is None:
+            return None
+
+        if state["read"]:
+            await asyncio.to_thread(self._persist_reads, consultation_id, state["read"])
+
+        frame: Dict[str, Any] = {"type": "ephemeral_update", "consultation_id": consultation_id}
+        if state["read"]:
+            frame["read"] = [
+                {"reader_id": reader_id, "up_to_message_id": message_id}
+                for reader_id, message_id in state["read"].items()
+            ]
+        if state["typing"]:
+            frame["typing"] = [
+                {"user_id": user_id, "typing": is_typing}
+                for user_id, is_typing in state["typing"].items()
+            ]
+        if state["presence"]:
+            frame["presence"] = [
+                {"user_id": user_id, "online": online}
+                for user_id, online in state["presence"].items()
+            ]
+
+        # Без seq и буфера повтора: кадр не вытесняет сообщения чата из буфера
+        await self.bus.publish(consultation_channel(consultation_id), frame, ephemeral=True)
+        self._counters["frames_out"] += 1
+        return frame
+
+    async def flush_all(self) -> None:
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for consultation_id in list(self._pending):
+            await self.flush(consultation_id)
+
+    def _persist_reads(self, consultation_id: int, reads: Dict[int, int]) -> int:
+        """
+        Водяные знаки прочтения: один UPDATE на читателя вместо записи по каждому сообщению.
+        Читатель отмечает только адресованные ему сообщения (индекс idx_messages_receiver_unread)
+        """
+        updated = 0
+        with self.session_factory() as db:
+            consultation = db.get(Consultation, consultation_id)
+            if consultation is None:
+                return 0
+
+            for reader_id, message_id in reads.items():
+                result = db.execute(
+                    update(Message)
+                    .where(
+                        Message.consultation_id == consultation_id,
+                        Message.receiver_id == reader_id,
+                        Message.id <= message_id,
+                        Message.is_read == False,
+                    )
+                    .values(is_read=True)
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount:
+                    updated += result.rowcount
+                    record_consultation_change(db, consultation, CHANGE_READ, reader_id)
+
+            if updated:
+                db.commit()
+
+        self._counters["read_updates"] += updated
+        return updated
+
+    def metrics(self) -> Dict[str, Any]:
+        return {**self._counters, "pending_consultations": len(self._pending)}
+
+
+# Общий экземпляр процесса
+event_coalescer = EventCoalescer()
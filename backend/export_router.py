@@ -0,0 +1,72 @@
+# backend/export_router.py
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from models import get_db, User, Consultation
+from auth import get_current_user
+from transcript_export import stream_transcript_export
+
+router = APIRouter(prefix="/api/export", tags=["export"])
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+
+def _streaming_export(consultation_ids, export_format: str, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        stream_transcript_export(consultation_ids, export_format),
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'},
+    )
+
+
+@router.get("/consultations/{consultation_id}")
+async def export_consultation_transcript(
+    consultation_id: int,
+    format: str = Query("ndjson", pattern="^(ndjson|json)$", description="ndjson или json (для генерации PDF)"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Потоковый экспорт переписки одной консультации.
+    Доступен участникам консультации и администратору.
+    """
+    consultation = db.query(Consultation).filter(Consultation.id == consultation_id).first()
+    if not consultation:
+        raise HTTPException(status_code=404, detail="Консультация не найдена")
+
+    if current_user.role != "admin" and current_user.id not in (consultation.patient_id, consultation.doctor_id):
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+    return _streaming_export([consultation_id], format, f"consultation_{consultation_id}")
+
+
+@router.get("/patients/{patient_id}")
+async def export_patient_transcripts(
+    patient_id: int,
+    format: str = Query("ndjson", pattern="^(ndjson|json)$", description="ndjson или json (для генерации PDF)"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Потоковый экспорт переписки всех консультаций пациента (запрос на переносимость данных).
+    Доступен самому пациенту и администратору.
+    """
+    if current_user.role != "admin" and current_user.id != patient_id:
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+    patient = db.query(User).filter(User.id == patient_id, User.role == "patient").first()
+    if not patient:
+        raise HTTPException(status_code=404, detail="Пациент не найден")
+
+    consultation_ids = [
+        consultation_id for (consultation_id,) in db.query(Consultation.id)
+        .filter(Consultation.patient_id == patient_id)
+        .order_by(Consultation.id)
+        .all()
+    ]
+
+    return _streaming_export(consultation_ids, format, f"patient_{patient_id}_consultations")
@@ -0,0 +1,44 @@
+# backend/fast_json.py
+
+import json
+from typing import Any
+from fastapi.responses import JSONResponse
+
+# orjson - необязательная зависимость: без нее используется стандартный json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Ключи словарей не только строки (как и в стандартном json), numpy и dataclass сериализуются напрямую
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY) if orjson is not None else 0
+
+
+def dumps_bytes(data: Any) -> bytes:
+    """Кодирует данные в JSON (UTF-8)"""
+    if orjson is not None:
+        return orjson.dumps(data, option=ORJSON_OPTIONS)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def dumps(data: Any) -> str:
+    """
+    Кодирует данные в JSON-строку для текстового WebSocket кадра.
+    Рассылка кодирует сообщение один раз и отправляет эту строку всем получателям.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=ORJSON_OPTIONS).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse на orjson: для горячих эндпоинтов чата и уведомлений"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_bytes(content)
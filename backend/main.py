@@ -17,15 +17,16 @@ from fastapi import (
     WebSocketDisconnect,
     Header,
     Request,
+    Body,
 )  # Добавляем WebSocket и WebSocketDisconnect
 from fastapi.responses import RedirectResponse, HTMLResponse
 from fastapi.security import (
     OAuth2PasswordRequestForm,
     OAuth2PasswordBearer,
 )  # Добавляем OAuth2PasswordRequestForm и OAuth2PasswordBearer
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm import Session, joinedload, selectinload
 from typing import Annotated, List, Optional, Union, Dict, Any
-from datetime import timedelta, datetime  # Импортируем timedelta и datetime
+from datetime import timedelta, datetime, timezone  # Импортируем timedelta, datetime и timezone
 from fastapi.middleware.cors import CORSMiddleware
 import smtplib  # Для SMTP-соединения
 from email.mime.text import MIMEText  # Для создания email
@@ -39,8 +40,8 @@ import time
 import jwt  # Импортируем PyJWT
 import asyncio  # Добавляем для асинхронного кода
 from starlette.websockets import WebSocketState  # Импортируем WebSocketState из starlette
-from fastapi.responses import JSONResponse
-from sqlalchemy import func
+from fastapi.responses import JSONResponse, Response
+from sqlalchemy import func, select, and_, or_
 from urllib.parse import urlencode
 import urllib.parse
 from sqlalchemy.exc import IntegrityError
@@ -65,10 +66,11 @@ from models import (
     UserNotificationSettings,
     PendingUser,
     Notification,
-    WebSocketToken,  # Добавляем импорт новой модели
     Call,  # Добавляем импорт модели звонков
     News,  # Добавляем импорт модели новостей
     NewsTranslation,  # Добавляем импорт модели переводов новостей
+    ArchivedTranscript,  # Архив переписки завершенных консультаций
+    NotificationBroadcast,  # Массовые рассылки уведомлений
 )  # Добавляем PendingUser и Notification
 
 # Импортируем функции для работы с паролями и JWT, а также зависимости для аутентификации и ролей
@@ -132,17 +134,68 @@ from news_router import router as news_router
 # Импортируем роутер AI диагностики
 from ai_router import router as ai_router
 
-from dotenv import load_dotenv
+# Импортируем роутер дельта-синхронизации и журнал изменений
+from sync_router import router as sync_router
+from search_router import router as search_router
+from export_router import router as export_router
+from websocket_manager import connection_manager, KIND_CONSULTATION, KIND_NOTIFICATIONS
+from event_bus import event_bus, consultation_channel
+from fast_json import dumps, FastJSONResponse
+from event_coalescer import event_coalescer
+from notification_service import (
+    enqueue_notification,
+    serialize_notification,
+    undelivered_unread_query,
+    mark_delivered,
+    delivery_key,
+    create_broadcast,
+    serialize_broadcast,
+    get_unread_count,
+    get_inbox_version,
+    mark_notification_read,
+    mark_read_up_to,
+    publish_unread_count,
+    publish_notifications_read,
+    notification_dispatcher,
+    UNREAD_ON_CONNECT_LIMIT,
+)
+from ws_tokens import (
+    issue_ws_token,
+    decode_ws_token,
+    verify_ws_token,
+    revocation_list,
+    WS_TOKEN_TTL_SECONDS,
+    WS_SIGNUP_TOKEN_TTL_SECONDS,
+    WS_TOKEN_REVOCATION_ENABLED,
+    REVOCATION_REFRESH_SECONDS,
+)
+from search_service import index_message
+from sync_service import (
+    record_change,
+    record_consultation_change,
+    CHANGE_MESSAGE,
+    CHANGE_READ,
+    CHANGE_NOTIFICATION,
+)
 
-load_dotenv()
+# Настройки уведомлений пользователей (отключенные типы, тихие часы)
+from notification_preferences import MUTABLE_NOTIFICATION_TYPES, parse_muted_types, format_muted_types
+
+# Очистка старых прочитанных уведомлений
+from notification_retention import run_retention_pass, RETENTION_INTERVAL_SECONDS
+
+# Импортируем архив переписки завершенных консультаций
+from transcript_archive import (
+    load_archived_messages,
+    serialize_message as serialize_archived_message,
+    run_archive_batch,
+    ARCHIVE_AFTER_DAYS,
+    ARCHIVE_INTERVAL_SECONDS,
+)
 
-# Глобальные переменные для хранения активных соединений
-active_websocket_connections = {}
-# Глобальное хранилище соединений для консультаций (consultation_id -> list of connections)
-consultation_websocket_connections = {}
+from dotenv import load_dotenv
 
-# Словарь для хранения отправленных уведомлений (user_id -> set(notification_ids))
-sent_notifications = {}
+load_dotenv()
 
 # Создаем директорию для загрузки файлов, если она еще не существует
 UPLOAD_DIR = os.path.join(os.getcwd(), "uploads")
@@ -248,6 +301,101 @@ app.include_router(news_router)
 # Подключаем роутер AI диагностики
 app.include_router(ai_router)
 
+# Подключаем роутер дельта-синхронизации
+app.include_router(sync_router)
+
+# Подключаем роутер поиска по сообщениям
+app.include_router(search_router)
+
+# Подключаем роутер экспорта переписки
+app.include_router(export_router)
+
+
+async def transcript_archive_loop():
+    """Периодически переносит переписку давно завершенных консультаций в архив"""
+    while True:
+        try:
+            stats = await asyncio.to_thread(run_archive_batch)
+            if stats["consultations"] or stats["errors"]:
+                print(f"[Archive] Архивировано консультаций: {stats['consultations']}, "
+                      f"сообщений: {stats['messages']}, "
+                      f"{stats['original_bytes']} -> {stats['compressed_bytes']} байт, "
+                      f"ошибок: {stats['errors']}")
+        except Exception as e:
+            print(f"[Archive] Ошибка фоновой архивации: {str(e)}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+@app.on_event("startup")
+async def start_transcript_archive():
+    # Запускаем фоновую архивацию переписки
+    asyncio.create_task(transcript_archive_loop())
+
+
+async def notification_retention_loop():
+    """Периодически удаляет прочитанные уведомления старше срока хранения их типа"""
+    while True:
+        try:
+            stats = await asyncio.to_thread(run_retention_pass)
+            if stats["deleted"] or stats["outbox_deleted"] or stats["sync_deleted"] or stats["errors"]:
+                print(f"[Retention] Удалено уведомлений: {stats['deleted']} {stats['by_type']}, "
+                      f"строк очереди доставки: {stats['outbox_deleted']}, "
+                      f"записей журнала синхронизации: {stats['sync_deleted']}, "
+                      f"пачек: {stats['batches']}, ошибок: {stats['errors']}, {stats['seconds']} с")
+        except Exception as e:
+            print(f"[Retention] Ошибка фоновой очистки уведомлений: {str(e)}")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+
+@app.on_event("startup")
+async def start_notification_retention():
+    # Запускаем фоновую очистку уведомлений
+    asyncio.create_task(notification_retention_loop())
+
+
+@app.on_event("startup")
+async def start_event_bus():
+    # Подписываемся на события других воркеров (для бэкендов redis и mysql)
+    await event_bus.start()
+    # Доставка уведомлений из очереди notification_outbox
+    await notification_dispatcher.start()
+    # Рассылки, прерванные перезапуском, продолжаются с последнего обработанного пользователя
+    try:
+        await notification_dispatcher.resume_broadcasts()
+    except Exception as e:
+        print(f"[Notifications] Ошибка возобновления рассылок: {str(e)}")
+
+
+@app.on_event("shutdown")
+async def stop_event_bus():
+    # Сначала досылаем накопленные эфемерные события, затем останавливаем шину
+    await notification_dispatcher.stop()
+    await event_coalescer.flush_all()
+    await event_bus.stop()
+
+
+async def ws_token_revocation_loop():
+    """Периодически обновляет bloom-фильтр отозванных WebSocket токенов из БД"""
+    while True:
+        try:
+            await asyncio.to_thread(revocation_list.refresh)
+        except Exception as e:
+            print(f"[WebSocket Token] Ошибка обновления списка отозванных токенов: {str(e)}")
+        await asyncio.sleep(REVOCATION_REFRESH_SECONDS)
+
+
+@app.on_event("startup")
+async def start_ws_token_revocation():
+    # Список отзыва нужен только при включенной проверке отзыва токенов
+    if WS_TOKEN_REVOCATION_ENABLED:
+        asyncio.create_task(ws_token_revocation_loop())
+
+
+@app.on_event("startup")
+async def start_websocket_heartbeat():
+    # Серверный ping и закрытие неактивных/полуоткрытых WebSocket соединений
+    asyncio.create_task(connection_manager.heartbeat_loop())
+
 # Dependency для получения сессии базы данных. Используется в роутах для взаимодействия с БД.
 # Annotated - современный способ указания типа и зависимости.
 DbDependency = Annotated[Session, Depends(get_db)]
@@ -855,7 +1003,7 @@ def verify_email(
             # Логируем ошибку, но продолжаем работу
         
         # Создаем WebSocket токен для пользователя
-        websocket_token = asyncio.run(create_websocket_token(new_user.id, db))
+        websocket_token = issue_ws_token(new_user.id, ttl=WS_SIGNUP_TOKEN_TTL_SECONDS)
         print(f"WebSocket token created for user {new_user.id}: {websocket_token[:10]}...")
         
         # Создаем JWT токен для автоматического входа
@@ -2737,6 +2885,33 @@ class UnreadMessagesResponse(BaseModel):
         from_attributes = True
 
 
+# Модель карточки консультации для ленты: собеседник, последнее сообщение и счетчик непрочитанных
+class ConsultationSummaryResponse(BaseModel):
+    id: int
+    patient_id: int
+    doctor_id: int
+    status: str
+    created_at: datetime
+    counterpart_id: int
+    counterpart_name: Optional[str] = None
+    counterpart_avatar: Optional[str] = None
+    last_message_preview: Optional[str] = None
+    last_message_at: Optional[datetime] = None
+    last_message_sender_id: Optional[int] = None
+    last_activity_at: datetime
+    unread_count: int = 0
+
+
+# Страница ленты консультаций с курсором для следующей страницы
+class ConsultationSummaryPage(BaseModel):
+    items: List[ConsultationSummaryResponse]
+    next_cursor: Optional[str] = None
+
+
+# Максимальная длина превью последнего сообщения в ленте консультаций
+SUMMARY_PREVIEW_LENGTH = 100
+
+
 # --- Роуты для консультаций ---
 
 
@@ -2803,8 +2978,8 @@ async def create_consultation(
         )
 
         db.add(consultation)
-        db.commit()
-        db.refresh(consultation)
+        db.flush()  # Получаем ID консультации для журнала изменений
+        record_consultation_change(db, consultation)
 
         # Получаем информацию о пациенте для уведомления
         patient = db.query(User).filter(User.id == current_user.id).first()
@@ -2820,8 +2995,9 @@ async def create_consultation(
         elif patient:
             patient_name = patient.email.split('@')[0]
             
-        # Создаем уведомление для врача о новой консультации
-        notification = await create_notification(
+        # Уведомление врачу сохраняется в той же транзакции, что и консультация;
+        # по WebSocket его доставит диспетчер уведомлений после коммита
+        enqueue_notification(
             db=db,
             user_id=doctor.id,
             title="Новая заявка на консультацию",
@@ -2829,34 +3005,8 @@ async def create_consultation(
             notification_type="new_consultation",
             related_id=consultation.id
         )
-
-        # Отправка уведомления через WebSocket, если врач подключен
-        try:
-            # Проверяем, подключен ли врач к WebSocket
-            if doctor.id in active_websocket_connections:
-                # Используем объект уведомления из БД для доставки через WebSocket
-                notification_data = {
-                    "id": notification.id,
-                    "title": notification.title,
-                    "message": notification.message,
-                    "type": notification.type,
-                    "related_id": notification.related_id,
-                    "created_at": notification.created_at.isoformat(),
-                    "is_viewed": notification.is_viewed
-                }
-                
-                # Отправляем уведомление всем соединениям врача
-                for conn in active_websocket_connections[doctor.id]:
-                    try:
-                        await conn.send_json({
-                            "type": "new_notification",
-                            "notification": notification_data
-                        })
-                        print(f"WebSocket: Уведомление о новой консультации отправлено врачу {doctor.id}")
-                    except Exception as ws_err:
-                        print(f"WebSocket: Ошибка при отправке уведомления врачу {doctor.id}: {str(ws_err)}")
-        except Exception as e:
-            print(f"Ошибка при отправке WebSocket-уведомления о новой консультации: {str(e)}")
+        db.commit()
+        db.refresh(consultation)
 
         return consultation
     except HTTPException as he:
@@ -2871,6 +3021,7 @@ async def create_consultation(
 @app.get(
     "/api/consultations/unread",
     response_model=UnreadMessagesResponse,
+    response_class=FastJSONResponse,
     tags=["consultations"],
 )
 async def get_unread_messages(
@@ -2950,6 +3101,180 @@ async def get_unread_messages(
         ) from e
 
 
+# Эндпоинт для ленты консультаций с последним сообщением и счетчиком непрочитанных
+# ВАЖНО: Этот маршрут должен быть определен ДО маршрутов с параметрами!
+@app.get(
+    "/api/consultations/summary",
+    response_model=ConsultationSummaryPage,
+    response_class=FastJSONResponse,
+    tags=["consultations"],
+)
+async def get_consultations_summary(
+    status: Optional[str] = Query(
+        None, description="Фильтр по статусу: pending, active, completed, cancelled"
+    ),
+    cursor: Optional[str] = Query(
+        None, description="Курсор next_cursor из предыдущей страницы"
+    ),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Возвращает ленту консультаций текущего пользователя, отсортированную по последней активности.
+    Для каждой консультации: имя и аватар собеседника, превью и время последнего сообщения,
+    количество непрочитанных сообщений. Вся страница собирается одним запросом
+    (последнее сообщение выбирается оконной функцией ROW_NUMBER).
+    """
+    if current_user.role == "patient":
+        own_column = Consultation.patient_id
+        counterpart_column = Consultation.doctor_id
+        CounterpartProfile = DoctorProfile
+        default_name = "Врач"
+    elif current_user.role == "doctor":
+        own_column = Consultation.doctor_id
+        counterpart_column = Consultation.patient_id
+        CounterpartProfile = PatientProfile
+        default_name = "Пациент"
+    else:
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+    # Последнее сообщение каждой консультации пользователя.
+    # Берем на один символ больше лимита превью, чтобы понять, нужно ли многоточие.
+    ranked_messages = (
+        select(
+            Message.consultation_id.label("consultation_id"),
+            func.substr(Message.content, 1, SUMMARY_PREVIEW_LENGTH + 1).label("preview"),
+            Message.sent_at.label("sent_at"),
+            Message.sender_id.label("sender_id"),
+            func.row_number().over(
+                partition_by=Message.consultation_id,
+                order_by=Message.id.desc(),
+            ).label("rn"),
+        )
+        .join(Consultation, Consultation.id == Message.consultation_id)
+        .where(own_column == current_user.id)
+        .subquery()
+    )
+    last_messages = (
+        select(ranked_messages)
+        .where(ranked_messages.c.rn == 1)
+        .subquery()
+    )
+
+    # Количество непрочитанных сообщений, адресованных текущему пользователю
+    unread_counts = (
+        select(
+            Message.consultation_id.label("consultation_id"),
+            func.count(Message.id).label("unread_count"),
+        )
+        .where(Message.receiver_id == current_user.id, Message.is_read == False)
+        .group_by(Message.consultation_id)
+        .subquery()
+    )
+
+    # Для архивированных консультаций последнее сообщение берется из сводки архива
+    last_preview = func.coalesce(
+        last_messages.c.preview,
+        func.substr(ArchivedTranscript.last_message_preview, 1, SUMMARY_PREVIEW_LENGTH + 1),
+    )
+    last_sent_at = func.coalesce(last_messages.c.sent_at, ArchivedTranscript.last_message_at)
+    last_sender_id = func.coalesce(last_messages.c.sender_id, ArchivedTranscript.last_message_sender_id)
+    last_activity = func.coalesce(last_sent_at, Consultation.created_at)
+
+    query = (
+        db.query(
+            Consultation,
+            last_preview,
+            last_sent_at,
+            last_sender_id,
+            func.coalesce(unread_counts.c.unread_count, 0),
+            User.email,
+            User.avatar_path,
+            CounterpartProfile.full_name,
+            last_activity,
+        )
+        .outerjoin(last_messages, last_messages.c.consultation_id == Consultation.id)
+        .outerjoin(ArchivedTranscript, ArchivedTranscript.consultation_id == Consultation.id)
+        .outerjoin(unread_counts, unread_counts.c.consultation_id == Consultation.id)
+        .outerjoin(User, User.id == counterpart_column)
+        .outerjoin(CounterpartProfile, CounterpartProfile.user_id == counterpart_column)
+        .filter(own_column == current_user.id)
+    )
+
+    if status:
+        query = query.filter(Consultation.status == status)
+
+    # Курсор имеет вид "<время последней активности в ISO>|<id консультации>"
+    if cursor:
+        try:
+            cursor_time_raw, cursor_id_raw = cursor.rsplit("|", 1)
+            cursor_time = datetime.fromisoformat(cursor_time_raw)
+            cursor_id = int(cursor_id_raw)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Некорректный курсор")
+
+        query = query.filter(
+            or_(
+                last_activity < cursor_time,
+                and_(last_activity == cursor_time, Consultation.id < cursor_id),
+            )
+        )
+
+    rows = (
+        query.order_by(last_activity.desc(), Consultation.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    items = []
+    for (
+        consultation,
+        preview,
+        last_message_at,
+        last_message_sender_id,
+        unread_count,
+        counterpart_email,
+        counterpart_avatar,
+        counterpart_full_name,
+        last_activity_at,
+    ) in rows:
+        if preview is not None and len(preview) > SUMMARY_PREVIEW_LENGTH:
+            preview = preview[:SUMMARY_PREVIEW_LENGTH - 3] + "..."
+
+        counterpart_name = counterpart_full_name
+        if not counterpart_name:
+            counterpart_name = counterpart_email.split('@')[0] if counterpart_email else default_name
+
+        items.append(ConsultationSummaryResponse(
+            id=consultation.id,
+            patient_id=consultation.patient_id,
+            doctor_id=consultation.doctor_id,
+            status=consultation.status,
+            created_at=consultation.created_at,
+            counterpart_id=(
+                consultation.doctor_id if current_user.role == "patient" else consultation.patient_id
+            ),
+            counterpart_name=counterpart_name,
+            counterpart_avatar=counterpart_avatar,
+            last_message_preview=preview,
+            last_message_at=last_message_at,
+            last_message_sender_id=last_message_sender_id,
+            last_activity_at=last_activity_at,
+            unread_count=unread_count or 0,
+        ))
+
+    next_cursor = None
+    if has_more and items:
+        last_item = items[-1]
+        next_cursor = f"{last_item.last_activity_at.isoformat()}|{last_item.id}"
+
+    return ConsultationSummaryPage(items=items, next_cursor=next_cursor)
+
+
 # Эндпоинт для получения списка консультаций пользователя
 @app.get(
     "/api/consultations",
@@ -3064,8 +3389,7 @@ async def start_consultation(
         # Активируем консультацию
         consultation.status = "active"
         consultation.started_at = datetime.utcnow()
-        db.commit()
-        db.refresh(consultation)
+        record_consultation_change(db, consultation)
 
         # Получаем имя врача для уведомления
         doctor = db.query(User).filter(User.id == consultation.doctor_id).first()
@@ -3080,18 +3404,17 @@ async def start_consultation(
         elif doctor:
             doctor_name = doctor.email.split('@')[0]
 
-        # Создаем уведомление для пациента
-        try:
-            await create_notification(
-                db=db,
-                user_id=consultation.patient_id,
-                title="Консультация принята",
-                message=f"{doctor_name} принял(а) вашу заявку на консультацию. Теперь вы можете обмениваться сообщениями.",
-                notification_type="consultation_started",
-                related_id=consultation.id
-            )
-        except Exception as e:
-            print(f"Ошибка при отправке уведомления о принятии консультации: {str(e)}")
+        # Уведомление пациенту сохраняется вместе со сменой статуса консультации
+        enqueue_notification(
+            db=db,
+            user_id=consultation.patient_id,
+            title="Консультация принята",
+            message=f"{doctor_name} принял(а) вашу заявку на консультацию. Теперь вы можете обмениваться сообщениями.",
+            notification_type="consultation_started",
+            related_id=consultation.id
+        )
+        db.commit()
+        db.refresh(consultation)
 
         # Отправляем WebSocket-уведомление пациенту, если он подключен
         try:
@@ -3168,55 +3491,48 @@ async def complete_consultation(
             # Обновляем статус консультации
             consultation.status = "completed"
             consultation.completed_at = datetime.utcnow()
+            record_consultation_change(db, consultation)
+
+            # Уведомление о завершении второму участнику - в той же транзакции
+            # Получаем профили участников для персонализации уведомлений
+            doctor_profile = db.query(DoctorProfile).filter(DoctorProfile.user_id == consultation.doctor_id).first()
+            patient_profile = db.query(PatientProfile).filter(PatientProfile.user_id == consultation.patient_id).first()
+            
+            doctor_name = "Врач"
+            if doctor_profile:
+                doctor_name = doctor_profile.full_name
+            
+            patient_name = "Пациент"
+            if patient_profile:
+                patient_name = patient_profile.full_name
+            
+            # Создаем уведомление для врача (если завершил пациент)
+            if current_user.id == consultation.patient_id:
+                enqueue_notification(
+                    db=db,
+                    user_id=consultation.doctor_id,
+                    title="🔴 Консультация завершена",
+                    message=f"{patient_name} завершил(а) консультацию. Просмотрите историю для деталей.",
+                    notification_type="consultation_completed",
+                    related_id=consultation.id
+                )
             
+            # Создаем уведомление для пациента (если завершил врач)
+            if current_user.id == consultation.doctor_id:
+                enqueue_notification(
+                    db=db,
+                    user_id=consultation.patient_id,
+                    title="🔴 Консультация завершена",
+                    message=f"{doctor_name} завершил(а) консультацию. Вы можете оставить отзыв о консультации.",
+                    notification_type="consultation_completed",
+                    related_id=consultation.id
+                )
+
             # Фиксируем изменения
             db.commit()
             
             # Получаем обновленную консультацию
             db.refresh(consultation)
-            
-            # Отправляем уведомление о завершении консультации обоим участникам
-            try:
-                # Получаем профили участников для персонализации уведомлений
-                doctor_profile = db.query(DoctorProfile).filter(DoctorProfile.user_id == consultation.doctor_id).first()
-                patient_profile = db.query(PatientProfile).filter(PatientProfile.user_id == consultation.patient_id).first()
-                
-                doctor_name = "Врач"
-                if doctor_profile:
-                    doctor_name = doctor_profile.full_name
-                
-                patient_name = "Пациент"
-                if patient_profile:
-                    patient_name = patient_profile.full_name
-                
-                # Определяем инициатора завершения для корректного формирования сообщения
-                initiator_name = doctor_name if current_user.id == consultation.doctor_id else patient_name
-                
-                # Создаем уведомление для врача (если завершил пациент)
-                if current_user.id == consultation.patient_id:
-                    await create_notification(
-                        db=db,
-                        user_id=consultation.doctor_id,
-                        title="🔴 Консультация завершена",
-                        message=f"{patient_name} завершил(а) консультацию. Просмотрите историю для деталей.",
-                        notification_type="consultation_completed",
-                        related_id=consultation.id
-                    )
-                
-                # Создаем уведомление для пациента (если завершил врач)
-                if current_user.id == consultation.doctor_id:
-                    await create_notification(
-                        db=db,
-                        user_id=consultation.patient_id,
-                        title="🔴 Консультация завершена",
-                        message=f"{doctor_name} завершил(а) консультацию. Вы можете оставить отзыв о консультации.",
-                        notification_type="consultation_completed",
-                        related_id=consultation.id
-                    )
-                
-                print(f"Уведомления о завершении консультации отправлены. Инициатор: {initiator_name}")
-            except Exception as e:
-                print(f"Ошибка при отправке уведомлений о завершении консультации: {str(e)}")
 
             # Отправляем WebSocket уведомление
             try:
@@ -3265,6 +3581,7 @@ async def complete_consultation(
 @app.post(
     "/api/consultations/{consultation_id}/messages",
     response_model=MessageResponse,
+    response_class=FastJSONResponse,
     tags=["consultations"],
 )
 async def send_message(
@@ -3335,6 +3652,36 @@ async def send_message(
 
             # Сохраняем сообщение и обновленную консультацию
             db.add(db_message)
+            db.flush()  # Получаем ID сообщения для журнала изменений
+            record_consultation_change(db, consultation, CHANGE_MESSAGE, db_message.id)
+            index_message(db, db_message.id, consultation_id, db_message.content)
+            record_consultation_change(db, consultation)
+
+            # Уведомление получателю о новом сообщении - в той же транзакции,
+            # доставку по WebSocket выполнит диспетчер уведомлений после коммита
+            sender_name = "Пользователь"
+            if current_user.role == "doctor":
+                doctor_profile = db.query(DoctorProfile).filter(DoctorProfile.user_id == current_user.id).first()
+                if doctor_profile:
+                    sender_name = doctor_profile.full_name
+            elif current_user.role == "patient":
+                patient_profile = db.query(PatientProfile).filter(PatientProfile.user_id == current_user.id).first()
+                if patient_profile:
+                    sender_name = patient_profile.full_name
+            
+            # Подготавливаем текст сообщения для уведомления (укорачиваем для предпросмотра)
+            message_preview = db_message.content
+            if len(message_preview) > 50:
+                message_preview = message_preview[:47] + "..."
+            
+            enqueue_notification(
+                db=db,
+                user_id=db_message.receiver_id,
+                title="📩 Новое сообщение в консультации",
+                message=f"{sender_name}: {message_preview}",
+                notification_type="new_message",
+                related_id=consultation.id
+            )
             db.commit()
             db.refresh(db_message)
             
@@ -3373,63 +3720,6 @@ async def send_message(
     except Exception as e:
         print(f"[WebSocket] Ошибка при отправке сообщения через WebSocket: {str(e)}")
 
-    # Добавляем уведомление получателю о новом сообщении
-    try:
-        # Определяем получателя (если отправитель - врач, то получатель - пациент и наоборот)
-        recipient_id = consultation.patient_id if current_user.id == consultation.doctor_id else consultation.doctor_id
-        
-        # Получаем профиль отправителя для персонализации уведомления
-        sender_name = "Пользователь"
-        if current_user.role == "doctor":
-            doctor_profile = db.query(DoctorProfile).filter(DoctorProfile.user_id == current_user.id).first()
-            if doctor_profile:
-                sender_name = doctor_profile.full_name
-        elif current_user.role == "patient":
-            patient_profile = db.query(PatientProfile).filter(PatientProfile.user_id == current_user.id).first()
-            if patient_profile:
-                sender_name = patient_profile.full_name
-        
-        # Подготавливаем текст сообщения для уведомления (укорачиваем для предпросмотра)
-        message_preview = db_message.content
-        if len(message_preview) > 50:
-            message_preview = message_preview[:47] + "..."
-        
-        # Создаем уведомление
-        notification = await create_notification(
-            db=db,
-            user_id=recipient_id,
-            title="📩 Новое сообщение в консультации",
-            message=f"{sender_name}: {message_preview}",
-            notification_type="new_message",
-            related_id=consultation.id
-        )
-        
-        print(f"Уведомление о новом сообщении отправлено пользователю {recipient_id}")
-        
-        # Немедленно отправляем уведомление через WebSocket, если получатель подключен
-        if recipient_id in active_websocket_connections:
-            notification_data = {
-                "id": notification.id,
-                "title": notification.title,
-                "message": notification.message,
-                "type": notification.type,
-                "is_viewed": notification.is_viewed,
-                "created_at": notification.created_at.isoformat(),
-                "related_id": notification.related_id
-            }
-            
-            for connection in active_websocket_connections[recipient_id]:
-                try:
-                    await connection.send_json({
-                        "type": "new_notification",
-                        "notification": notification_data
-                    })
-                    print(f"Мгновенное уведомление о новом сообщении отправлено пользователю {recipient_id}")
-                except Exception as ws_error:
-                    print(f"Ошибка отправки мгновенного уведомления о сообщении: {str(ws_error)}")
-    except Exception as e:
-        print(f"Ошибка при создании уведомления о новом сообщении: {str(e)}")
-
     # Проверяем, не нужно ли автоматически завершить консультацию
     if consultation.message_count >= consultation.message_limit and current_user.id == consultation.patient_id:
         # Используем retry логику для автоматического завершения
@@ -3453,12 +3743,12 @@ async def send_message(
                 # Автоматически завершаем консультацию
                 fresh_consultation.status = "completed"
                 fresh_consultation.completed_at = datetime.utcnow()
-                db.commit()
+                record_consultation_change(db, fresh_consultation)
                 
                 # Обновляем локальную переменную
                 consultation = fresh_consultation
                 
-                # Отправляем уведомления о завершении
+                # Уведомления о завершении - в той же транзакции
                 doctor_profile = db.query(DoctorProfile).filter(DoctorProfile.user_id == consultation.doctor_id).first()
                 patient_profile = db.query(PatientProfile).filter(PatientProfile.user_id == consultation.patient_id).first()
                 
@@ -3466,7 +3756,7 @@ async def send_message(
                 patient_name = patient_profile.full_name if patient_profile else "Пациент"
                 
                 # Уведомление для врача
-                await create_notification(
+                enqueue_notification(
                     db=db,
                     user_id=consultation.doctor_id,
                     title="🔴 Консультация автоматически завершена",
@@ -3476,7 +3766,7 @@ async def send_message(
                 )
                 
                 # Уведомление для пациента
-                await create_notification(
+                enqueue_notification(
                     db=db,
                     user_id=consultation.patient_id,
                     title="🔴 Консультация автоматически завершена",
@@ -3484,6 +3774,7 @@ async def send_message(
                     notification_type="consultation_completed",
                     related_id=consultation.id
                 )
+                db.commit()
                 
                 # Отправляем WebSocket уведомление о завершении
                 await broadcast_consultation_update(consultation_id, {
@@ -3524,6 +3815,7 @@ async def send_message(
 @app.get(
     "/api/consultations/{consultation_id}/messages",
     response_model=List[MessageResponse],
+    response_class=FastJSONResponse,
     tags=["consultations"],
 )
 async def get_messages(
@@ -3553,6 +3845,10 @@ async def get_messages(
             status_code=403, detail="У вас нет доступа к сообщениям этой консультации"
         )
 
+    # Переписка давно завершенной консультации хранится в архиве
+    if consultation.archived_at:
+        return load_archived_messages(db, consultation_id)
+
     # Получаем сообщения с вложениями, исключая временные вложения с message_id=0
     messages = (
         db.query(Message)
@@ -3573,20 +3869,15 @@ async def get_messages(
             unread_messages_updated = True
 
     if unread_messages_updated:
+        record_consultation_change(db, consultation, CHANGE_READ, current_user.id)
         db.commit()
         
         # Отправляем уведомление через WebSocket о прочтении сообщений
-        if consultation_id in consultation_websocket_connections:
-            for connection in consultation_websocket_connections.get(consultation_id, []):
-                try:
-                    await connection.send_json({
-                        "type": "messages_read",
-                        "reader_id": current_user.id,
-                        "consultation_id": consultation_id
-                    })
-                except:
-                    # Если возникла ошибка при отправке, пропускаем
-                    pass
+        await broadcast_consultation_update(consultation_id, {
+            "type": "messages_read",
+            "reader_id": current_user.id,
+            "consultation_id": consultation_id
+        })
 
     return messages
 
@@ -3692,6 +3983,7 @@ async def upload_consultation_file(
 @app.post(
     "/api/consultations/{consultation_id}/messages-with-files",
     response_model=MessageResponse,
+    response_class=FastJSONResponse,
     tags=["consultations"],
 )
 async def send_message_with_files(
@@ -3796,6 +4088,10 @@ async def send_message_with_files(
             # Увеличиваем счетчик сообщений
             consultation.message_count += 1
 
+            record_consultation_change(db, consultation, CHANGE_MESSAGE, db_message.id)
+            index_message(db, db_message.id, consultation_id, db_message.content)
+            record_consultation_change(db, consultation)
+
             # Сохраняем изменения
             db.commit()
             
@@ -4179,6 +4475,12 @@ class NotificationSettingsUpdate(CsrfProtectedRequest):
     email_notifications: bool = True
     push_notifications: bool = True
     appointment_reminders: bool = True
+    # Необязательные поля: если не переданы, сохраненные значения не меняются
+    muted_types: Optional[List[str]] = None
+    quiet_hours_start: Optional[int] = Field(None, ge=0, le=23)
+    quiet_hours_end: Optional[int] = Field(None, ge=0, le=23)
+    # Отключить тихие часы (quiet_hours_start/end = None)
+    clear_quiet_hours: bool = False
 
 
 # Модель для ответа с настройками уведомлений
@@ -4186,12 +4488,27 @@ class NotificationSettingsResponse(BaseModel):
     email_notifications: bool
     push_notifications: bool
     appointment_reminders: bool
+    muted_types: List[str] = []
+    quiet_hours_start: Optional[int] = None
+    quiet_hours_end: Optional[int] = None
     updated_at: datetime
 
     class Config:
         from_attributes = True
 
 
+def _notification_settings_response(settings: UserNotificationSettings) -> NotificationSettingsResponse:
+    return NotificationSettingsResponse(
+        email_notifications=settings.email_notifications,
+        push_notifications=settings.push_notifications,
+        appointment_reminders=settings.appointment_reminders,
+        muted_types=parse_muted_types(settings.muted_types),
+        quiet_hours_start=settings.quiet_hours_start,
+        quiet_hours_end=settings.quiet_hours_end,
+        updated_at=settings.updated_at,
+    )
+
+
 # Эндпоинт для получения настроек уведомлений пользователя
 @app.get("/users/me/notification-settings", response_model=NotificationSettingsResponse)
 async def get_notification_settings(
@@ -4219,7 +4536,7 @@ async def get_notification_settings(
         db.commit()
         db.refresh(settings)
 
-    return settings
+    return _notification_settings_response(settings)
 
 
 # Эндпоинт для обновления настроек уведомлений пользователя
@@ -4260,10 +4577,33 @@ async def update_notification_settings(
         settings.push_notifications = settings_data.push_notifications
         settings.appointment_reminders = settings_data.appointment_reminders
 
+    if settings_data.muted_types is not None:
+        unknown_types = set(settings_data.muted_types) - set(MUTABLE_NOTIFICATION_TYPES)
+        if unknown_types:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Нельзя отключить уведомления типов: {', '.join(sorted(unknown_types))}",
+            )
+        settings.muted_types = format_muted_types(settings_data.muted_types)
+    if settings_data.clear_quiet_hours:
+        settings.quiet_hours_start = None
+        settings.quiet_hours_end = None
+    elif settings_data.quiet_hours_start is not None or settings_data.quiet_hours_end is not None:
+        if settings_data.quiet_hours_start is None or settings_data.quiet_hours_end is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Укажите начало и конец тихих часов",
+            )
+        settings.quiet_hours_start = settings_data.quiet_hours_start
+        settings.quiet_hours_end = settings_data.quiet_hours_end
+
     db.commit()
     db.refresh(settings)
 
-    return settings
+    # Диспетчер уведомлений сразу применяет новые настройки
+    notification_dispatcher.preferences.invalidate(current_user.id)
+
+    return _notification_settings_response(settings)
 
 
 # Эндпоинт для проверки существования email
@@ -4344,6 +4684,7 @@ async def delete_account(
     if notification_settings:
         db.delete(notification_settings)
         db.commit()
+        notification_dispatcher.preferences.invalidate(current_user.id)
     
     # Удаляем пользователя из базы данных
     # Каскадное удаление связанных записей настроено в моделях (cascade="all, delete-orphan")
@@ -4398,6 +4739,7 @@ async def extend_consultation(
 
     # Добавляем 30 сообщений к лимиту
     consultation.message_limit += 30
+    record_consultation_change(db, consultation)
 
     db.commit()
     db.refresh(consultation)
@@ -4439,32 +4781,26 @@ async def notify_about_consultation(
     # Определяем получателя уведомления (если отправитель - врач, то получатель - пациент и наоборот)
     recipient_id = consultation.patient_id if current_user.id == consultation.doctor_id else consultation.doctor_id
     
-    # Создаем уведомление
-    notification = Notification(
-        user_id=recipient_id,
-        title="Обновление по консультации",
-        message=message_data.get("message", "Есть обновление по вашей консультации."),
-        type="consultation_update",
-        is_viewed=False
+    # Создаем уведомление через очередь доставки (счетчик, настройки, журнал синхронизации)
+    enqueue_notification(
+        db,
+        recipient_id,
+        "Обновление по консультации",
+        message_data.get("message", "Есть обновление по вашей консультации."),
+        notification_type="consultation_update",
+        related_id=consultation_id,
     )
-    
-    db.add(notification)
     db.commit()
     
     return None
 
-# Глобальное хранилище активных WebSocket соединений (user_id -> list of connections)
-active_websocket_connections = {}
-# Глобальное хранилище соединений для консультаций (consultation_id -> list of connections)
-consultation_websocket_connections = {}
-
 # WebSocket эндпоинт для чата консультаций
 @app.websocket("/ws/consultations/{consultation_id}")
 async def websocket_consultation_endpoint(
     websocket: WebSocket, 
     consultation_id: int,
-    db: Session = Depends(get_db),
-    token: str = Query(None)
+    token: str = Query(None),
+    last_seq: Optional[int] = Query(None)
 ):
     # Проверяем авторизацию через токен
     if token is None:
@@ -4472,471 +4808,486 @@ async def websocket_consultation_endpoint(
         return
     
     try:
-        # Проверяем токен в базе данных напрямую (без JWT декодирования)
-        ws_token = db.query(WebSocketToken).filter(
-            WebSocketToken.token == token,
-            WebSocketToken.expires_at > datetime.utcnow()
-        ).first()
-        
-        if not ws_token:
+        # Подписанный токен проверяется в памяти, без запроса к БД
+        user_id = await verify_ws_token(token)
+        if user_id is None:
             print(f"WebSocket token validation failed for consultation {consultation_id}")
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Недействительный токен")
             return
-            
-        # Получаем ID пользователя из токена
-        user_id = ws_token.user_id
-        
-        # Получаем консультацию
-        consultation = db.query(Consultation).filter(Consultation.id == consultation_id).first()
-        # Проверяем, имеет ли пользователь доступ к этой консультации
-        if consultation is None:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Консультация не найдена")
-            return
-        
-        if user_id != consultation.patient_id and user_id != consultation.doctor_id:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Доступ запрещен")
-            return
         
-        # Проверка существования пользователя
-        user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
-        if user is None:
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Пользователь не найден")
-            return
+        # Проверка доступа - в короткой сессии, которая закрывается до начала работы с соединением:
+        # открытый WebSocket не держит подключение к БД
+        with SessionLocal() as db:
+            # Получаем консультацию
+            consultation = db.query(Consultation).filter(Consultation.id == consultation_id).first()
+            # Проверяем, имеет ли пользователь доступ к этой консультации
+            if consultation is None:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Консультация не найдена")
+                return
+        
+            if user_id != consultation.patient_id and user_id != consultation.doctor_id:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Доступ запрещен")
+                return
+        
+            # Проверка существования пользователя
+            user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
+            if user is None:
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Пользователь не найден")
+                return
         
         # Принимаем соединение
         await websocket.accept()
         print(f"WebSocket соединение принято для консультации {consultation_id}, пользователь {user_id}")
         
-        # Добавляем соединение в список активных
-        if user_id not in active_websocket_connections:
-            active_websocket_connections[user_id] = []
-        
-        # Проверяем, не добавлено ли уже это соединение (избегаем дублирования)
-        if websocket not in active_websocket_connections[user_id]:
-            active_websocket_connections[user_id].append(websocket)
+        # Регистрируем соединение для пользователя и консультации.
+        # Пользователь пришел в чат, только если это его первое соединение с консультацией
+        first_connection = not connection_manager.consultation_connections(consultation_id, user_id)
+        connection_manager.connect(websocket, user_id, KIND_CONSULTATION, consultation_id=consultation_id)
+        if first_connection:
+            event_coalescer.presence(consultation_id, user_id, True)
+        
+        # Повтор пропущенных событий: клиент передает seq последнего полученного события.
+        # Регистрация и постановка в очередь идут без await, поэтому новые события не обгонят повтор
+        if last_seq is not None:
+            missed_events, current_seq = event_bus.replay.since(consultation_id, last_seq)
+        else:
+            missed_events, current_seq = [], event_bus.replay.current_seq(consultation_id)
         
-        if consultation_id not in consultation_websocket_connections:
-            consultation_websocket_connections[consultation_id] = []
+        for payload in missed_events or ():
+            connection_manager.enqueue(websocket, payload)
         
-        # Проверяем, не добавлено ли уже это соединение (избегаем дублирования)
-        if websocket not in consultation_websocket_connections[consultation_id]:
-            consultation_websocket_connections[consultation_id].append(websocket)
+        # gap=True: пропущено больше, чем хранит буфер - клиент загружает историю через HTTP API
+        connection_manager.enqueue(websocket, {
+            "type": "replay",
+            "seq": current_seq,
+            "replayed": len(missed_events) if missed_events is not None else 0,
+            "gap": missed_events is None
+        })
         
         # Ожидаем сообщения
         try:
             while True:
                 data = await websocket.receive_json()
+                connection_manager.touch(websocket)
                 
-                # Если это текстовое сообщение
-                if data.get("type") == "message":
-                    content = data.get("content")
-                    temp_id = data.get("temp_id")  # ID временного сообщения с фронтенда
-                    
-                    if not content:
+                # Пинг обрабатывается без обращения к БД
+                if data.get("type") == "ping":
+                    connection_manager.enqueue(websocket, {"type": "pong"})
+                    continue
+                
+                # Отметки о прочтении и набор текста сливаются за короткое окно в один кадр;
+                # прочтение сохраняется в БД одним UPDATE "прочитано до сообщения X"
+                if data.get("type") == "read_receipt":
+                    message_id = data.get("message_id")
+                    if isinstance(message_id, int):
+                        event_coalescer.read_up_to(consultation_id, user.id, message_id)
+                    continue
+                
+                if data.get("type") == "typing":
+                    event_coalescer.typing(consultation_id, user.id, data.get("typing", True))
+                    continue
+                
+                if data.get("type") not in ("message", "status_update", "mark_read", "get_messages_bulk"):
+                    continue
+                
+                # Каждое событие обрабатывается в своей короткой сессии БД:
+                # между событиями соединение не держит подключение из пула
+                with SessionLocal() as db:
+                    # Консультацию читаем заново: статус и счетчики могли измениться с момента подключения
+                    consultation = db.get(Consultation, consultation_id)
+                    if consultation is None:
+                        connection_manager.enqueue(websocket, {
+                            "type": "error",
+                            "message": "Консультация не найдена или была удалена"
+                        })
                         continue
                     
-                    # Попытка создать сообщение с несколькими попытками при ошибке конфликта
-                    attempts = 0
-                    max_attempts = 3
-                    success = False
+                    # Если это текстовое сообщение
+                    if data.get("type") == "message":
+                        content = data.get("content")
+                        temp_id = data.get("temp_id")  # ID временного сообщения с фронтенда
                     
-                    while attempts < max_attempts and not success:
-                        try:
-                            # Важно: получаем новую (свежую) копию объекта консультации перед каждой попыткой
-                            # чтобы избежать ошибки "Record has changed since last read"
-                            fresh_consultation = (
-                                db.query(Consultation)
-                                .filter(Consultation.id == consultation_id)
-                                .with_for_update()  # Блокируем строку для обновления
-                                .first()
-                            )
+                        if not content:
+                            continue
+                    
+                        # Попытка создать сообщение с несколькими попытками при ошибке конфликта
+                        attempts = 0
+                        max_attempts = 3
+                        success = False
+                    
+                        while attempts < max_attempts and not success:
+                            try:
+                                # Важно: получаем новую (свежую) копию объекта консультации перед каждой попыткой
+                                # чтобы избежать ошибки "Record has changed since last read"
+                                fresh_consultation = (
+                                    db.query(Consultation)
+                                    .filter(Consultation.id == consultation_id)
+                                    .with_for_update()  # Блокируем строку для обновления
+                                    .first()
+                                )
                             
-                            if not fresh_consultation:
-                                await websocket.send_json({
-                                    "type": "error",
-                                    "message": "Консультация не найдена или была удалена"
-                                })
-                                break
+                                if not fresh_consultation:
+                                    connection_manager.enqueue(websocket, {
+                                        "type": "error",
+                                        "message": "Консультация не найдена или была удалена"
+                                    })
+                                    break
                             
-                            # Создаем новое сообщение
-                            new_message = Message(
-                                consultation_id=consultation_id,
-                                sender_id=user.id,
-                                content=content,
-                                sender_role=user.role,  # Добавляем роль отправителя
-                                is_read=False,
-                                receiver_id=consultation.doctor_id if user.id == consultation.patient_id else consultation.patient_id,
-                                receiver_role="doctor" if user.id == consultation.patient_id else "patient"
-                            )
+                                # Создаем новое сообщение
+                                new_message = Message(
+                                    consultation_id=consultation_id,
+                                    sender_id=user.id,
+                                    content=content,
+                                    sender_role=user.role,  # Добавляем роль отправителя
+                                    is_read=False,
+                                    receiver_id=consultation.doctor_id if user.id == consultation.patient_id else consultation.patient_id,
+                                    receiver_role="doctor" if user.id == consultation.patient_id else "patient"
+                                )
                             
-                            # Увеличиваем счетчик сообщений для контроля лимита
-                            # Только если отправитель - пациент (у врача нет лимита)
-                            if user.id == fresh_consultation.patient_id:
-                                fresh_consultation.message_count += 1
+                                # Увеличиваем счетчик сообщений для контроля лимита
+                                # Только если отправитель - пациент (у врача нет лимита)
+                                if user.id == fresh_consultation.patient_id:
+                                    fresh_consultation.message_count += 1
                             
-                            # Сначала добавляем сообщение
-                            db.add(new_message)
-                            # Затем сохраняем изменения
-                            db.commit()
-                            # Обновляем объект из БД
-                            db.refresh(new_message)
+                                # Сначала добавляем сообщение
+                                db.add(new_message)
+                                db.flush()
+                                record_consultation_change(db, fresh_consultation, CHANGE_MESSAGE, new_message.id)
+                                index_message(db, new_message.id, consultation_id, new_message.content)
+                                record_consultation_change(db, fresh_consultation)
+                                # Затем сохраняем изменения
+                                db.commit()
+                                # Обновляем объект из БД
+                                db.refresh(new_message)
                             
-                            # Если успешно, выходим из цикла
-                            success = True
+                                # Если успешно, выходим из цикла
+                                success = True
                             
-                            # Преобразуем сообщение в JSON для отправки
-                            message_data = {
-                                "id": new_message.id,
-                                "consultation_id": new_message.consultation_id,
-                                "sender_id": new_message.sender_id,
-                                "content": new_message.content,
-                                "sent_at": new_message.sent_at.isoformat(),
-                                "is_read": new_message.is_read,
-                                "sender_role": new_message.sender_role,
-                                "receiver_id": new_message.receiver_id,
-                                "receiver_role": new_message.receiver_role
-                            }
+                                # Преобразуем сообщение в JSON для отправки
+                                message_data = {
+                                    "id": new_message.id,
+                                    "consultation_id": new_message.consultation_id,
+                                    "sender_id": new_message.sender_id,
+                                    "content": new_message.content,
+                                    "sent_at": new_message.sent_at.isoformat(),
+                                    "is_read": new_message.is_read,
+                                    "sender_role": new_message.sender_role,
+                                    "receiver_id": new_message.receiver_id,
+                                    "receiver_role": new_message.receiver_role
+                                }
                             
-                            # Отправляем подтверждение отправителю
-                            await websocket.send_json({
-                                "type": "message",
-                                "message": message_data,
-                                "temp_id": temp_id
-                            })
+                                # Отправляем подтверждение отправителю
+                                connection_manager.enqueue(websocket, {
+                                    "type": "message",
+                                    "message": message_data,
+                                    "temp_id": temp_id
+                                })
                             
-                            # Отправляем сообщение всем подключенным к консультации
-                            await broadcast_consultation_update(consultation_id, {
-                                "type": "message", 
-                                "message": message_data
-                            })
+                                # Отправляем сообщение всем подключенным к консультации
+                                await broadcast_consultation_update(consultation_id, {
+                                    "type": "message", 
+                                    "message": message_data
+                                })
                             
-                        except Exception as e:
-                            # Увеличиваем счетчик попыток
-                            attempts += 1
+                            except Exception as e:
+                                # Увеличиваем счетчик попыток
+                                attempts += 1
                             
-                            # Логируем ошибку
-                            print(f"Ошибка при сохранении сообщения (попытка {attempts}/{max_attempts}): {str(e)}")
+                                # Логируем ошибку
+                                print(f"Ошибка при сохранении сообщения (попытка {attempts}/{max_attempts}): {str(e)}")
                             
-                            # Если это ошибка конфликта записи или другая ошибка транзакции
-                            if "Record has changed" in str(e) or "transaction has been rolled back" in str(e):
-                                # Выполняем откат транзакции
-                                db.rollback()
+                                # Если это ошибка конфликта записи или другая ошибка транзакции
+                                if "Record has changed" in str(e) or "transaction has been rolled back" in str(e):
+                                    # Выполняем откат транзакции
+                                    db.rollback()
                                 
-                                # Если это не последняя попытка, ждем небольшую паузу
-                                if attempts < max_attempts:
-                                    await asyncio.sleep(0.2 * attempts)  # увеличиваем время ожидания с каждой попыткой
-                            else:
-                                # Другие ошибки - просто логируем и откатываем
-                                db.rollback()
+                                    # Если это не последняя попытка, ждем небольшую паузу
+                                    if attempts < max_attempts:
+                                        await asyncio.sleep(0.2 * attempts)  # увеличиваем время ожидания с каждой попыткой
+                                else:
+                                    # Другие ошибки - просто логируем и откатываем
+                                    db.rollback()
                                 
-                                # Если мы уже сделали максимальное количество попыток, прекращаем
-                                if attempts >= max_attempts:
-                                    # Отправляем сообщение об ошибке клиенту
-                                    try:
-                                        await websocket.send_json({
-                                            "type": "error",
-                                            "message": "Не удалось сохранить сообщение. Пожалуйста, попробуйте позже."
-                                        })
-                                    except:
-                                        pass
-                    
-                    # Если все попытки неудачны, переходим к следующей итерации
-                    if not success:
-                        continue
-                
-                # Если это уведомление о прочтении сообщений
-                elif data.get("type") == "read_receipt":
-                    message_id = data.get("message_id")
+                                    # Если мы уже сделали максимальное количество попыток, прекращаем
+                                    if attempts >= max_attempts:
+                                        # Отправляем сообщение об ошибке клиенту
+                                        try:
+                                            connection_manager.enqueue(websocket, {
+                                                "type": "error",
+                                                "message": "Не удалось сохранить сообщение. Пожалуйста, попробуйте позже."
+                                            })
+                                        except:
+                                            pass
                     
-                    if message_id:
-                        # Помечаем конкретное сообщение как прочитанное
-                        message = (
-                            db.query(Message)
-                            .filter(
-                                Message.consultation_id == consultation_id,
-                                Message.id == message_id,
-                                Message.sender_id != user.id  # Не отмечаем собственные сообщения
-                            )
-                            .first()
-                        )
-                        
-                        if message and not message.is_read:
-                            message.is_read = True
-                            db.commit()
-                            
-                            # Отправляем уведомление о прочтении сообщения
-                            await broadcast_consultation_update(consultation_id, {
-                                "type": "read_receipt",
-                                "message_id": message_id
-                            })
+                        # Если все попытки неудачны, переходим к следующей итерации
+                        if not success:
+                            continue
                 
-                # Если это уведомление об изменении статуса консультации
-                elif data.get("type") == "status_update":
-                    # Проверяем, что отправитель является участником консультации
-                    if user.id == consultation.doctor_id or user.id == consultation.patient_id or user.role == "admin":
-                        new_status = data.get("status")
-                        auto_completed = data.get("auto_completed", False)
-                        reason = data.get("reason", "")
+                    # Если это уведомление об изменении статуса консультации
+                    elif data.get("type") == "status_update":
+                        # Проверяем, что отправитель является участником консультации
+                        if user.id == consultation.doctor_id or user.id == consultation.patient_id or user.role == "admin":
+                            new_status = data.get("status")
+                            auto_completed = data.get("auto_completed", False)
+                            reason = data.get("reason", "")
                         
-                        if new_status in ["completed"]:
-                            # Используем retry логику для предотвращения блокировок БД
-                            max_retries = 3
-                            retry_count = 0
+                            if new_status in ["completed"]:
+                                # Используем retry логику для предотвращения блокировок БД
+                                max_retries = 3
+                                retry_count = 0
                             
-                            while retry_count < max_retries:
-                                try:
-                                    # Получаем свежую копию консультации с блокировкой
-                                    fresh_consultation = (
-                                        db.query(Consultation)
-                                        .filter(Consultation.id == consultation_id)
-                                        .with_for_update()
-                                        .first()
-                                    )
+                                while retry_count < max_retries:
+                                    try:
+                                        # Получаем свежую копию консультации с блокировкой
+                                        fresh_consultation = (
+                                            db.query(Consultation)
+                                            .filter(Consultation.id == consultation_id)
+                                            .with_for_update()
+                                            .first()
+                                        )
                                     
-                                    if not fresh_consultation:
-                                        await websocket.send_json({
-                                            "type": "error",
-                                            "message": "Консультация не найдена или была удалена"
-                                        })
-                                        break
+                                        if not fresh_consultation:
+                                            connection_manager.enqueue(websocket, {
+                                                "type": "error",
+                                                "message": "Консультация не найдена или была удалена"
+                                            })
+                                            break
                                     
-                                    # Обновляем статус консультации
-                                    fresh_consultation.status = new_status
-                                    fresh_consultation.completed_at = datetime.utcnow()
-                                    db.commit()
-                                    db.refresh(fresh_consultation)
+                                        # Обновляем статус консультации
+                                        fresh_consultation.status = new_status
+                                        fresh_consultation.completed_at = datetime.utcnow()
+                                        record_consultation_change(db, fresh_consultation)
+                                        db.commit()
+                                        db.refresh(fresh_consultation)
                                     
-                                    # Обновляем локальную переменную consultation
-                                    consultation = fresh_consultation
+                                        # Обновляем локальную переменную consultation
+                                        consultation = fresh_consultation
                                     
-                                    # Отправляем уведомление об изменении статуса
-                                    await broadcast_consultation_update(consultation_id, {
-                                        "type": "status_update",
-                                        "consultation": {
-                                            "id": consultation.id,
-                                            "status": consultation.status,
-                                            "completed_at": consultation.completed_at.isoformat() if consultation.completed_at else None
-                                        },
-                                        "initiator_id": user.id,
-                                        "initiator_role": user.role,
-                                        "auto_completed": auto_completed,
-                                        "reason": reason
-                                    })
+                                        # Отправляем уведомление об изменении статуса
+                                        await broadcast_consultation_update(consultation_id, {
+                                            "type": "status_update",
+                                            "consultation": {
+                                                "id": consultation.id,
+                                                "status": consultation.status,
+                                                "completed_at": consultation.completed_at.isoformat() if consultation.completed_at else None
+                                            },
+                                            "initiator_id": user.id,
+                                            "initiator_role": user.role,
+                                            "auto_completed": auto_completed,
+                                            "reason": reason
+                                        })
                                     
-                                    # Создаем уведомления для участников
-                                    try:
-                                        # Получаем профили участников для персонализации уведомлений
-                                        doctor_profile = db.query(DoctorProfile).filter(DoctorProfile.user_id == consultation.doctor_id).first()
-                                        patient_profile = db.query(PatientProfile).filter(PatientProfile.user_id == consultation.patient_id).first()
+                                        # Создаем уведомления для участников
+                                        try:
+                                            # Получаем профили участников для персонализации уведомлений
+                                            doctor_profile = db.query(DoctorProfile).filter(DoctorProfile.user_id == consultation.doctor_id).first()
+                                            patient_profile = db.query(PatientProfile).filter(PatientProfile.user_id == consultation.patient_id).first()
                                         
-                                        doctor_name = "Врач"
-                                        if doctor_profile:
-                                            doctor_name = doctor_profile.full_name
+                                            doctor_name = "Врач"
+                                            if doctor_profile:
+                                                doctor_name = doctor_profile.full_name
                                         
-                                        patient_name = "Пациент"
-                                        if patient_profile:
-                                            patient_name = patient_profile.full_name
+                                            patient_name = "Пациент"
+                                            if patient_profile:
+                                                patient_name = patient_profile.full_name
                                         
-                                        # Формируем сообщения в зависимости от автоматического завершения
-                                        if auto_completed and reason:
-                                            doctor_message = f"Консультация с {patient_name} автоматически завершена: {reason}"
-                                            patient_message = f"Консультация с {doctor_name} автоматически завершена: {reason}. Вы можете оставить отзыв о консультации."
-                                        else:
-                                            # Определяем инициатора завершения для корректного формирования сообщения
-                                            initiator_name = doctor_name if user.id == consultation.doctor_id else patient_name
+                                            # Формируем сообщения в зависимости от автоматического завершения
+                                            if auto_completed and reason:
+                                                doctor_message = f"Консультация с {patient_name} автоматически завершена: {reason}"
+                                                patient_message = f"Консультация с {doctor_name} автоматически завершена: {reason}. Вы можете оставить отзыв о консультации."
+                                            else:
+                                                # Определяем инициатора завершения для корректного формирования сообщения
+                                                initiator_name = doctor_name if user.id == consultation.doctor_id else patient_name
                                             
-                                            doctor_message = f"{patient_name if user.id == consultation.patient_id else 'Консультация'} завершил(а) консультацию."
-                                            patient_message = f"{doctor_name if user.id == consultation.doctor_id else 'Консультация'} завершил(а) консультацию. Вы можете оставить отзыв о консультации."
+                                                doctor_message = f"{patient_name if user.id == consultation.patient_id else 'Консультация'} завершил(а) консультацию."
+                                                patient_message = f"{doctor_name if user.id == consultation.doctor_id else 'Консультация'} завершил(а) консультацию. Вы можете оставить отзыв о консультации."
                                         
-                                        # Создаем уведомление для врача
-                                        if user.id != consultation.doctor_id:
-                                            await create_notification(
-                                                db=db,
-                                                user_id=consultation.doctor_id,
-                                                title="🔴 Консультация завершена",
-                                                message=doctor_message,
-                                                notification_type="consultation_completed",
-                                                related_id=consultation.id
-                                            )
+                                            # Создаем уведомление для врача
+                                            if user.id != consultation.doctor_id:
+                                                enqueue_notification(
+                                                    db=db,
+                                                    user_id=consultation.doctor_id,
+                                                    title="🔴 Консультация завершена",
+                                                    message=doctor_message,
+                                                    notification_type="consultation_completed",
+                                                    related_id=consultation.id
+                                                )
                                         
-                                        # Создаем уведомление для пациента
-                                        if user.id != consultation.patient_id:
-                                            await create_notification(
-                                                db=db,
-                                                user_id=consultation.patient_id,
-                                                title="🔴 Консультация завершена",
-                                                message=patient_message,
-                                                notification_type="consultation_completed",
-                                                related_id=consultation.id
-                                            )
-                                    except Exception as notif_error:
-                                        print(f"Ошибка при отправке уведомлений о завершении: {str(notif_error)}")
+                                            # Создаем уведомление для пациента
+                                            if user.id != consultation.patient_id:
+                                                enqueue_notification(
+                                                    db=db,
+                                                    user_id=consultation.patient_id,
+                                                    title="🔴 Консультация завершена",
+                                                    message=patient_message,
+                                                    notification_type="consultation_completed",
+                                                    related_id=consultation.id
+                                                )
+                                            db.commit()
+                                        except Exception as notif_error:
+                                            print(f"Ошибка при отправке уведомлений о завершении: {str(notif_error)}")
                                     
-                                    # Если успешно, выходим из цикла
-                                    break
+                                        # Если успешно, выходим из цикла
+                                        break
                                     
-                                except Exception as e:
-                                    # Откатываем транзакцию при ошибке
-                                    db.rollback()
+                                    except Exception as e:
+                                        # Откатываем транзакцию при ошибке
+                                        db.rollback()
                                     
-                                    # Проверяем, является ли это ошибкой конкурентного доступа
-                                    if "Record has changed" in str(e) or "transaction has been rolled back" in str(e):
-                                        retry_count += 1
-                                        print(f"WebSocket: Ошибка блокировки БД при завершении консультации (попытка {retry_count}/{max_retries}): {str(e)}")
+                                        # Проверяем, является ли это ошибкой конкурентного доступа
+                                        if "Record has changed" in str(e) or "transaction has been rolled back" in str(e):
+                                            retry_count += 1
+                                            print(f"WebSocket: Ошибка блокировки БД при завершении консультации (попытка {retry_count}/{max_retries}): {str(e)}")
                                         
-                                        # Небольшая задержка перед повторной попыткой с экспоненциальным увеличением
-                                        if retry_count < max_retries:
-                                            await asyncio.sleep(0.3 * retry_count)
+                                            # Небольшая задержка перед повторной попыткой с экспоненциальным увеличением
+                                            if retry_count < max_retries:
+                                                await asyncio.sleep(0.3 * retry_count)
+                                            else:
+                                                print(f"WebSocket: Достигнуто максимальное количество попыток. Консультация не завершена.")
+                                                connection_manager.enqueue(websocket, {
+                                                    "type": "error",
+                                                    "message": "Не удалось завершить консультацию из-за конфликта данных. Пожалуйста, попробуйте еще раз."
+                                                })
                                         else:
-                                            print(f"WebSocket: Достигнуто максимальное количество попыток. Консультация не завершена.")
-                                            await websocket.send_json({
+                                            # Для других ошибок сразу завершаем
+                                            print(f"WebSocket: Ошибка при завершении консультации: {str(e)}")
+                                            connection_manager.enqueue(websocket, {
                                                 "type": "error",
-                                                "message": "Не удалось завершить консультацию из-за конфликта данных. Пожалуйста, попробуйте еще раз."
+                                                "message": "Внутренняя ошибка сервера при завершении консультации"
                                             })
-                                    else:
-                                        # Для других ошибок сразу завершаем
-                                        print(f"WebSocket: Ошибка при завершении консультации: {str(e)}")
-                                        await websocket.send_json({
-                                            "type": "error",
-                                            "message": "Внутренняя ошибка сервера при завершении консультации"
-                                        })
-                                        break
+                                            break
                 
-                # Если это запрос на отметку всех сообщений как прочитанных
-                elif data.get("type") == "mark_read":
-                    # Обновляем статус всех сообщений как прочитанных
-                    # Получаем все непрочитанные сообщения, отправленные не этим пользователем
-                    unread_messages = (
-                        db.query(Message)
-                        .filter(
-                            Message.consultation_id == consultation_id,
-                            Message.sender_id != user.id,
-                            Message.is_read == False
+                    # Если это запрос на отметку всех сообщений как прочитанных
+                    elif data.get("type") == "mark_read":
+                        # Обновляем статус всех сообщений как прочитанных
+                        # Получаем все непрочитанные сообщения, отправленные не этим пользователем
+                        unread_messages = (
+                            db.query(Message)
+                            .filter(
+                                Message.consultation_id == consultation_id,
+                                Message.sender_id != user.id,
+                                Message.is_read == False
+                            )
+                            .all()
                         )
-                        .all()
-                    )
                     
-                    if unread_messages:
-                        for message in unread_messages:
-                            message.is_read = True
-                        
-                        db.commit()
-                
-                # Если это пинг для проверки соединения
-                elif data.get("type") == "ping":
-                    await websocket.send_json({"type": "pong"})
+                        if unread_messages:
+                            for message in unread_messages:
+                                message.is_read = True
+
+                            record_consultation_change(db, consultation, CHANGE_READ, user.id)
+                            db.commit()
                 
-                # Если это запрос на получение истории сообщений
-                elif data.get("type") == "get_messages_bulk":
-                    try:
-                        print(f"[WebSocket] Получен запрос на историю сообщений для консультации {consultation_id}")
+                    # Если это запрос на получение истории сообщений
+                    elif data.get("type") == "get_messages_bulk":
+                        try:
+                            print(f"[WebSocket] Получен запрос на историю сообщений для консультации {consultation_id}")
                         
-                        # Получаем все сообщения для консультации
-                        messages = (
-                            db.query(Message)
-                            .filter(Message.consultation_id == consultation_id)
-                            .order_by(Message.sent_at.asc())
-                            .all()
-                        )
+                            # Получаем все сообщения для консультации
+                            messages = []
+                            if not consultation.archived_at:
+                                messages = (
+                                    db.query(Message)
+                                    .filter(Message.consultation_id == consultation_id)
+                                    .order_by(Message.sent_at.asc())
+                                    .all()
+                                )
                         
-                        # Форматируем сообщения для JSON
-                        formatted_messages = []
-                        for msg in messages:
-                            formatted_messages.append({
-                                "id": msg.id,
-                                "consultation_id": msg.consultation_id,
-                                "sender_id": msg.sender_id,
-                                "content": msg.content,
-                                "sent_at": msg.sent_at.isoformat(),
-                                "is_read": msg.is_read,
-                                "sender_role": msg.sender_role,
-                                "receiver_id": msg.receiver_id,
-                                "receiver_role": msg.receiver_role
-                            })
+                            # Форматируем сообщения для JSON (архивная переписка уже хранится в этом виде)
+                            formatted_messages = []
+                            if consultation.archived_at:
+                                formatted_messages = load_archived_messages(db, consultation_id, parse_dates=False)
+                            for msg in messages:
+                                formatted_messages.append({
+                                    "id": msg.id,
+                                    "consultation_id": msg.consultation_id,
+                                    "sender_id": msg.sender_id,
+                                    "content": msg.content,
+                                    "sent_at": msg.sent_at.isoformat(),
+                                    "is_read": msg.is_read,
+                                    "sender_role": msg.sender_role,
+                                    "receiver_id": msg.receiver_id,
+                                    "receiver_role": msg.receiver_role
+                                })
                         
-                        # Добавляем подробную информацию о консультации
-                        consultation_data = {
-                            "id": consultation.id,
-                            "status": consultation.status,
-                            "message_count": consultation.message_count,
-                            "message_limit": consultation.message_limit,
-                            "patient_id": consultation.patient_id,
-                            "doctor_id": consultation.doctor_id,
-                            "created_at": consultation.created_at.isoformat() if consultation.created_at else None,
-                            "started_at": consultation.started_at.isoformat() if consultation.started_at else None,
-                            "completed_at": consultation.completed_at.isoformat() if consultation.completed_at else None
-                        }
+                            # Добавляем подробную информацию о консультации
+                            consultation_data = {
+                                "id": consultation.id,
+                                "status": consultation.status,
+                                "message_count": consultation.message_count,
+                                "message_limit": consultation.message_limit,
+                                "patient_id": consultation.patient_id,
+                                "doctor_id": consultation.doctor_id,
+                                "created_at": consultation.created_at.isoformat() if consultation.created_at else None,
+                                "started_at": consultation.started_at.isoformat() if consultation.started_at else None,
+                                "completed_at": consultation.completed_at.isoformat() if consultation.completed_at else None
+                            }
                         
-                        # Получаем информацию о пользователях
-                        patient = db.query(User).filter(User.id == consultation.patient_id).first()
-                        doctor = db.query(User).filter(User.id == consultation.doctor_id).first()
+                            # Получаем информацию о пользователях
+                            patient = db.query(User).filter(User.id == consultation.patient_id).first()
+                            doctor = db.query(User).filter(User.id == consultation.doctor_id).first()
                         
-                        patient_profile = db.query(PatientProfile).filter(PatientProfile.user_id == consultation.patient_id).first()
-                        doctor_profile = db.query(DoctorProfile).filter(DoctorProfile.user_id == consultation.doctor_id).first()
+                            patient_profile = db.query(PatientProfile).filter(PatientProfile.user_id == consultation.patient_id).first()
+                            doctor_profile = db.query(DoctorProfile).filter(DoctorProfile.user_id == consultation.doctor_id).first()
                         
-                        participants = {
-                            "patient": {
-                                "id": patient.id if patient else None,
-                                "name": patient_profile.full_name if patient_profile else "Пациент",
-                                "avatar": patient.avatar_path if patient and patient.avatar_path else None
-                            },
-                            "doctor": {
-                                "id": doctor.id if doctor else None,
-                                "name": doctor_profile.full_name if doctor_profile else "Врач",
-                                "avatar": doctor.avatar_path if doctor and doctor.avatar_path else None
+                            participants = {
+                                "patient": {
+                                    "id": patient.id if patient else None,
+                                    "name": patient_profile.full_name if patient_profile else "Пациент",
+                                    "avatar": patient.avatar_path if patient and patient.avatar_path else None
+                                },
+                                "doctor": {
+                                    "id": doctor.id if doctor else None,
+                                    "name": doctor_profile.full_name if doctor_profile else "Врач",
+                                    "avatar": doctor.avatar_path if doctor and doctor.avatar_path else None
+                                }
                             }
-                        }
                         
-                        # Отправляем ответ с более полными данными
-                        await websocket.send_json({
-                            "type": "messages_bulk",
-                            "messages": formatted_messages,
-                            "consultation": consultation_data,
-                            "participants": participants
-                        })
+                            # Отправляем ответ с более полными данными
+                            connection_manager.enqueue(websocket, {
+                                "type": "messages_bulk",
+                                "messages": formatted_messages,
+                                "consultation": consultation_data,
+                                "participants": participants
+                            })
                         
-                        # Если есть непрочитанные сообщения, отмечаем их как прочитанные
-                        unread_messages = [m for m in messages if m.sender_id != user.id and not m.is_read]
-                        if unread_messages:
-                            for msg in unread_messages:
-                                msg.is_read = True
-                            db.commit()
+                            # Если есть непрочитанные сообщения, отмечаем их как прочитанные
+                            unread_messages = [m for m in messages if m.sender_id != user.id and not m.is_read]
+                            if unread_messages:
+                                for msg in unread_messages:
+                                    msg.is_read = True
+                                record_consultation_change(db, consultation, CHANGE_READ, user.id)
+                                db.commit()
                             
-                            # Отправляем уведомление о прочтении всех сообщений
-                            await broadcast_consultation_update(consultation_id, {
-                                "type": "messages_read",
-                                "reader_id": user.id
-                            })
+                                # Отправляем уведомление о прочтении всех сообщений
+                                await broadcast_consultation_update(consultation_id, {
+                                    "type": "messages_read",
+                                    "reader_id": user.id
+                                })
                         
-                        print(f"[WebSocket] Отправлена история сообщений ({len(formatted_messages)} сообщений) для консультации {consultation_id}")
-                    except Exception as e:
-                        print(f"[WebSocket] Ошибка при получении истории сообщений: {str(e)}")
-                        # Записываем полную трассировку для отладки
-                        import traceback
-                        traceback.print_exc()
+                            print(f"[WebSocket] Отправлена история сообщений ({len(formatted_messages)} сообщений) для консультации {consultation_id}")
+                        except Exception as e:
+                            print(f"[WebSocket] Ошибка при получении истории сообщений: {str(e)}")
+                            # Записываем полную трассировку для отладки
+                            import traceback
+                            traceback.print_exc()
                         
-                        await websocket.send_json({
-                            "type": "error",
-                            "message": "Не удалось загрузить историю сообщений"
-                        })
+                            connection_manager.enqueue(websocket, {
+                                "type": "error",
+                                "message": "Не удалось загрузить историю сообщений"
+                            })
                 
         except WebSocketDisconnect:
             print(f"WebSocket отключен пользователем {user.id} из консультации {consultation_id}")
         except Exception as e:
             print(f"Ошибка в WebSocket: {str(e)}")
         finally:
-            # В любом случае удаляем соединение из списков при завершении
-            if user.id in active_websocket_connections:
-                if websocket in active_websocket_connections.get(user.id, []):
-                    active_websocket_connections[user_id].remove(websocket)
-                    if not active_websocket_connections[user_id]:
-                        del active_websocket_connections[user_id]
+            # В любом случае удаляем соединение из реестра при завершении
+            connection_manager.disconnect(websocket)
             
-            if consultation_id in consultation_websocket_connections:
-                if websocket in consultation_websocket_connections.get(consultation_id, []):
-                    consultation_websocket_connections[consultation_id].remove(websocket)
-                    if not consultation_websocket_connections[consultation_id]:
-                        del consultation_websocket_connections[consultation_id]
+            # Пользователь ушел из чата, если у него не осталось других соединений с консультацией
+            if not connection_manager.consultation_connections(consultation_id, user_id):
+                event_coalescer.presence(consultation_id, user_id, False)
     
     except Exception as e:
         print(f"WebSocket ошибка глобальная: {str(e)}")
@@ -4953,91 +5304,11 @@ async def broadcast_consultation_update(
 ):
     """
     Отправляет обновления всем пользователям, подключенным к определенной консультации.
-    Надежно обрабатывает закрытые соединения.
+    Надежно обрабатывает закрытые соединения: они удаляются из реестра соединений.
     """
-    success_count = 0
-    error_count = 0
-    closed_connections = []
-    
-    if consultation_id not in consultation_websocket_connections:
-        return 0
-    
-    # Создаем копию списка соединений, чтобы избежать изменения во время итерации
-    connections = consultation_websocket_connections[consultation_id].copy()
-    
-    # Нет соединений для этой консультации, просто выходим
-    if not connections:
-        return 0
-    
-    for connection in connections:
-        try:
-            # Проверяем, не закрыто ли соединение с помощью safe_check
-            # Функция getattr обеспечивает безопасное получение атрибута, 
-            # возвращая None, если атрибут отсутствует
-            client_state = getattr(connection, "client_state", None)
-            if client_state is None or not hasattr(WebSocketState, "DISCONNECTED"):
-                # Если нет атрибута client_state или WebSocketState.DISCONNECTED не определен,
-                # мы просто пытаемся отправить сообщение
-                pass
-            elif client_state == WebSocketState.DISCONNECTED:
-                closed_connections.append(connection)
-                error_count += 1
-                continue
-            
-            # Отправляем сообщение
-            await connection.send_json(update_data)
-            success_count += 1
-        except WebSocketDisconnect:
-            # Соединение закрыто клиентом
-            closed_connections.append(connection)
-            error_count += 1
-            print("WebSocket отключен клиентом при отправке сообщения")
-        except RuntimeError as e:
-            # Ошибки типа "Cannot call send after a close message" и подобные
-            closed_connections.append(connection)
-            error_count += 1
-            print(f"Ошибка при отправке WebSocket сообщения: {str(e)}")
-        except Exception as e:
-            error_count += 1
-            print(f"Непредвиденная ошибка при отправке WebSocket сообщения: {str(e)}")
-            
-            # Предполагаем, что соединение с ошибкой должно быть закрыто
-            # Добавляем его в список закрытых соединений
-            closed_connections.append(connection)
-    
-    # Удаляем закрытые соединения
-    if closed_connections:
-        # Создаем список уникальных закрытых соединений (избегаем дублирования)
-        unique_closed = list(set(closed_connections))
-        
-        for closed_conn in unique_closed:
-            # Находим соединения в списках и удаляем их
-            for user_id in list(active_websocket_connections.keys()):
-                user_connections = active_websocket_connections.get(user_id, [])
-                if closed_conn in user_connections:
-                    try:
-                        user_connections.remove(closed_conn)
-                        if not user_connections:
-                            del active_websocket_connections[user_id]
-                    except (ValueError, KeyError):
-                        # Игнорируем ошибки, если соединение уже удалено
-                        pass
-            
-            if consultation_id in consultation_websocket_connections:
-                consultation_connections = consultation_websocket_connections.get(consultation_id, [])
-                if closed_conn in consultation_connections:
-                    try:
-                        consultation_connections.remove(closed_conn)
-                        if not consultation_connections:
-                            del consultation_websocket_connections[consultation_id]
-                    except (ValueError, KeyError):
-                        # Игнорируем ошибки, если соединение уже удалено
-                        pass
-    
-    if error_count > 0:
-        print(f"WebSocket статистика: успешно {success_count}, ошибок {error_count}, удалено соединений {len(closed_connections)}")
-    
-    return success_count
+    # Событие уходит в шину: каждый воркер доставит его своим соединениям консультации.
+    # Закрытые соединения удаляются из реестра внутри connection_manager
+    return await event_bus.publish(consultation_channel(consultation_id), update_data)
 
 # Документирование WebSocket-маршрута в OpenAPI
 @app.get("/docs/websocket", tags=["WebSocket"])
@@ -5045,22 +5316,33 @@ def get_websocket_docs():
     """
     Документация по WebSocket API
     
-    Маршрут: /ws/consultations/{consultation_id}?token={jwt_token}
+    Маршрут: /ws/consultations/{consultation_id}?token={jwt_token}[&last_seq={seq}]
+    
+    События консультации (message, read_receipt, status_update и др.) содержат поле seq.
+    При переподключении клиент передает last_seq - seq последнего полученного события -
+    и получает только пропущенные события, после чего приходит
+    {"type": "replay", "seq": ..., "replayed": N, "gap": false}.
+    Если gap = true, пропущено больше, чем хранит буфер: историю нужно загрузить через HTTP API.
     
     Сообщения от клиента:
     - {"type": "message", "content": "текст сообщения"} - отправка нового сообщения
     - {"type": "read_receipt", "message_id": 123} - отметка о прочтении сообщения
     - {"type": "status_update", "status": "completed"} - изменение статуса консультации (только для врачей)
+    - {"type": "typing", "typing": true} - пользователь набирает текст (false - перестал)
     - {"type": "ping"} - проверка соединения
+    - {"type": "pong"} - ответ на серверный ping
+    
+    Соединение, от которого долго не приходит ни одного сообщения, сервер закрывает (код 1001).
     
     Сообщения от сервера:
     - {"type": "message", "message": {...}} - новое сообщение
-    - {"type": "read_receipt", "message_id": 123, "user_id": 456} - кто-то прочитал сообщение
+    - {"type": "ephemeral_update", "read": [{"reader_id": 456, "up_to_message_id": 123}],
+       "typing": [{"user_id": 456, "typing": true}], "presence": [{"user_id": 456, "online": true}]}
+      - прочтение, набор текста и присутствие, объединенные за ~100 мс (присутствуют только непустые поля)
     - {"type": "status_update", "consultation": {...}} - изменение статуса консультации
-    - {"type": "user_joined", "user_id": 123} - пользователь подключился к чату
-    - {"type": "user_left", "user_id": 123} - пользователь отключился от чата
     - {"type": "error", "message": "текст ошибки"} - сообщение об ошибке
     - {"type": "pong"} - ответ на ping
+    - {"type": "ping", "timestamp": "..."} - серверная проверка соединения, клиент отвечает pong
     """
     return {
         "websocket_url": "/ws/consultations/{consultation_id}?token={jwt_token}",
@@ -5069,16 +5351,18 @@ def get_websocket_docs():
                 "message",
                 "read_receipt",
                 "status_update",
-                "ping"
+                "typing",
+                "ping",
+                "pong"
             ],
             "server_to_client": [
                 "message",
-                "read_receipt", 
+                "ephemeral_update",
                 "status_update",
-                "user_joined",
-                "user_left",
                 "error",
-                "pong"
+                "pong",
+                "ping",
+                "replay"
             ]
         }
     }
@@ -5087,45 +5371,18 @@ def get_websocket_docs():
 @app.get("/api/ws-token", response_model=dict)
 async def get_websocket_token(
     current_user: User = Depends(get_current_user), 
-    db: Session = Depends(get_db),
     request: Request = None
 ):
     """
     Создает и возвращает специальный токен для WebSocket соединения.
-    Токен сохраняется в базе данных и имеет ограниченный срок действия.
+    Токен подписан (HMAC) и содержит ID пользователя, срок действия и область,
+    поэтому проверяется при подключении без обращения к базе данных.
     """
     try:
-        # Удаляем устаревшие токены для этого пользователя
-        expired_tokens = db.query(WebSocketToken).filter(
-            WebSocketToken.user_id == current_user.id,
-            WebSocketToken.expires_at < datetime.utcnow()
-        ).all()
-        
-        if expired_tokens:
-            for token in expired_tokens:
-                db.delete(token)
-            db.commit()
-        
-        # Генерируем новый случайный токен
-        token_value = secrets.token_urlsafe(32)
-        
-        # Устанавливаем срок действия токена (5 минут)
-        expires_at = datetime.utcnow() + timedelta(minutes=5)
-        
-        # Создаем запись в базе данных
-        db_token = WebSocketToken(
-            user_id=current_user.id,
-            token=token_value,
-            expires_at=expires_at
-        )
-        
-        # Сохраняем в базе данных
-        db.add(db_token)
-        db.commit()
-        db.refresh(db_token)
+        token_value = issue_ws_token(current_user.id)
         
         # Возвращаем токен клиенту
-        return {"token": token_value, "expires_in": 300}  # 300 секунд = 5 минут
+        return {"token": token_value, "expires_in": WS_TOKEN_TTL_SECONDS}
     except HTTPException as e:
         # Специальная обработка ошибки "пользователь не найден"
         if e.status_code == 401 and "X-Registration-Required" in e.headers:
@@ -5148,6 +5405,23 @@ async def get_websocket_token(
 
 # Alias удален - используйте /api/ws-token
 
+@app.post("/api/ws-token/revoke", status_code=status.HTTP_204_NO_CONTENT)
+async def revoke_websocket_token(
+    token: str = Body(..., embed=True),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+):
+    """
+    Отзывает WebSocket токен текущего пользователя (например, при выходе из аккаунта).
+    Отзыв проверяется при подключении, только если включен WS_TOKEN_REVOCATION=1.
+    """
+    payload = decode_ws_token(token)
+    if payload is None or payload["uid"] != current_user.id:
+        raise HTTPException(status_code=400, detail="Недействительный токен")
+    
+    revocation_list.revoke(db, payload)
+    db.commit()
+
 # Эндпоинт для получения публичного профиля Пациента по ID пользователя Пациента. Не требует авторизации.
 @app.get("/patients/{user_id}/profile", response_model=PatientProfileResponse)
 def read_patient_profile_by_user_id(user_id: int, db: DbDependency):
@@ -5169,6 +5443,7 @@ def read_patient_profile_by_user_id(user_id: int, db: DbDependency):
 @app.get(
     "/api/consultations/{consultation_id}/messages/bulk",
     response_model=Dict[str, Any],
+    response_class=FastJSONResponse,
     tags=["consultations"],
 )
 async def get_consultation_messages_bulk(
@@ -5191,8 +5466,18 @@ async def get_consultation_messages_bulk(
         if current_user.id != consultation.patient_id and current_user.id != consultation.doctor_id:
             raise HTTPException(status_code=403, detail="У вас нет доступа к этой консультации")
         
-        # Загружаем все сообщения консультации
-        messages = db.query(Message).filter(Message.consultation_id == consultation_id).order_by(Message.sent_at.asc()).all()
+        # Загружаем все сообщения консультации (из архива, если переписка уже перенесена)
+        if consultation.archived_at:
+            messages = load_archived_messages(db, consultation_id, parse_dates=False)
+        else:
+            messages = [
+                serialize_archived_message(message)
+                for message in db.query(Message)
+                .options(selectinload(Message.attachments))
+                .filter(Message.consultation_id == consultation_id)
+                .order_by(Message.sent_at.asc())
+                .all()
+            ]
         
         # Получаем данные профилей участников
         doctor = db.query(User).filter(User.id == consultation.doctor_id).first()
@@ -5218,6 +5503,7 @@ async def get_consultation_messages_bulk(
         if unread_messages:
             for message in unread_messages:
                 message.is_read = True
+            record_consultation_change(db, consultation, CHANGE_READ, current_user.id)
             db.commit()
         
         # Формируем информацию о последней активности
@@ -5225,24 +5511,14 @@ async def get_consultation_messages_bulk(
         if messages:
             last_message = messages[-1]
             last_activity = {
-                "timestamp": last_message.sent_at.isoformat(),
-                "sender_id": last_message.sender_id,
-                "is_current_user": last_message.sender_id == current_user.id
+                "timestamp": last_message["sent_at"],
+                "sender_id": last_message["sender_id"],
+                "is_current_user": last_message["sender_id"] == current_user.id
             }
         
         # Собираем данные для ответа
         response_data = {
-            "messages": [
-                {
-                    "id": message.id,
-                    "consultation_id": message.consultation_id,
-                    "sender_id": message.sender_id,
-                    "content": message.content,
-                    "sent_at": message.sent_at.isoformat(),
-                    "is_read": message.is_read
-                }
-                for message in messages
-            ],
+            "messages": messages,
             "consultation": {
                 "id": consultation.id,
                 "patient_id": consultation.patient_id,
@@ -5278,56 +5554,6 @@ async def get_consultation_messages_bulk(
         print(f"Ошибка при получении информации о консультации: {str(e)}")
         raise HTTPException(status_code=500, detail="Ошибка сервера при получении данных консультации")
 
-# Добавляем функцию для создания WebSocket токена после импортов и основных настроек
-# Добавляем примерно на строке 120, перед существующими определениями функций
-
-async def create_websocket_token(user_id: int, db: Session) -> str:
-    """
-    Создает новый WebSocket токен для пользователя и сохраняет его в базе данных.
-    
-    Args:
-        user_id (int): ID пользователя
-        db (Session): сессия базы данных
-        
-    Returns:
-        str: Значение созданного токена
-    """
-    print(f"[WebSocket Token] Создание токена для пользователя {user_id}")
-    
-    # Удаляем устаревшие токены для этого пользователя
-    expired_tokens = db.query(WebSocketToken).filter(
-        WebSocketToken.user_id == user_id,
-        WebSocketToken.expires_at < datetime.utcnow()
-    ).all()
-    
-    if expired_tokens:
-        print(f"[WebSocket Token] Удаляем {len(expired_tokens)} устаревших токенов для пользователя {user_id}")
-        for token in expired_tokens:
-            db.delete(token)
-        db.commit()
-    
-    # Генерируем новый случайный токен
-    token_value = secrets.token_urlsafe(32)
-    print(f"[WebSocket Token] Сгенерирован новый токен: {token_value[:10]}...")
-    
-    # Устанавливаем срок действия токена (30 минут)
-    expires_at = datetime.utcnow() + timedelta(minutes=30)
-    print(f"[WebSocket Token] Срок действия токена: {expires_at}")
-    
-    # Создаем запись в базе данных
-    db_token = WebSocketToken(
-        user_id=user_id,
-        token=token_value,
-        expires_at=expires_at
-    )
-    
-    # Сохраняем в базе данных
-    db.add(db_token)
-    db.commit()
-    print(f"[WebSocket Token] Токен сохранен в БД для пользователя {user_id}")
-    
-    return token_value
-
 # Дублирующаяся функция send_message удалена - используется версия выше
 
 
@@ -5495,7 +5721,7 @@ async def google_auth_callback(
             
             # Создаем WebSocket токен для нового пользователя
             try:
-                ws_token = await create_websocket_token(db_user.id, db)
+                ws_token = issue_ws_token(db_user.id, ttl=WS_SIGNUP_TOKEN_TTL_SECONDS)
                 print(f"Google Auth: Created WebSocket token for new user {db_user.id}: {ws_token[:10]}...")
             except Exception as e:
                 print(f"Google Auth: Error creating WebSocket token: {str(e)}")
@@ -6060,7 +6286,6 @@ def cleanup_pending_registrations(email: str, db: DbDependency):
 async def websocket_notifications_endpoint(
     websocket: WebSocket, 
     user_id: int,
-    db: Session = Depends(get_db),
     token: str = Query(None)
 ):
     # Проверяем авторизацию через токен
@@ -6081,120 +6306,118 @@ async def websocket_notifications_endpoint(
         return
     
     try:
-        # Проверяем токен в базе данных напрямую (без JWT декодирования)
-        print(f"[WebSocket Notifications] Проверяем токен в БД для пользователя {user_id}")
-        ws_token = db.query(WebSocketToken).filter(
-            WebSocketToken.token == token,
-            WebSocketToken.user_id == user_id,
-            WebSocketToken.expires_at > datetime.utcnow()
-        ).first()
-        
-        if not ws_token:
+        # Подписанный токен проверяется в памяти, без запроса к БД
+        if await verify_ws_token(token, user_id=user_id) is None:
             print(f"[WebSocket Notifications] Отклонено: недействительный токен для пользователя {user_id}")
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Недействительный токен")
             return
         
         print(f"[WebSocket Notifications] Токен валиден для пользователя {user_id}")
         
-        # Проверка существования пользователя
-        user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
-        if user is None:
-            print(f"[WebSocket Notifications] Отклонено: пользователь {user_id} не найден или неактивен")
-            await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Пользователь не найден")
-            return
+        # Проверка пользователя - в короткой сессии, закрытой до начала работы с соединением
+        with SessionLocal() as db:
+            # Проверка существования пользователя
+            user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
+            if user is None:
+                print(f"[WebSocket Notifications] Отклонено: пользователь {user_id} не найден или неактивен")
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Пользователь не найден")
+                return
         
-        print(f"[WebSocket Notifications] Пользователь {user_id} найден: {user.email}")
+            print(f"[WebSocket Notifications] Пользователь {user_id} найден: {user.email}")
         
         # Принимаем соединение
         await websocket.accept()
         print(f"WebSocket соединение принято для пользователя {user_id}")
         
-        # Добавляем соединение в список активных
-        if user_id not in active_websocket_connections:
-            active_websocket_connections[user_id] = []
-        
-        # Добавляем только если соединения с таким же ID еще нет
-        if websocket not in active_websocket_connections[user_id]:
-            active_websocket_connections[user_id].append(websocket)
+        # Регистрируем соединение для уведомлений пользователя
+        connection_manager.connect(websocket, user_id, KIND_NOTIFICATIONS)
         
         print(f"Новое WebSocket соединение для уведомлений пользователя {user_id}")
         
-        # Инициализируем множество для хранения ID отправленных уведомлений
-        if user_id not in sent_notifications:
-            sent_notifications[user_id] = set()
-        
-        # Отправляем текущие непрочитанные уведомления
+        # Отправляем счетчик и последние непрочитанные уведомления, которые еще не были доставлены.
+        # Состояние доставки хранится в notification_outbox - оно общее для воркеров и переживает перезапуск
         try:
-            unread_notifications = db.query(Notification).filter(
-                Notification.user_id == user_id,
-                Notification.is_viewed == False
-            ).order_by(Notification.created_at.desc()).all()
-            
-            # Закрываем текущую сессию и открываем новую для отправки уведомлений
-            db.close()
-            db = SessionLocal()
-            
-            if unread_notifications:
+            with SessionLocal() as db:
+                unread_count = get_unread_count(db, user_id)
                 notifications_list = []
-                for notif in unread_notifications:
-                    # Проверяем, не было ли уже отправлено это уведомление
-                    if notif.id not in sent_notifications[user_id]:
-                        notifications_list.append({
-                            "id": notif.id,
-                            "title": notif.title,
-                            "message": notif.message,
-                            "type": notif.type,
-                            "related_id": notif.related_id,
-                            "created_at": notif.created_at.isoformat(),
-                            "is_viewed": notif.is_viewed
-                        })
-                        # Добавляем в список отправленных
-                        sent_notifications[user_id].add(notif.id)
-                
-                if notifications_list:
-                    await websocket.send_json({
-                        "type": "unread_notifications",
-                        "notifications": notifications_list
-                    })
+                if unread_count:
+                    unread_notifications = (
+                        undelivered_unread_query(db, user_id)
+                        .order_by(Notification.id.desc())
+                        .limit(UNREAD_ON_CONNECT_LIMIT)
+                        .all()
+                    )
+                    notifications_list = [
+                        notif
+                        for notif in map(serialize_notification, unread_notifications)
+                        if not notification_dispatcher.delivered_cache.seen(delivery_key(notif))
+                    ]
+                    mark_delivered(db, notifications_list)
+                    db.commit()
+            
+            if notifications_list:
+                connection_manager.enqueue(websocket, {
+                    "type": "unread_notifications",
+                    "notifications": notifications_list,
+                    "unread_count": unread_count
+                })
+            else:
+                connection_manager.enqueue(websocket, {
+                    "type": "unread_count",
+                    "unread_count": unread_count
+                })
         except Exception as e:
             print(f"Ошибка при отправке непрочитанных уведомлений: {str(e)}")
         
+        # Отложенные повторы доставки этому пользователю выполняются сразу после подключения
+        try:
+            await notification_dispatcher.user_connected(user_id)
+        except Exception as e:
+            print(f"Ошибка при запуске отложенной доставки уведомлений: {str(e)}")
+        
         # Ждем сообщения или закрытия соединения
         try:
             while True:
                 # Проверяем наличие сообщений от клиента и обрабатываем их при необходимости
                 data = await websocket.receive_json()
+                connection_manager.touch(websocket)
                 
                 # Если клиент отправил команду mark_read, отмечаем уведомление как прочитанное
                 if data.get("action") == "mark_read" and "notification_id" in data:
-                    notif_id = data["notification_id"]
-                    notification = db.query(Notification).filter(
-                        Notification.id == notif_id,
-                        Notification.user_id == user_id
-                    ).first()
+                    # Короткая сессия только на время обработки команды
+                    with SessionLocal() as db:
+                        notif_id = data["notification_id"]
+                        if mark_notification_read(db, user_id, notif_id):
+                            db.commit()
+                            # Новый счетчик - во все соединения пользователя (другие вкладки, устройства)
+                            await publish_unread_count(user_id, get_unread_count(db, user_id))
+                            found = True
+                        else:
+                            # Уже прочитано (в том числе параллельным запросом) или не существует
+                            found = db.query(Notification.id).filter(
+                                Notification.id == notif_id,
+                                Notification.user_id == user_id
+                            ).first() is not None
                     
-                    if notification:
-                        notification.is_viewed = True
-                        db.commit()
-                        
-                        # Отправляем подтверждение клиенту
-                        await websocket.send_json({
-                            "type": "mark_read_confirmation",
-                            "notification_id": notif_id,
-                            "success": True
-                        })
-                    else:
-                        # Отправляем ошибку
-                        await websocket.send_json({
-                            "type": "mark_read_confirmation",
-                            "notification_id": notif_id,
-                            "success": False,
-                            "error": "Уведомление не найдено"
-                        })
+                        if found:
+                            # Отправляем подтверждение клиенту
+                            connection_manager.enqueue(websocket, {
+                                "type": "mark_read_confirmation",
+                                "notification_id": notif_id,
+                                "success": True
+                            })
+                        else:
+                            # Отправляем ошибку
+                            connection_manager.enqueue(websocket, {
+                                "type": "mark_read_confirmation",
+                                "notification_id": notif_id,
+                                "success": False,
+                                "error": "Уведомление не найдено"
+                            })
                 
                 # Если клиент отправил ping, отвечаем pong
                 elif data.get("action") == "ping":
-                    await websocket.send_json({
+                    connection_manager.enqueue(websocket, {
                         "type": "pong",
                         "timestamp": datetime.utcnow().isoformat()
                     })
@@ -6207,23 +6430,14 @@ async def websocket_notifications_endpoint(
         except Exception as e:
             print(f"WebSocket ошибка при работе с уведомлениями: {str(e)}")
         finally:
-            # Удаляем соединение из списка активных
-            if user_id in active_websocket_connections and websocket in active_websocket_connections[user_id]:
-                active_websocket_connections[user_id].remove(websocket)
-                if not active_websocket_connections[user_id]:
-                    del active_websocket_connections[user_id]
-            
-            # Закрываем сессию БД, чтобы освободить ресурсы
-            db.close()
+            # Удаляем соединение из реестра
+            connection_manager.disconnect(websocket)
     except Exception as e:
         print(f"WebSocket ошибка при работе с уведомлениями: {str(e)}")
         try:
             await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason="Internal error")
         except:
             pass
-        finally:
-            # Обязательно закрываем сессию БД
-            db.close()
 
 # Эндпоинт для загрузки аватара пользователя
 @app.post("/users/me/avatar", status_code=status.HTTP_200_OK)
@@ -6328,213 +6542,141 @@ class NotificationResponse(BaseModel):
     is_viewed: bool
     related_id: Optional[int] = None
     created_at: datetime
+    collapse_count: int = 1
+    updated_at: Optional[datetime] = None
     
     class Config:
         from_attributes = True
 
 class NotificationList(BaseModel):
     items: List[NotificationResponse]
+    unread_count: int = 0
+    # Последний id в ленте пользователя: его можно передать как since_id при опросе
+    last_id: int = 0
+    has_more: bool = False
+    next_before_id: Optional[int] = None
+    next_after_id: Optional[int] = None
+    # Опрос since_id: уведомления с id <= since_id, свернутые после updated_since
+    updated: List[NotificationResponse] = []
+    # Время сервера: передается как updated_since в следующем опросе
+    server_time: Optional[datetime] = None
 
 
-# Функция для создания уведомлений
-async def create_notification(
-    db: Session,
-    user_id: int, 
-    title: str, 
-    message: str,
-    notification_type: str = "system",
-    related_id: Optional[int] = None
-) -> Notification:
-    """
-    Создаёт новое уведомление для пользователя и возвращает его.
-    
-    Args:
-        db: сессия БД
-        user_id: ID пользователя, которому предназначено уведомление
-        title: заголовок уведомления
-        message: текст уведомления
-        notification_type: тип уведомления (system, consultation, new_message и т.д.)
-        related_id: ID связанного объекта (например, ID консультации)
-    
-    Returns:
-        Созданный объект уведомления
-    """
-    print(f"🔔 НАЧАЛО: Создание уведомления типа {notification_type} для пользователя {user_id}")
-    
-    # Создаем объект уведомления
-    notification = Notification(
-        user_id=user_id,
-        title=title,
-        message=message,
-        type=notification_type,
-        related_id=related_id,
-        is_viewed=False
-    )
-    
-    # Добавляем в БД и сохраняем
-    try:
-        db.add(notification)
-        db.commit()
-        db.refresh(notification)
-        print(f"✅ БД: Уведомление ID {notification.id} сохранено в базе данных")
-    except Exception as db_error:
-        print(f"❌ БД: Ошибка при сохранении уведомления в базе данных: {str(db_error)}")
-        db.rollback()
-        # В случае ошибки создаем уведомление без сохранения в БД, чтобы хотя бы отправить по WebSocket
-        notification = Notification(
-            id=-1,  # Временный ID для отправки
-            user_id=user_id,
-            title=title,
-            message=message,
-            type=notification_type,
-            related_id=related_id,
-            is_viewed=False,
-            created_at=datetime.utcnow()
-        )
-        print(f"⚠️ БД: Создано временное уведомление без сохранения в БД")
-    
-    # Добавляем в список отправленных уведомлений
-    if user_id not in sent_notifications:
-        sent_notifications[user_id] = set()
-    sent_notifications[user_id].add(notification.id)
-    
-    # Отправляем уведомление через WebSocket, если пользователь подключен
-    websocket_success = False
-    
-    try:
-        print(f"🔍 WS: Проверка WebSocket соединений для пользователя {user_id}")
-        
-        if user_id in active_websocket_connections and active_websocket_connections[user_id]:
-            connections_count = len(active_websocket_connections[user_id])
-            print(f"📡 WS: Найдено {connections_count} активных соединений для пользователя {user_id}")
-            
-            notification_data = {
-                "id": notification.id,
-                "title": notification.title,
-                "message": notification.message,
-                "type": notification.type,
-                "related_id": notification.related_id,
-                "created_at": notification.created_at.isoformat(),
-                "is_viewed": notification.is_viewed
-            }
-            
-            # Список успешных соединений для отчета
-            success_connections = 0
-            
-            # Отправляем на все соединения пользователя
-            for i, connection in enumerate(active_websocket_connections[user_id]):
-                try:
-                    print(f"📤 WS: Отправка уведомления через WebSocket для соединения {i+1}/{connections_count} пользователя {user_id}")
-                    
-                    # Проверяем статус соединения перед отправкой
-                    client_state = getattr(connection, "client_state", None)
-                    if client_state == WebSocketState.DISCONNECTED:
-                        print(f"❌ WS: Соединение {i+1} закрыто (DISCONNECTED)")
-                        continue
-                    
-                    # Отправляем уведомление
-                    await connection.send_json({
-                        "type": "new_notification",
-                        "notification": notification_data
-                    })
-                    
-                    success_connections += 1
-                    websocket_success = True
-                    print(f"✅ WS: Уведомление успешно отправлено через WebSocket соединение {i+1}")
-                except WebSocketDisconnect:
-                    print(f"❌ WS: Соединение {i+1} закрыто клиентом (WebSocketDisconnect)")
-                except RuntimeError as re:
-                    print(f"❌ WS: Ошибка RuntimeError при отправке через соединение {i+1}: {str(re)}")
-                except Exception as e:
-                    print(f"❌ WS: Непредвиденная ошибка при отправке через соединение {i+1}: {str(e)}")
-            
-            # Итоговый отчет по отправке
-            if success_connections > 0:
-                print(f"✅ WS: Уведомление успешно отправлено через {success_connections}/{connections_count} WebSocket соединений")
-            else:
-                print(f"❌ WS: Не удалось отправить уведомление ни через одно из {connections_count} соединений")
-        else:
-            print(f"ℹ️ WS: У пользователя {user_id} нет активных WebSocket соединений для отправки уведомления")
-            
-        # Повторная попытка для доставки особо важных уведомлений
-        if not websocket_success and notification_type in ['consultation_started', 'consultation_completed', 'new_consultation']:
-            print(f"🔄 WS: Запланирована повторная попытка отправки важного уведомления типа {notification_type}")
-            
-            # Используем background task для повторной попытки (в реальном коде нужно использовать background_tasks)
-            asyncio.create_task(retry_notification_delivery(user_id, notification_data))
-    except Exception as e:
-        print(f"❌ WS: Общая ошибка при отправке WebSocket уведомления для пользователя {user_id}: {str(e)}")
-    
-    print(f"🔔 ЗАВЕРШЕНО: Создание и отправка уведомления для пользователя {user_id} (WebSocket: {'✅' if websocket_success else '❌'})")
-    return notification
+# Размер страницы списка уведомлений по умолчанию и максимальный
+NOTIFICATIONS_PAGE_SIZE = 30
+NOTIFICATIONS_MAX_PAGE_SIZE = 100
 
-# Функция для повторной попытки отправки уведомления
-async def retry_notification_delivery(user_id: int, notification_data: dict, max_retries: int = 3):
-    """
-    Повторяет попытку отправки уведомления через WebSocket с экспоненциальной задержкой
-    
-    Args:
-        user_id: ID пользователя
-        notification_data: Данные уведомления
-        max_retries: Максимальное количество повторных попыток
-    """
-    for retry in range(1, max_retries + 1):
-        # Экспоненциальная задержка: 2с, 4с, 8с и т.д.
-        await asyncio.sleep(2 ** retry)
-        
-        print(f"🔄 RETRY: Повторная попытка #{retry} отправки уведомления пользователю {user_id}")
-        
-        # Проверяем наличие активных соединений
-        if user_id not in active_websocket_connections or not active_websocket_connections[user_id]:
-            print(f"ℹ️ RETRY: У пользователя {user_id} по-прежнему нет активных соединений")
-            continue
-        
-        # Список соединений
-        connections = active_websocket_connections[user_id]
-        success = False
-        
-        for i, connection in enumerate(connections):
-            try:
-                # Проверяем статус соединения
-                client_state = getattr(connection, "client_state", None)
-                if client_state == WebSocketState.DISCONNECTED:
-                    continue
-                
-                # Отправляем уведомление
-                await connection.send_json({
-                    "type": "new_notification",
-                    "notification": notification_data
-                })
-                
-                print(f"✅ RETRY: Повторная отправка уведомления успешна через соединение {i+1}")
-                success = True
-                break  # Достаточно одной успешной отправки
-            except Exception as e:
-                print(f"❌ RETRY: Ошибка при повторной отправке через соединение {i+1}: {str(e)}")
-        
-        if success:
-            print(f"✅ RETRY: Уведомление успешно доставлено при повторной попытке #{retry}")
-            break
+# Перекрытие окна updated_since в секундах: updated_at выставляется до коммита,
+# поэтому свертывание может стать видимым позже своего updated_at.
+# Повторно полученные уведомления клиент заменяет по id
+NOTIFICATIONS_UPDATED_OVERLAP_SECONDS = 10
 
 
 # Эндпоинт для получения уведомлений пользователя
-@app.get("/api/notifications", response_model=NotificationList)
+@app.get("/api/notifications", response_model=NotificationList, response_class=FastJSONResponse)
 async def get_api_notifications(
-    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+    before_id: Optional[int] = Query(None, ge=1, description="Вернуть уведомления старше этого id"),
+    after_id: Optional[int] = Query(None, ge=0, description="Вернуть уведомления новее этого id"),
+    since_id: Optional[int] = Query(None, ge=0, description="Режим опроса: только уведомления новее этого id"),
+    updated_since: Optional[datetime] = Query(None, description="Вместе с since_id: server_time предыдущего опроса"),
+    limit: int = Query(NOTIFICATIONS_PAGE_SIZE, ge=1, le=NOTIFICATIONS_MAX_PAGE_SIZE),
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
 ):
     """
-    Получает список уведомлений для текущего пользователя.
-    Возвращает последние 30 уведомлений, отсортированные по дате создания (новые сверху).
-    """
-    notifications = (
-        db.query(Notification)
-        .filter(Notification.user_id == current_user.id)
-        .order_by(Notification.created_at.desc())
-        .limit(30)
-        .all()
-    )
-    
-    return {"items": notifications}
+    Получает список уведомлений для текущего пользователя (новые сверху).
+    Постраничная навигация по курсорам на индексе (user_id, id):
+    - без курсора: последние `limit` уведомлений;
+    - before_id: более старые уведомления (следующая страница - next_before_id);
+    - after_id / since_id: уведомления новее указанного id (продолжение - next_after_id).
+
+    Свертывание меняет уже выданное уведомление, но не его id. Поэтому при опросе
+    since_id клиент передает updated_since (server_time прошлого ответа) и получает
+    в `updated` уведомления с id <= since_id, свернутые после этого момента.
+    Без updated_since такие изменения видны только по смене ETag - тогда ленту нужно перезагрузить.
+
+    Ответ содержит ETag: если лента не изменилась, на запрос с If-None-Match возвращается 304.
+    """
+    cursors = [value for value in (before_id, after_id, since_id) if value is not None]
+    if len(cursors) > 1:
+        raise HTTPException(status_code=400, detail="Укажите только один из параметров before_id, after_id, since_id")
+    if updated_since is not None and since_id is None:
+        raise HTTPException(status_code=400, detail="Параметр updated_since используется только вместе с since_id")
+
+    # Версия ленты считается без чтения уведомлений: ETag проверяется до основного запроса
+    last_id, unread_count, inbox_version = get_inbox_version(db, current_user.id)
+    version = f"{current_user.id}:{last_id}:{unread_count}:{inbox_version}:{before_id}:{after_id}:{since_id}:{updated_since}:{limit}"
+    etag = 'W/"' + hashlib.md5(version.encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    result = {
+        "items": [],
+        "unread_count": unread_count,
+        "last_id": last_id,
+        "has_more": False,
+        "next_before_id": None,
+        "next_after_id": None,
+        "updated": [],
+        "server_time": datetime.utcnow().isoformat(),
+    }
+
+    if updated_since is not None:
+        # Свернутые после прошлого опроса уведомления, уже известные клиенту (индекс (user_id, updated_at))
+        if updated_since.tzinfo is not None:
+            updated_since = updated_since.astimezone(timezone.utc).replace(tzinfo=None)
+        updated = (
+            db.query(Notification)
+            .filter(
+                Notification.user_id == current_user.id,
+                Notification.updated_at > updated_since - timedelta(seconds=NOTIFICATIONS_UPDATED_OVERLAP_SECONDS),
+                Notification.id <= since_id,
+            )
+            .order_by(Notification.updated_at.desc())
+            .limit(NOTIFICATIONS_MAX_PAGE_SIZE)
+            .all()
+        )
+        result["updated"] = [
+            {**serialize_notification(notification), "user_id": notification.user_id}
+            for notification in updated
+        ]
+
+    newer_than = after_id if after_id is not None else since_id
+    if newer_than is not None and newer_than >= last_id:
+        # Опрос без новых уведомлений: список новых не читаем
+        return FastJSONResponse(result, headers=headers)
+
+    query = db.query(Notification).filter(Notification.user_id == current_user.id)
+    if newer_than is not None:
+        # Ближайшие к курсору более новые уведомления, затем разворачиваем (новые сверху)
+        notifications = (
+            query.filter(Notification.id > newer_than)
+            .order_by(Notification.id.asc())
+            .limit(limit + 1)
+            .all()
+        )
+        result["has_more"] = len(notifications) > limit
+        notifications = notifications[:limit]
+        if result["has_more"]:
+            result["next_after_id"] = notifications[-1].id
+        notifications.reverse()
+    else:
+        if before_id is not None:
+            query = query.filter(Notification.id < before_id)
+        notifications = query.order_by(Notification.id.desc()).limit(limit + 1).all()
+        result["has_more"] = len(notifications) > limit
+        notifications = notifications[:limit]
+        if result["has_more"]:
+            result["next_before_id"] = notifications[-1].id
+
+    result["items"] = [
+        {**serialize_notification(notification), "user_id": notification.user_id}
+        for notification in notifications
+    ]
+    return FastJSONResponse(result, headers=headers)
 
 # Отметка уведомления как прочитанное
 @app.post(
@@ -6548,7 +6690,13 @@ async def mark_api_notification_as_read(
     """
     Отмечает уведомление как прочитанное.
     """
-    notification = db.query(Notification).filter(
+    # Отмечаем как прочитанное условным UPDATE (повторная отметка не меняет счетчик)
+    if mark_notification_read(db, current_user.id, notification_id):
+        db.commit()
+        await publish_unread_count(current_user.id, get_unread_count(db, current_user.id))
+        return None
+
+    notification = db.query(Notification.id).filter(
         Notification.id == notification_id,
         Notification.user_id == current_user.id
     ).first()
@@ -6559,62 +6707,53 @@ async def mark_api_notification_as_read(
             detail="Уведомление не найдено или у вас нет к нему доступа"
         )
     
-    # Отмечаем как прочитанное
-    notification.is_viewed = True
-    
-    # Добавляем в список отправленных через WebSocket
-    if current_user.id not in sent_notifications:
-        sent_notifications[current_user.id] = set()
-    sent_notifications[current_user.id].add(notification_id)
-    
-    db.commit()
-    
     # Возвращаем 204 No Content
     return None
 
+async def _mark_notifications_read(db: Session, user_id: int, up_to_id: Optional[int] = None) -> dict:
+    """Отмечает уведомления прочитанными одним UPDATE и оповещает другие устройства пользователя"""
+    marked, up_to_id = mark_read_up_to(db, user_id, up_to_id)
+    db.commit()
+    unread_count = get_unread_count(db, user_id)
+    if marked:
+        await publish_notifications_read(user_id, up_to_id, unread_count)
+    return {"marked": marked, "up_to_id": up_to_id, "unread_count": unread_count}
+
 # Отметка всех уведомлений как прочитанных
-@app.post("/api/notifications/mark-all-read", status_code=status.HTTP_204_NO_CONTENT)
+@app.post("/api/notifications/mark-all-read", response_model=dict, response_class=FastJSONResponse)
 async def mark_all_api_notifications_read(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
     """
     Отмечает все уведомления пользователя как прочитанные.
+    Возвращает число отмеченных уведомлений, границу up_to_id и новый счетчик непрочитанных.
     """
-    # Получаем все непрочитанные уведомления
-    notifications = db.query(Notification).filter(
-        Notification.user_id == current_user.id,
-        Notification.is_viewed == False
-    ).all()
-    
-    # Отмечаем все как прочитанные
-    for notification in notifications:
-        notification.is_viewed = True
-        
-        # Добавляем в список отпраcat вленных через WebSocket
-        if current_user.id not in sent_notifications:
-            sent_notifications[current_user.id] = set()
-        sent_notifications[current_user.id].add(notification.id)
-    
-    db.commit()
-    
-    # Возвращаем 204 No Content
-    return None
+    return await _mark_notifications_read(db, current_user.id)
+
+# Отметка прочитанными уведомлений до указанного id включительно
+@app.post("/api/notifications/mark-read", response_model=dict, response_class=FastJSONResponse)
+async def mark_api_notifications_read_up_to(
+    up_to_id: int = Query(..., ge=1, description="Отметить уведомления с id не больше этого"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Отмечает прочитанными уведомления пользователя с id <= up_to_id
+    (например, все уведомления, которые клиент уже показал).
+    """
+    return await _mark_notifications_read(db, current_user.id, up_to_id)
 
-@app.get("/notifications/unread-count", response_model=dict)
+@app.get("/notifications/unread-count", response_model=dict, response_class=FastJSONResponse)
 async def get_notifications_unread_count(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
     """
-    Возвращает количество непрочитанных уведомлений для текущего пользователя.
+    Возвращает количество непрочитанных уведомлений для текущего пользователя
+    (из инкрементального счетчика, без COUNT по таблице уведомлений).
     """
-    unread_count = db.query(Notification).filter(
-        Notification.user_id == current_user.id,
-        Notification.is_viewed == False
-    ).count()
-    
-    return {"unread_count": unread_count}
+    return {"unread_count": get_unread_count(db, current_user.id)}
 
 # Модель для администратора для создания уведомлений
 class AdminNotificationCreate(BaseModel):
@@ -6633,6 +6772,8 @@ async def send_admin_notification(
 ):
     """
     Отправляет административное уведомление пользователям.
+    Рассылка всем или по роли выполняется в фоне пачками; прогресс -
+    GET /admin/notifications/broadcasts/{broadcast_id}.
     
     Args:
         notification_data: Данные уведомления
@@ -6640,50 +6781,82 @@ async def send_admin_notification(
         current_user: Администратор, отправляющий уведомление
     
     Returns:
-        Список созданных уведомлений
+        Количество получателей и (для рассылки) ID задачи рассылки
     """
-    created_notifications = []
-    
-    # Определяем целевых пользователей на основе параметров
-    target_users = []
-    
-    if notification_data.target_type == "all":
-        # Отправка всем пользователям
-        target_users = db.query(User).filter(User.is_active == True).all()
-    elif notification_data.target_type == "role" and notification_data.role:
-        # Отправка пользователям с определенной ролью
-        target_users = db.query(User).filter(
-            User.is_active == True,
-            User.role == notification_data.role
-        ).all()
-    elif notification_data.target_type == "user" and notification_data.user_id:
-        # Отправка конкретному пользователю
+    if notification_data.target_type == "user" and notification_data.user_id:
+        # Отправка конкретному пользователю - сразу, через очередь доставки
         user = db.query(User).filter(
             User.is_active == True,
             User.id == notification_data.user_id
         ).first()
-        if user:
-            target_users = [user]
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Не найдены пользователи для отправки уведомления"
+            )
+        
+        enqueue_notification(
+            db=db,
+            user_id=user.id,
+            title=notification_data.title,
+            message=notification_data.message,
+            notification_type=notification_data.type
+        )
+        db.commit()
+        return {"count": 1}
     
-    if not target_users:
+    if notification_data.target_type not in ("all", "role") or (
+        notification_data.target_type == "role" and not notification_data.role
+    ):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Не найдены пользователи для отправки уведомления"
         )
     
-    # Отправляем уведомления каждому целевому пользователю
-    for user in target_users:
-        notification = await create_notification(
-            db=db,
-            user_id=user.id,
-            title=notification_data.title,
-            message=notification_data.message,
-            notification_type=notification_data.type
+    # Массовая рассылка: сохраняем задачу и запускаем ее в фоне
+    broadcast = create_broadcast(
+        db,
+        created_by=current_user.id,
+        title=notification_data.title,
+        message=notification_data.message,
+        notification_type=notification_data.type,
+        target_type=notification_data.target_type,
+        role=notification_data.role if notification_data.target_type == "role" else None,
+    )
+    if not broadcast.total_users:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Не найдены пользователи для отправки уведомления"
         )
-        created_notifications.append(notification)
+    db.commit()
+    
+    notification_dispatcher.start_broadcast(broadcast.id)
     
-    # Возвращаем количество созданных уведомлений
-    return {"count": len(created_notifications)}
+    return {
+        "count": broadcast.total_users,
+        "broadcast_id": broadcast.id,
+        "status": broadcast.status,
+    }
+
+
+@app.get("/admin/notifications/broadcasts/{broadcast_id}")
+async def get_notification_broadcast(
+    broadcast_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_role("admin")),
+):
+    """
+    Прогресс массовой рассылки уведомлений.
+    """
+    broadcast = db.get(NotificationBroadcast, broadcast_id)
+    if not broadcast:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Рассылка не найдена"
+        )
+    
+    return serialize_broadcast(broadcast)
 # Все alias endpoints удалены - используйте /api/ версии
 
 
@@ -6738,4 +6911,55 @@ async def cleanup_temp_attachments(
         raise HTTPException(
             status_code=500,
             detail="Ошибка при очистке временных вложений"
-        ) 
\ No newline at end of file
+        )
+
+
+# Административный endpoint для ручного запуска архивации переписки
+@app.post("/admin/archive-transcripts", status_code=status.HTTP_200_OK)
+async def archive_transcripts(
+    older_than_days: int = Query(ARCHIVE_AFTER_DAYS, ge=0),
+    current_user: User = Depends(require_role("admin"))
+):
+    """
+    Переносит переписку консультаций, завершенных более older_than_days дней назад,
+    в сжатый архив. Возвращает статистику прохода.
+    Архивация выполняется в отдельном потоке, чтобы не блокировать цикл событий.
+    """
+    stats = await asyncio.to_thread(run_archive_batch, older_than_days)
+    return {
+        "message": "Архивация переписки выполнена",
+        **stats
+    }
+
+
+# Административный endpoint для ручного запуска очистки уведомлений
+@app.post("/admin/notifications/retention", status_code=status.HTTP_200_OK)
+async def run_notification_retention(
+    current_user: User = Depends(require_role("admin"))
+):
+    """
+    Удаляет прочитанные уведомления старше срока хранения их типа и
+    завершенные строки очереди доставки. Возвращает статистику прохода.
+    """
+    stats = await asyncio.to_thread(run_retention_pass)
+    return {
+        "message": "Очистка уведомлений выполнена",
+        **stats
+    }
+
+
+# Административный endpoint с метриками WebSocket соединений
+@app.get("/admin/websocket-metrics")
+async def get_websocket_metrics(
+    current_user: User = Depends(require_role("admin"))
+):
+    """
+    Возвращает метрики WebSocket соединений: количество соединений, глубину
+    очередей отправки, потерянные сообщения и отключенных медленных клиентов.
+    """
+    return {
+        **connection_manager.metrics(),
+        "replay": event_bus.replay.stats(),
+        "coalescer": event_coalescer.metrics(),
+        "notifications": notification_dispatcher.metrics(),
+    }
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Миграция для поиска по сообщениям: создает таблицу message_search_terms
+и строит инвертированный индекс для уже существующих сообщений (включая архивные).
+Скрипт можно запускать повторно - уже проиндексированные сообщения пропускаются.
+"""
+
+import os
+import sys
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Добавляем путь к проекту
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from models import engine, SessionLocal, MessageSearchTerm
+from search_service import backfill_search_index
+
+def run_migration():
+    """Создает таблицу индекса и заполняет ее"""
+
+    try:
+        print("➕ Создаем таблицу 'message_search_terms' (если ее еще нет)...")
+        MessageSearchTerm.__table__.create(bind=engine, checkfirst=True)
+
+        print("🔎 Индексируем существующие сообщения...")
+        with SessionLocal() as db:
+            indexed = backfill_search_index(db)
+
+        print(f"✅ Проиндексировано сообщений: {indexed}")
+        return True
+
+    except Exception as e:
+        print(f"❌ Ошибка при выполнении миграции: {e}")
+        return False
+
+if __name__ == "__main__":
+    print("🔄 Запуск миграции для поиска по сообщениям...")
+    success = run_migration()
+
+    if success:
+        print("🎉 Миграция завершена успешно!")
+        sys.exit(0)
+    else:
+        print("💥 Миграция не выполнена!")
+        sys.exit(1)
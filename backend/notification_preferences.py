@@ -0,0 +1,169 @@
+# backend/notification_preferences.py
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, FrozenSet, Iterable, List, Optional
+from sqlalchemy import exists, literal
+from sqlalchemy.orm import Session
+from models import User, UserNotificationSettings
+
+# Типы уведомлений, которые пользователь может отключить.
+# Системные уведомления (в том числе рассылки администратора) отключить нельзя
+MUTABLE_NOTIFICATION_TYPES = (
+    "new_message",
+    "new_consultation",
+    "consultation_started",
+    "consultation_completed",
+)
+
+# Сколько секунд настройки пользователя живут в кэше процесса.
+# В своем воркере кэш сбрасывается сразу при изменении настроек, TTL ограничивает
+# время, в течение которого другие воркеры используют старые настройки
+PREFERENCES_CACHE_TTL_SECONDS = int(os.getenv("NOTIFICATION_PREFERENCES_TTL", "300"))
+PREFERENCES_CACHE_SIZE = int(os.getenv("NOTIFICATION_PREFERENCES_CACHE_SIZE", "10000"))
+
+
+def parse_muted_types(value: Optional[str]) -> List[str]:
+    """Разбирает поле muted_types ("new_message,consultation_started") в список типов"""
+    if not value:
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def format_muted_types(types: Iterable[str]) -> Optional[str]:
+    """Сохраняет список отключенных типов в поле muted_types (только известные типы, без повторов)"""
+    muted = [t for t in MUTABLE_NOTIFICATION_TYPES if t in set(types)]
+    return ",".join(muted) or None
+
+
+@dataclass(frozen=True)
+class NotificationPreferences:
+    """Настройки доставки уведомлений пользователя, уже разобранные для диспетчера"""
+    realtime: bool = True                       # показывать уведомления сразу (WebSocket, push в браузере)
+    muted_types: FrozenSet[str] = frozenset()   # типы, которые не создаются вовсе
+    quiet_hours_start: Optional[int] = None     # тихие часы (UTC): с какого часа
+    quiet_hours_end: Optional[int] = None       # до какого часа (не включительно)
+
+    def is_muted(self, notification_type: Optional[str]) -> bool:
+        return notification_type in self.muted_types
+
+    def in_quiet_hours(self, now: datetime) -> bool:
+        start, end = self.quiet_hours_start, self.quiet_hours_end
+        if start is None or end is None or start == end:
+            return False
+        if start < end:
+            return start <= now.hour < end
+        # Интервал через полночь, например 22 -> 7
+        return now.hour >= start or now.hour < end
+
+    def quiet_hours_end_after(self, now: datetime) -> datetime:
+        """Ближайший момент окончания тихих часов после now"""
+        end = now.replace(hour=self.quiet_hours_end, minute=0, second=0, microsecond=0)
+        return end if end > now else end + timedelta(days=1)
+
+
+DEFAULT_PREFERENCES = NotificationPreferences()
+
+
+def resolve_preferences(settings: Optional[UserNotificationSettings]) -> NotificationPreferences:
+    if settings is None:
+        return DEFAULT_PREFERENCES
+    return NotificationPreferences(
+        realtime=settings.push_notifications is not False,
+        muted_types=frozenset(parse_muted_types(settings.muted_types)),
+        quiet_hours_start=settings.quiet_hours_start,
+        quiet_hours_end=settings.quiet_hours_end,
+    )
+
+
+class NotificationPreferencesCache:
+    """
+    Ограниченный LRU-кэш настроек уведомлений пользователей с TTL.
+    Настройки проверяются для каждого уведомления до записи в БД и отправки в сокет,
+    поэтому обычно обходятся без запроса к user_notification_settings.
+    Сбрасывается для пользователя при изменении настроек (invalidate).
+    Используется и из потоков (синхронные эндпоинты, asyncio.to_thread), поэтому под блокировкой.
+    """
+
+    def __init__(self, ttl: float = PREFERENCES_CACHE_TTL_SECONDS, max_size: int = PREFERENCES_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # id пользователя -> (настройки, момент истечения по time.monotonic)
+        self._items: "OrderedDict[int, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, user_id: int) -> Optional[NotificationPreferences]:
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None or item[1] <= time.monotonic():
+                return None
+            self._items.move_to_end(user_id)
+            return item[0]
+
+    def _store(self, user_id: int, preferences: NotificationPreferences) -> None:
+        with self._lock:
+            self._items[user_id] = (preferences, time.monotonic() + self.ttl)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def get(self, db: Session, user_id: int) -> NotificationPreferences:
+        preferences = self._cached(user_id)
+        if preferences is not None:
+            self.hits += 1
+            return preferences
+        self.misses += 1
+        settings = db.query(UserNotificationSettings).filter(UserNotificationSettings.user_id == user_id).first()
+        preferences = resolve_preferences(settings)
+        self._store(user_id, preferences)
+        return preferences
+
+    def get_many(self, db: Session, user_ids: List[int]) -> Dict[int, NotificationPreferences]:
+        """Настройки группы пользователей: отсутствующие в кэше загружаются одним запросом"""
+        result = {}
+        missing = []
+        for user_id in user_ids:
+            preferences = self._cached(user_id)
+            if preferences is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = preferences
+        self.hits += len(result)
+        self.misses += len(missing)
+
+        if missing:
+            loaded = {
+                settings.user_id: settings
+                for settings in db.query(UserNotificationSettings).filter(UserNotificationSettings.user_id.in_(missing))
+            }
+            for user_id in missing:
+                preferences = resolve_preferences(loaded.get(user_id))
+                self._store(user_id, preferences)
+                result[user_id] = preferences
+        return result
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._items.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+def muted_by_user_condition(notification_type: Optional[str]):
+    """
+    SQL-условие "пользователь отключил этот тип" для массовых операций (INSERT ... SELECT рассылки),
+    где настройки проверяются в самом запросе, а не через кэш
+    """
+    if notification_type not in MUTABLE_NOTIFICATION_TYPES:
+        return None
+    return exists().where(
+        UserNotificationSettings.user_id == User.id,
+        (literal(",") + UserNotificationSettings.muted_types + literal(",")).like(f"%,{notification_type},%"),
+    )
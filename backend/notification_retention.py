@@ -0,0 +1,206 @@
+# backend/notification_retention.py
+
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+from sqlalchemy import delete, or_
+from sqlalchemy.orm import Session
+from models import Notification, NotificationOutbox, SyncChange, SessionLocal
+from notification_service import OUTBOX_PENDING
+from sync_service import SYNC_RETENTION_DAYS, advance_purge_watermark
+
+# Срок хранения прочитанных уведомлений по типам (в днях).
+# Уведомления о сообщениях дублируют саму переписку, поэтому живут меньше всего
+DEFAULT_RETENTION_TTL_DAYS = {
+    "new_message": 14,
+    "new_consultation": 60,
+    "consultation_started": 60,
+    "consultation_completed": 180,
+    "system": 180,
+}
+
+# Срок хранения прочитанных уведомлений остальных типов
+RETENTION_DEFAULT_DAYS = int(os.getenv("NOTIFICATION_RETENTION_DAYS", "90"))
+
+# Сколько строк удалять одной транзакцией и сколько пачек одного типа за проход
+RETENTION_BATCH_SIZE = int(os.getenv("NOTIFICATION_RETENTION_BATCH_SIZE", "1000"))
+RETENTION_MAX_BATCHES = 200
+
+# Пауза между пачками: даем место обычным запросам к таблице
+RETENTION_BATCH_PAUSE_SECONDS = 0.05
+
+# Через сколько дней удаляются завершенные строки очереди доставки
+OUTBOX_RETENTION_DAYS = int(os.getenv("NOTIFICATION_OUTBOX_RETENTION_DAYS", "7"))
+
+# Интервал фоновой очистки в секундах (по умолчанию раз в 6 часов)
+RETENTION_INTERVAL_SECONDS = int(os.getenv("NOTIFICATION_RETENTION_INTERVAL_SECONDS", str(6 * 60 * 60)))
+
+
+def parse_ttl_overrides(value: str) -> Dict[str, int]:
+    """Разбирает NOTIFICATION_RETENTION_TTLS вида "new_message=7,system=365" """
+    overrides = {}
+    for item in value.split(","):
+        notification_type, _, days = item.partition("=")
+        if notification_type.strip() and days.strip().isdigit():
+            overrides[notification_type.strip()] = int(days)
+    return overrides
+
+
+RETENTION_TTL_DAYS = {
+    **DEFAULT_RETENTION_TTL_DAYS,
+    **parse_ttl_overrides(os.getenv("NOTIFICATION_RETENTION_TTLS", "")),
+}
+
+
+def _delete_in_batches(
+    db: Session,
+    select_ids: Callable[[], Any],
+    delete_batch: Callable[[list], None],
+    batch_size: int,
+    max_batches: int,
+) -> tuple:
+    """
+    Удаляет строки пачками по первичному ключу: каждая пачка - короткая транзакция,
+    поэтому долгих блокировок таблицы нет. Возвращает (удалено строк, пачек).
+    """
+    deleted = 0
+    batches = 0
+    while batches < max_batches:
+        ids = [row[0] for row in select_ids().limit(batch_size)]
+        if not ids:
+            break
+
+        delete_batch(ids)
+        db.commit()
+        deleted += len(ids)
+        batches += 1
+
+        if len(ids) < batch_size:
+            break
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+    return deleted, batches
+
+
+def purge_notifications(
+    db: Session,
+    ttl_days: Optional[Dict[str, int]] = None,
+    default_days: int = RETENTION_DEFAULT_DAYS,
+    batch_size: int = RETENTION_BATCH_SIZE,
+    max_batches: int = RETENTION_MAX_BATCHES,
+    now: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    """
+    Удаляет прочитанные уведомления старше срока хранения их типа,
+    завершенные строки очереди доставки прочитанных уведомлений старше OUTBOX_RETENTION_DAYS
+    и записи журнала синхронизации старше SYNC_RETENTION_DAYS.
+    Непрочитанные уведомления не удаляются: счетчик непрочитанных не меняется.
+
+    Returns:
+        dict: статистика прохода (удалено всего и по типам, строки очереди, журнал, пачки, ошибки)
+    """
+    ttl_days = RETENTION_TTL_DAYS if ttl_days is None else ttl_days
+    now = now or datetime.utcnow()
+
+    stats = {
+        "deleted": 0,
+        "by_type": {},
+        "outbox_deleted": 0,
+        "sync_deleted": 0,
+        "batches": 0,
+        "errors": 0,
+    }
+
+    # Правила: отдельный срок для каждого известного типа и общий - для остальных
+    rules = [(notification_type, days, Notification.type == notification_type) for notification_type, days in ttl_days.items()]
+    rules.append(("other", default_days, or_(Notification.type.is_(None), Notification.type.notin_(list(ttl_days)))))
+
+    def delete_notifications(ids: list) -> None:
+        # Строки очереди удаляются явно: не полагаемся на ON DELETE CASCADE
+        db.execute(delete(NotificationOutbox).where(NotificationOutbox.notification_id.in_(ids)))
+        db.execute(delete(Notification).where(Notification.id.in_(ids)))
+
+    for label, days, type_condition in rules:
+        cutoff = now - timedelta(days=days)
+        try:
+            deleted, batches = _delete_in_batches(
+                db,
+                # Выборка по индексу idx_notifications_retention (is_viewed, type, created_at)
+                lambda: db.query(Notification.id).filter(
+                    Notification.is_viewed == True,
+                    type_condition,
+                    Notification.created_at < cutoff,
+                ),
+                delete_notifications,
+                batch_size,
+                max_batches,
+            )
+        except Exception as e:
+            db.rollback()
+            stats["errors"] += 1
+            print(f"[Retention] Ошибка при удалении уведомлений типа {label}: {str(e)}")
+            continue
+
+        if deleted:
+            stats["by_type"][label] = deleted
+        stats["deleted"] += deleted
+        stats["batches"] += batches
+
+    # Строка очереди непрочитанного уведомления - отметка "уже доставлено" (или "не доставлять"):
+    # без нее уведомление снова отправлялось бы при каждом подключении. Поэтому удаляются
+    # только строки прочитанных или уже удаленных уведомлений
+    outbox_cutoff = now - timedelta(days=OUTBOX_RETENTION_DAYS)
+    try:
+        deleted, batches = _delete_in_batches(
+            db,
+            lambda: db.query(NotificationOutbox.id).outerjoin(
+                Notification, Notification.id == NotificationOutbox.notification_id
+            ).filter(
+                NotificationOutbox.status != OUTBOX_PENDING,
+                NotificationOutbox.created_at < outbox_cutoff,
+                or_(Notification.id.is_(None), Notification.is_viewed == True),
+            ).order_by(NotificationOutbox.id),
+            lambda ids: db.execute(delete(NotificationOutbox).where(NotificationOutbox.id.in_(ids))),
+            batch_size,
+            max_batches,
+        )
+        stats["outbox_deleted"] = deleted
+        stats["batches"] += batches
+    except Exception as e:
+        db.rollback()
+        stats["errors"] += 1
+        print(f"[Retention] Ошибка при очистке очереди доставки: {str(e)}")
+
+    # Журнал синхронизации удаляется с начала (по id). Вместе с каждой пачкой сдвигается
+    # граница удаленной части: клиенты с курсором меньше нее получат full_resync
+    sync_cutoff = now - timedelta(days=SYNC_RETENTION_DAYS)
+
+    def delete_sync_batch(ids: list) -> None:
+        db.execute(delete(SyncChange).where(SyncChange.id.in_(ids)))
+        advance_purge_watermark(db, max(ids))
+
+    try:
+        deleted, batches = _delete_in_batches(
+            db,
+            lambda: db.query(SyncChange.id).filter(SyncChange.created_at < sync_cutoff).order_by(SyncChange.id),
+            delete_sync_batch,
+            batch_size,
+            max_batches,
+        )
+        stats["sync_deleted"] = deleted
+        stats["batches"] += batches
+    except Exception as e:
+        db.rollback()
+        stats["errors"] += 1
+        print(f"[Retention] Ошибка при очистке журнала синхронизации: {str(e)}")
+
+    return stats
+
+
+def run_retention_pass() -> Dict[str, Any]:
+    """Выполняет один проход очистки в собственной сессии (для фоновых задач)"""
+    started = time.monotonic()
+    with SessionLocal() as db:
+        stats = purge_notifications(db)
+    stats["seconds"] = round(time.monotonic() - started, 3)
+    return stats
@@ -0,0 +1,1126 @@
+# backend/notification_service.py
+
+import os
+import time
+import uuid
+import heapq
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from sqlalchemy import event, update, insert, select, exists, literal, func, case, or_, and_, bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import (
+    Notification,
+    NotificationCounter,
+    NotificationOutbox,
+    NotificationBroadcast,
+    SyncChange,
+    User,
+    SessionLocal,
+)
+from sync_service import record_change, CHANGE_NOTIFICATION, CHANGE_NOTIFICATIONS_READ
+from event_bus import event_bus, user_channel, broadcast_channel
+from websocket_manager import KIND_NOTIFICATIONS
+from notification_preferences import NotificationPreferences, NotificationPreferencesCache, muted_by_user_condition
+
+# Статусы строки очереди доставки
+OUTBOX_PENDING = "pending"    # ожидает доставки (или повторной попытки)
+OUTBOX_SENT = "sent"          # воркер, владеющий соединением пользователя, подтвердил доставку
+OUTBOX_OFFLINE = "offline"    # опубликовано, но доставка не подтверждена: пользователь получит уведомление при подключении
+OUTBOX_FAILED = "failed"      # попытки исчерпаны из-за ошибок
+OUTBOX_SUPPRESSED = "suppressed"  # пользователь отключил мгновенные уведомления: только в списке уведомлений
+
+DISPATCH_POLL_INTERVAL_SECONDS = float(os.getenv("NOTIFICATION_DISPATCH_INTERVAL", "1"))
+DISPATCH_BATCH_SIZE = 200
+# На сколько строка закрепляется за диспетчером (если воркер упал - ее заберет другой)
+DISPATCH_LEASE_SECONDS = 30
+DISPATCH_MAX_ATTEMPTS = 5
+
+# Повторные попытки после ошибок публикации: задержка 2**attempts секунд, но не больше
+DISPATCH_MAX_RETRY_DELAY_SECONDS = 60
+
+# Массовые рассылки: размер пачки пользователей на одну транзакцию INSERT ... SELECT
+BROADCAST_CHUNK_SIZE = int(os.getenv("NOTIFICATION_BROADCAST_CHUNK", "1000"))
+
+BROADCAST_QUEUED = "queued"
+BROADCAST_RUNNING = "running"
+BROADCAST_COMPLETED = "completed"
+BROADCAST_FAILED = "failed"
+
+# Размер кэша недавно доставленных уведомлений (защита от повторной отправки)
+DELIVERY_DEDUPE_CACHE_SIZE = int(os.getenv("NOTIFICATION_DEDUPE_CACHE_SIZE", "10000"))
+
+# Сколько последних непрочитанных уведомлений отправлять при подключении к WebSocket
+UNREAD_ON_CONNECT_LIMIT = 50
+
+# Типы, повторные непрочитанные уведомления которых сворачиваются в одно по ключу (type, related_id):
+# вместо новой строки обновляется существующая (счетчик и текст последнего события)
+COLLAPSIBLE_TYPES = ("new_message",)
+
+# Флаг в session.info: в транзакции есть новые строки очереди
+_OUTBOX_SESSION_FLAG = "notification_outbox"
+
+
+def serialize_notification(notification: Notification) -> Dict[str, Any]:
+    """Уведомление в формате WebSocket событий new_notification / unread_notifications"""
+    return {
+        "id": notification.id,
+        "title": notification.title,
+        "message": notification.message,
+        "type": notification.type,
+        "related_id": notification.related_id,
+        "created_at": notification.created_at.isoformat(),
+        "is_viewed": notification.is_viewed,
+        "collapse_count": notification.collapse_count or 1,
+        "updated_at": notification.updated_at.isoformat() if notification.updated_at else None,
+    }
+
+
+def delivery_key(notification: Dict[str, Any]) -> tuple:
+    """Ключ доставки: свернутое уведомление доставляется заново при каждом новом событии"""
+    return notification["id"], notification.get("collapse_count") or 1
+
+
+def enqueue_notification(
+    db: Session,
+    user_id: int,
+    title: str,
+    message: str,
+    notification_type: str = "system",
+    related_id: Optional[int] = None,
+) -> Optional[Notification]:
+    """
+    Добавляет уведомление и задание на его доставку в текущую транзакцию.
+    Коммит выполняет вызывающий код; доставку по WebSocket выполняет диспетчер после коммита.
+    Для типов из COLLAPSIBLE_TYPES непрочитанное уведомление с тем же related_id
+    не дублируется, а сворачивается (см. _collapse_notification).
+    Настройки пользователя (из кэша диспетчера) проверяются до записи в БД:
+    уведомления отключенных типов не создаются, в тихие часы доставка откладывается,
+    при отключенных мгновенных уведомлениях - не выполняется.
+
+    Args:
+        db: сессия БД вызывающего кода
+        user_id: ID пользователя, которому предназначено уведомление
+        title: заголовок уведомления
+        message: текст уведомления
+        notification_type: тип уведомления (system, consultation, new_message и т.д.)
+        related_id: ID связанного объекта (например, ID консультации)
+
+    Returns:
+        Optional[Notification]: уведомление (id уже назначен) или None, если тип отключен пользователем:
+        в этом случае в БД ничего не записывается, и вызывающий код должен обрабатывать None
+    """
+    preferences = notification_dispatcher.preferences.get(db, user_id)
+    if preferences.is_muted(notification_type):
+        notification_dispatcher.filtered["muted"] += 1
+        return None
+
+    if notification_type in COLLAPSIBLE_TYPES and related_id is not None:
+        existing = (
+            db.query(Notification)
+            .filter(
+                Notification.user_id == user_id,
+                Notification.type == notification_type,
+                Notification.related_id == related_id,
+                Notification.is_viewed == False,
+            )
+            .order_by(Notification.id.desc())
+            .with_for_update()
+            .first()
+        )
+        if existing:
+            _collapse_notification(db, existing, title, message, preferences)
+            return existing
+
+    notification = Notification(
+        user_id=user_id,
+        title=title,
+        message=message,
+        type=notification_type,
+        related_id=related_id,
+        is_viewed=False,
+    )
+    db.add(notification)
+    db.flush()
+
+    db.add(NotificationOutbox(notification_id=notification.id, user_id=user_id, **_outbox_state(preferences)))
+    record_change(db, [user_id], CHANGE_NOTIFICATION, notification.id)
+    increment_unread(db, user_id)
+    db.info[_OUTBOX_SESSION_FLAG] = True
+    return notification
+
+
+def _outbox_state(preferences: NotificationPreferences) -> Dict[str, Any]:
+    """Начальное состояние строки очереди с учетом настроек получателя"""
+    if not preferences.realtime:
+        notification_dispatcher.filtered["suppressed"] += 1
+        return {"status": OUTBOX_SUPPRESSED}
+    now = datetime.utcnow()
+    if preferences.in_quiet_hours(now):
+        # Диспетчер возьмет строку после окончания тихих часов
+        notification_dispatcher.filtered["deferred"] += 1
+        return {"status": OUTBOX_PENDING, "next_attempt_at": preferences.quiet_hours_end_after(now)}
+    return {"status": OUTBOX_PENDING, "next_attempt_at": None}
+
+
+def _collapse_notification(
+    db: Session,
+    notification: Notification,
+    title: str,
+    message: str,
+    preferences: NotificationPreferences,
+) -> None:
+    """
+    Сворачивает новое событие в существующее непрочитанное уведомление: увеличивает collapse_count
+    и заменяет текст последним событием. Новая строка не создается, счетчик непрочитанных не меняется;
+    строка очереди возвращается в ожидание - диспетчер отправит клиенту только изменения.
+    """
+    notification.title = title
+    notification.message = message
+    notification.collapse_count = (notification.collapse_count or 1) + 1
+    notification.updated_at = datetime.utcnow()
+
+    # Захват строки диспетчером сбрасывается: его результат по старой версии не перезапишет статус
+    state = _outbox_state(preferences)
+    requeued = db.execute(
+        update(NotificationOutbox)
+        .where(NotificationOutbox.notification_id == notification.id)
+        .values(
+            status=state["status"],
+            attempts=0,
+            next_attempt_at=state.get("next_attempt_at"),
+            last_error=None,
+            delivered_at=None,
+            claimed_by=None,
+            claimed_until=None,
+        ),
+        execution_options={"synchronize_session": False},
+    ).rowcount
+    if not requeued:
+        # Строку очереди уже удалила очистка - создаем новую
+        db.add(NotificationOutbox(notification_id=notification.id, user_id=notification.user_id, **state))
+
+    record_change(db, [notification.user_id], CHANGE_NOTIFICATION, notification.id)
+    db.execute(
+        update(NotificationCounter)
+        .where(NotificationCounter.user_id == notification.user_id)
+        .values(version=NotificationCounter.version + 1)
+    )
+    db.info[_OUTBOX_SESSION_FLAG] = True
+
+
+# --- Счетчики непрочитанных ---
+
+def increment_unread(db: Session, user_id: int, amount: int = 1) -> None:
+    """
+    Увеличивает счетчик в текущей транзакции. Если строки счетчика еще нет,
+    ничего не делает: при первом чтении счетчик посчитается по таблице целиком.
+    """
+    db.execute(
+        update(NotificationCounter)
+        .where(NotificationCounter.user_id == user_id)
+        .values(
+            unread_count=NotificationCounter.unread_count + amount,
+            version=NotificationCounter.version + 1,
+        )
+    )
+
+
+def decrement_unread(db: Session, user_id: int, amount: int = 1) -> None:
+    """Уменьшает счетчик в текущей транзакции (не ниже нуля)"""
+    db.execute(
+        update(NotificationCounter)
+        .where(NotificationCounter.user_id == user_id)
+        .values(unread_count=case(
+            (NotificationCounter.unread_count > amount, NotificationCounter.unread_count - amount),
+            else_=0,
+        ), version=NotificationCounter.version + 1)
+    )
+
+
+def mark_read_up_to(db: Session, user_id: int, up_to_id: Optional[int] = None) -> tuple:
+    """
+    Отмечает прочитанными уведомления пользователя с id <= up_to_id одним UPDATE
+    (без up_to_id - все уведомления до последнего на момент вызова) в текущей транзакции.
+    Счетчик непрочитанных уменьшается на число отмеченных строк в той же транзакции,
+    поэтому уведомления, созданные параллельно с id > up_to_id, остаются в счетчике.
+    В журнал синхронизации пишется одно событие CHANGE_NOTIFICATIONS_READ с границей.
+
+    Returns:
+        tuple: (число отмеченных уведомлений, граница up_to_id)
+    """
+    if up_to_id is None:
+        # Граница по индексу (user_id, id): нужна для журнала синхронизации
+        up_to_id = db.query(func.max(Notification.id)).filter(Notification.user_id == user_id).scalar()
+        if up_to_id is None:
+            return 0, None
+
+    marked = db.execute(
+        update(Notification)
+        .where(
+            Notification.user_id == user_id,
+            Notification.id <= up_to_id,
+            Notification.is_viewed == False,
+        )
+        .values(is_viewed=True),
+        execution_options={"synchronize_session": False},
+    ).rowcount
+    if marked:
+        decrement_unread(db, user_id, marked)
+        record_change(db, [user_id], CHANGE_NOTIFICATIONS_READ, up_to_id)
+    return marked, up_to_id
+
+
+def mark_notification_read(db: Session, user_id: int, notification_id: int) -> bool:
+    """
+    Отмечает одно уведомление прочитанным в текущей транзакции. UPDATE с условием
+    is_viewed = 0 меняет строку только один раз, поэтому при параллельных отметках
+    (HTTP и WebSocket, несколько вкладок) счетчик уменьшается ровно на одно уведомление.
+
+    Returns:
+        bool: True, если уведомление было непрочитанным и отмечено этим вызовом
+    """
+    marked = db.execute(
+        update(Notification)
+        .where(
+            Notification.id == notification_id,
+            Notification.user_id == user_id,
+            Notification.is_viewed == False,
+        )
+        .values(is_viewed=True),
+        execution_options={"synchronize_session": False},
+    ).rowcount
+    if marked:
+        decrement_unread(db, user_id, marked)
+        record_change(db, [user_id], CHANGE_NOTIFICATION, notification_id)
+    return bool(marked)
+
+
+def _count_unread(db: Session, user_id: int) -> int:
+    return db.query(func.count(Notification.id)).filter(
+        Notification.user_id == user_id,
+        Notification.is_viewed == False,
+    ).scalar() or 0
+
+
+def get_unread_count(db: Session, user_id: int) -> int:
+    """
+    Число непрочитанных уведомлений пользователя из счетчика.
+    При первом обращении счетчик создается по COUNT(*) и сохраняется (отдельный коммит).
+    """
+    unread_count = db.query(NotificationCounter.unread_count).filter(NotificationCounter.user_id == user_id).scalar()
+    if unread_count is not None:
+        return unread_count
+
+    unread_count = _count_unread(db, user_id)
+    try:
+        db.add(NotificationCounter(user_id=user_id, unread_count=unread_count))
+        db.commit()
+    except IntegrityError:
+        # Счетчик одновременно создал другой запрос - берем его значение
+        db.rollback()
+        return db.query(NotificationCounter.unread_count).filter(NotificationCounter.user_id == user_id).scalar()
+
+    # Уведомления, закоммиченные между COUNT(*) и созданием строки, не попали ни в подсчет,
+    # ни в счетчик (increment_unread без строки ничего не делает). Пересчитываем под
+    # блокировкой строки счетчика: новые increment/decrement ждут ее и применятся поверх
+    db.query(NotificationCounter.user_id).filter(NotificationCounter.user_id == user_id).with_for_update().scalar()
+    recount = _count_unread(db, user_id)
+    if recount != unread_count:
+        db.execute(
+            update(NotificationCounter)
+            .where(NotificationCounter.user_id == user_id)
+            .values(unread_count=recount, version=NotificationCounter.version + 1)
+        )
+        unread_count = recount
+    db.commit()
+    return unread_count
+
+
+def get_inbox_version(db: Session, user_id: int) -> tuple:
+    """
+    Версия ленты уведомлений пользователя без чтения самих уведомлений:
+    (последний id по индексу (user_id, id), число непрочитанных, версия счетчика).
+    Используется для ETag списка уведомлений.
+    """
+    unread_count = get_unread_count(db, user_id)
+    last_id = db.query(func.max(Notification.id)).filter(Notification.user_id == user_id).scalar() or 0
+    version = db.query(NotificationCounter.version).filter(NotificationCounter.user_id == user_id).scalar()
+    return last_id, unread_count, version
+
+
+async def publish_unread_count(user_id: int, unread_count: int) -> None:
+    """Отправляет новое значение счетчика в соединения уведомлений пользователя"""
+    await event_bus.publish(user_channel(user_id), {
+        "type": "unread_count",
+        "unread_count": unread_count,
+    }, kinds=(KIND_NOTIFICATIONS,))
+
+
+async def publish_notifications_read(user_id: int, up_to_id: int, unread_count: int) -> None:
+    """
+    Одно событие об отметке прочитанными всех уведомлений до up_to_id -
+    для остальных вкладок и устройств пользователя (вместо события на каждое уведомление)
+    """
+    await event_bus.publish(user_channel(user_id), {
+        "type": "notifications_read",
+        "up_to_id": up_to_id,
+        "unread_count": unread_count,
+    }, kinds=(KIND_NOTIFICATIONS,))
+
+
+def _broadcast_targets(broadcast: NotificationBroadcast) -> tuple:
+    """Условия выборки получателей рассылки (без пользователей, отключивших этот тип)"""
+    targets = [User.is_active == True]
+    if broadcast.target_type == "role":
+        targets.append(User.role == broadcast.role)
+    muted = muted_by_user_condition(broadcast.type)
+    if muted is not None:
+        targets.append(~muted)
+    return tuple(targets)
+
+
+def create_broadcast(
+    db: Session,
+    created_by: int,
+    title: str,
+    message: str,
+    notification_type: str = "system",
+    target_type: str = "all",
+    role: Optional[str] = None,
+) -> NotificationBroadcast:
+    """
+    Добавляет задачу массовой рассылки в текущую транзакцию (коммит - за вызывающим кодом).
+    Сами уведомления создает NotificationDispatcher.run_broadcast пачками в фоне.
+    """
+    broadcast = NotificationBroadcast(
+        created_by=created_by,
+        title=title,
+        message=message,
+        type=notification_type,
+        target_type=target_type,
+        role=role,
+        status=BROADCAST_QUEUED,
+    )
+    broadcast.total_users = db.query(func.count(User.id)).filter(*_broadcast_targets(broadcast)).scalar() or 0
+    db.add(broadcast)
+    db.flush()
+    return broadcast
+
+
+def serialize_broadcast(broadcast: NotificationBroadcast) -> Dict[str, Any]:
+    """Состояние рассылки для эндпоинта прогресса"""
+    return {
+        "id": broadcast.id,
+        "status": broadcast.status,
+        "title": broadcast.title,
+        "type": broadcast.type,
+        "target_type": broadcast.target_type,
+        "role": broadcast.role,
+        "total_users": broadcast.total_users,
+        "processed_users": broadcast.processed_users,
+        "progress": round(100 * broadcast.processed_users / broadcast.total_users, 1) if broadcast.total_users else 100.0,
+        "delivered": broadcast.delivered,
+        "error": broadcast.error,
+        "created_at": broadcast.created_at.isoformat() if broadcast.created_at else None,
+        "started_at": broadcast.started_at.isoformat() if broadcast.started_at else None,
+        "finished_at": broadcast.finished_at.isoformat() if broadcast.finished_at else None,
+    }
+
+
+class DeliveryDedupeCache:
+    """
+    Ограниченный LRU-кэш ключей доставки (id, collapse_count) уведомлений, уже доставленных этим воркером.
+    Память не растет: при переполнении вытесняются самые старые записи.
+    Долговременное состояние доставки хранится в notification_outbox.status -
+    оно общее для всех воркеров и переживает перезапуск; кэш лишь избавляет
+    от запросов к БД и повторных отправок в пределах воркера.
+    """
+
+    def __init__(self, max_size: int = DELIVERY_DEDUPE_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids: "OrderedDict[tuple, None]" = OrderedDict()
+        self.hits = 0
+
+    def mark(self, key: tuple) -> None:
+        self._ids[key] = None
+        self._ids.move_to_end(key)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def seen(self, key: tuple) -> bool:
+        if key in self._ids:
+            self.hits += 1
+            return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+class RetryScheduler:
+    """
+    Расписание повторных попыток доставки: куча (срок, id строки очереди) с индексом по пользователю.
+    Отдельных задач на каждый повтор нет - кучу обслуживает одна задача, цикл диспетчера:
+    он спит до ближайшего срока и затем забирает готовые строки из notification_outbox.
+    Удаление из кучи ленивое: отмененные и перенесенные записи пропускаются при извлечении.
+    """
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        # id строки очереди -> (срок по time.monotonic, id пользователя)
+        self._entries: Dict[int, tuple] = {}
+        self._by_user: Dict[int, set] = {}
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+
+    def schedule(self, outbox_id: int, user_id: int, delay: float) -> None:
+        self._discard(outbox_id)
+        due = time.monotonic() + delay
+        self._entries[outbox_id] = (due, user_id)
+        self._by_user.setdefault(user_id, set()).add(outbox_id)
+        heapq.heappush(self._heap, (due, outbox_id))
+        self.scheduled += 1
+        # Куча не разрастается из-за устаревших записей
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(due, outbox_id) for outbox_id, (due, _) in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def _discard(self, outbox_id: int) -> Optional[int]:
+        entry = self._entries.pop(outbox_id, None)
+        if entry is None:
+            return None
+        user_ids = self._by_user.get(entry[1])
+        if user_ids is not None:
+            user_ids.discard(outbox_id)
+            if not user_ids:
+                del self._by_user[entry[1]]
+        return entry[1]
+
+    def _is_current(self, item: tuple) -> bool:
+        entry = self._entries.get(item[1])
+        return entry is not None and entry[0] == item[0]
+
+    def pop_due(self) -> List[int]:
+        """Извлекает строки, срок повтора которых наступил"""
+        now = time.monotonic()
+        due_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            item = heapq.heappop(self._heap)
+            if self._is_current(item):
+                self._discard(item[1])
+                due_ids.append(item[1])
+        self.fired += len(due_ids)
+        return due_ids
+
+    def next_delay(self) -> Optional[float]:
+        """Секунды до ближайшего повтора (None - расписание пусто)"""
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+    def cancel_user(self, user_id: int) -> List[int]:
+        """Снимает с расписания все повторы пользователя и возвращает id строк"""
+        outbox_ids = list(self._by_user.get(user_id, ()))
+        for outbox_id in outbox_ids:
+            self._discard(outbox_id)
+        self.cancelled += len(outbox_ids)
+        return outbox_ids
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def undelivered_unread_query(db: Session, user_id: int):
+    """
+    Непрочитанные уведомления пользователя, которые еще не были доставлены по WebSocket
+    (нет строки в очереди или ее статус не sent) - их отправляют при подключении.
+    Уведомления, мгновенная доставка которых отключена пользователем, не отправляются.
+    Строки, отложенные до окончания тихих часов (next_attempt_at в будущем), тоже:
+    их доставит диспетчер, когда срок наступит.
+    """
+    now = datetime.utcnow()
+    return (
+        db.query(Notification)
+        .outerjoin(NotificationOutbox, NotificationOutbox.notification_id == Notification.id)
+        .filter(
+            Notification.user_id == user_id,
+            Notification.is_viewed == False,
+            or_(NotificationOutbox.id.is_(None), NotificationOutbox.status.notin_((OUTBOX_SENT, OUTBOX_SUPPRESSED))),
+            or_(NotificationOutbox.next_attempt_at.is_(None), NotificationOutbox.next_attempt_at <= now),
+        )
+    )
+
+
+def mark_delivered(db: Session, notifications: List[Dict[str, Any]]) -> None:
+    """
+    Отмечает уведомления (в формате serialize_notification) доставленными - например,
+    отправленными при подключении к WebSocket - в текущей транзакции:
+    диспетчер не отправит их повторно, а следующее подключение не получит.
+    Для уведомлений без строки очереди (созданных в обход очереди или до нее) строка
+    создается сразу со статусом sent - доставка фиксируется в БД, а не только в кэше воркера.
+    """
+    if not notifications:
+        return
+    now = datetime.utcnow()
+    ids = [notification["id"] for notification in notifications]
+    db.execute(
+        update(NotificationOutbox)
+        .where(
+            NotificationOutbox.notification_id.in_(ids),
+            NotificationOutbox.status != OUTBOX_SENT,
+        )
+        .values(status=OUTBOX_SENT, delivered_at=now, claimed_by=None, claimed_until=None),
+        execution_options={"synchronize_session": False},
+    )
+    db.execute(
+        insert(NotificationOutbox).from_select(
+            ["notification_id", "user_id", "status", "attempts", "created_at", "delivered_at"],
+            select(
+                Notification.id,
+                Notification.user_id,
+                literal(OUTBOX_SENT),
+                literal(0),
+                literal(now),
+                literal(now),
+            ).where(
+                Notification.id.in_(ids),
+                ~exists().where(NotificationOutbox.notification_id == Notification.id),
+            ),
+        )
+    )
+    for notification in notifications:
+        notification_dispatcher.delivered_cache.mark(delivery_key(notification))
+
+
+def _available(now: datetime):
+    """Условия строки, готовой к доставке: ожидает, срок попытки наступил, не закреплена"""
+    return (
+        NotificationOutbox.status == OUTBOX_PENDING,
+        or_(NotificationOutbox.next_attempt_at.is_(None), NotificationOutbox.next_attempt_at <= now),
+        or_(NotificationOutbox.claimed_until.is_(None), NotificationOutbox.claimed_until < now),
+    )
+
+
+class NotificationDispatcher:
+    """
+    Фоновая доставка уведомлений из очереди notification_outbox.
+
+    Диспетчер закрепляет за собой пачку ожидающих строк, публикует уведомления
+    в каналы пользователей и записывает результат: offline (опубликовано) или повтор
+    с экспоненциальной задержкой (после ошибки шины). Статус sent ставит не диспетчер,
+    а воркер, который отправил уведомление в соединение пользователя (confirm_delivery):
+    с распределенной шиной успешная публикация еще не означает доставку. Просыпается сразу после коммита
+    транзакции с новыми уведомлениями, к сроку ближайшего повтора из RetryScheduler
+    и по таймеру (уведомления других воркеров, истекшие захваты).
+    Уведомления для отключенного пользователя не повторяются по расписанию:
+    они доставляются, когда пользователь подключается (см. user_connected).
+    """
+
+    def __init__(self, session_factory=SessionLocal, bus=event_bus, poll_interval: float = DISPATCH_POLL_INTERVAL_SECONDS):
+        self.session_factory = session_factory
+        self.bus = bus
+        self.poll_interval = poll_interval
+        self.worker_id = uuid.uuid4().hex[:8]
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Выполняющиеся рассылки (ссылки, чтобы задачи не собрал сборщик мусора)
+        self._broadcasts = set()
+        self.delivered_cache = DeliveryDedupeCache()
+        self.retry_scheduler = RetryScheduler()
+        # Настройки уведомлений пользователей: проверяются до записи в БД и отправки
+        self.preferences = NotificationPreferencesCache()
+        self.filtered = {
+            "muted": 0,       # не созданы: тип отключен пользователем
+            "suppressed": 0,  # не отправлены: мгновенные уведомления отключены
+            "deferred": 0,    # отложены до конца тихих часов
+        }
+        # Подтверждения доставки копятся и записываются в БД одним UPDATE
+        self._acks: List[list] = []
+        self._ack_flush: Optional[asyncio.Task] = None
+        self._counters = {
+            "published": 0,  # переданы в шину
+            "sent": 0,       # доставка в соединения этого воркера подтверждена
+            "offline": 0,    # пользователь не был подключен (локальная шина)
+            "retried": 0,    # запланированы повторные попытки
+            "failed": 0,     # попытки исчерпаны
+        }
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.bus.delivery_handler = self.confirm_delivery
+        self._task = asyncio.create_task(self._run())
+        print(f"[Notifications] Диспетчер {self.worker_id} запущен")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def wake(self) -> None:
+        """Будит диспетчер; можно вызывать из любого потока (коммит бывает в asyncio.to_thread)"""
+        if self._loop is None or self._loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def user_connected(self, user_id: int) -> None:
+        """
+        Пользователь подключился к WebSocket уведомлений: его отложенные повторы
+        выполняются сразу, а не по расписанию.
+        """
+        outbox_ids = self.retry_scheduler.cancel_user(user_id)
+        if not outbox_ids:
+            return
+        await asyncio.to_thread(self._release, outbox_ids)
+        self.wake()
+
+    def _release(self, outbox_ids: List[int]) -> None:
+        with self.session_factory() as db:
+            db.execute(
+                update(NotificationOutbox)
+                .where(NotificationOutbox.id.in_(outbox_ids), NotificationOutbox.status == OUTBOX_PENDING)
+                .values(next_attempt_at=None),
+                execution_options={"synchronize_session": False},
+            )
+            db.commit()
+
+    # --- Подтверждения доставки ---
+
+    async def confirm_delivery(self, acks: List[list]) -> None:
+        """
+        Вызывается шиной на воркере, который отправил уведомления в соединения пользователей.
+        acks: [[id строки очереди, id уведомления, collapse_count, метка захвата], ...]
+        """
+        for _, notification_id, collapse_count, _ in acks:
+            self.delivered_cache.mark((notification_id, collapse_count))
+        self._counters["sent"] += len(acks)
+        self._acks.extend(acks)
+        if self._ack_flush is None or self._ack_flush.done():
+            self._ack_flush = asyncio.create_task(self._flush_acks())
+
+    async def _flush_acks(self) -> None:
+        # Подтверждения, пришедшие за одну итерацию цикла событий, записываются вместе
+        await asyncio.sleep(0)
+        while self._acks:
+            acks, self._acks = self._acks, []
+            try:
+                await asyncio.to_thread(self._confirm, acks)
+            except Exception as e:
+                print(f"[Notifications] Ошибка записи подтверждений доставки: {str(e)}")
+
+    def _confirm(self, acks: List[list]) -> None:
+        """
+        Отмечает строки очереди доставленными. Строка обновляется, только если она все еще
+        в той версии, которая была отправлена: захвачена той же меткой или уже записана как offline.
+        Свернутое после отправки уведомление снова в ожидании - его подтверждение не засчитывается.
+        """
+        table = NotificationOutbox.__table__
+        with self.session_factory() as db:
+            db.execute(
+                update(table)
+                .where(
+                    table.c.id == bindparam("ack_id"),
+                    or_(
+                        table.c.claimed_by == bindparam("ack_claim"),
+                        and_(table.c.claimed_by.is_(None), table.c.status == OUTBOX_OFFLINE),
+                    ),
+                )
+                .values(status=OUTBOX_SENT, delivered_at=datetime.utcnow(), claimed_by=None, claimed_until=None),
+                [{"ack_id": outbox_id, "ack_claim": claim} for outbox_id, _, _, claim in acks],
+            )
+            db.commit()
+
+    # --- Работа с очередью ---
+
+    def _claim(self) -> tuple:
+        """Закрепляет за диспетчером пачку ожидающих строк и возвращает (метка захвата, строки с уведомлениями)"""
+        now = datetime.utcnow()
+        available = _available(now)
+        with self.session_factory() as db:
+            ids = [
+                row.id
+                for row in db.query(NotificationOutbox.id)
+                .filter(*available)
+                .order_by(NotificationOutbox.id)
+                .limit(DISPATCH_BATCH_SIZE)
+            ]
+            if not ids:
+                return None, []
+
+            # Условный UPDATE: строки, которые успел забрать другой воркер, не перезаписываются
+            claim = f"{self.worker_id}:{uuid.uuid4().hex[:8]}"
+            db.execute(
+                update(NotificationOutbox)
+                .where(NotificationOutbox.id.in_(ids), *available)
+                .values(claimed_by=claim, claimed_until=now + timedelta(seconds=DISPATCH_LEASE_SECONDS))
+            )
+            db.commit()
+
+            rows = (
+                db.query(NotificationOutbox, Notification, NotificationCounter.unread_count)
+                .join(Notification, Notification.id == NotificationOutbox.notification_id)
+                .outerjoin(NotificationCounter, NotificationCounter.user_id == NotificationOutbox.user_id)
+                .filter(NotificationOutbox.claimed_by == claim)
+                .order_by(NotificationOutbox.id)
+                .all()
+            )
+            return claim, [
+                {
+                    "id": outbox.id,
+                    "user_id": outbox.user_id,
+                    "attempts": outbox.attempts,
+                    "notification": serialize_notification(notification),
+                    "unread_count": unread_count,
+                }
+                for outbox, notification, unread_count in rows
+            ]
+
+    def _finish(self, claim: str, results: List[Dict[str, Any]]) -> None:
+        """
+        Записывает результаты доставки одним UPDATE по первичному ключу (executemany).
+        Строки, захват которых был сброшен (уведомление свернуто после захвата
+        или доставка уже подтверждена), не перезаписываются.
+        """
+        table = NotificationOutbox.__table__
+        with self.session_factory() as db:
+            db.execute(
+                update(table).where(table.c.id == bindparam("outbox_id"), table.c.claimed_by == claim),
+                results,
+            )
+            db.commit()
+
+    async def dispatch_once(self) -> int:
+        """Доставляет одну пачку уведомлений. Возвращает размер пачки."""
+        claim, batch = await asyncio.to_thread(self._claim)
+        if not batch:
+            return 0
+
+        results = []
+        for item in batch:
+            now = datetime.utcnow()
+            attempts = item["attempts"] + 1
+            result = {
+                "outbox_id": item["id"],
+                "attempts": attempts,
+                "status": OUTBOX_PENDING,
+                "next_attempt_at": None,
+                "last_error": None,
+                "delivered_at": None,
+                "claimed_by": None,
+                "claimed_until": None,
+            }
+            # Строка могла вернуться в очередь после истечения захвата, хотя уже доставлена
+            if self.delivered_cache.seen(delivery_key(item["notification"])):
+                result["status"] = OUTBOX_SENT
+                result["delivered_at"] = now
+                results.append(result)
+                continue
+
+            notification = item["notification"]
+            if notification["collapse_count"] > 1:
+                # Свернутое уведомление у клиента уже есть - отправляем только изменившиеся поля
+                message = {
+                    "type": "notification_updated",
+                    "notification": {
+                        "id": notification["id"],
+                        "title": notification["title"],
+                        "message": notification["message"],
+                        "collapse_count": notification["collapse_count"],
+                        "updated_at": notification["updated_at"],
+                    },
+                }
+            else:
+                message = {"type": "new_notification", "notification": notification}
+            # Вместе с уведомлением клиент получает актуальный счетчик непрочитанных
+            if item["unread_count"] is not None:
+                message["unread_count"] = item["unread_count"]
+            ack = [item["id"], notification["id"], notification["collapse_count"], claim]
+            try:
+                published = await self.bus.publish(user_channel(item["user_id"]), message, acks=[ack])
+                if not published and self.bus.distributed:
+                    raise RuntimeError("событие не передано в шину")
+            except Exception as e:
+                result["last_error"] = str(e)[:1000]
+                if attempts >= DISPATCH_MAX_ATTEMPTS:
+                    result["status"] = OUTBOX_FAILED
+                    self._counters["failed"] += 1
+                    print(f"[Notifications] Уведомление {item['notification']['id']} не доставлено: {str(e)}")
+                else:
+                    delay = min(2 ** attempts, DISPATCH_MAX_RETRY_DELAY_SECONDS)
+                    result["next_attempt_at"] = now + timedelta(seconds=delay)
+                    self.retry_scheduler.schedule(item["id"], item["user_id"], delay)
+                    self._counters["retried"] += 1
+            else:
+                # sent записывает воркер, доставивший уведомление (confirm_delivery);
+                # если подтверждения не будет, пользователь получит уведомление при подключении
+                result["status"] = OUTBOX_OFFLINE
+                self._counters["published"] += 1
+                if not published:
+                    self._counters["offline"] += 1
+            results.append(result)
+
+        await asyncio.to_thread(self._finish, claim, results)
+        return len(batch)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                # Полная пачка - в очереди могут быть еще строки, забираем сразу
+                if await self.dispatch_once() >= DISPATCH_BATCH_SIZE:
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[Notifications] Ошибка доставки уведомлений: {str(e)}")
+
+            # Спим до ближайшего повтора, но не дольше интервала опроса
+            timeout = self.poll_interval
+            retry_delay = self.retry_scheduler.next_delay()
+            if retry_delay is not None:
+                timeout = min(timeout, retry_delay)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.retry_scheduler.pop_due()
+
+    # --- Массовые рассылки ---
+
+    def start_broadcast(self, broadcast_id: int) -> None:
+        """Запускает рассылку в фоне; запрос администратора не ждет ее завершения"""
+        task = asyncio.create_task(self.run_broadcast(broadcast_id))
+        self._broadcasts.add(task)
+        task.add_done_callback(self._broadcasts.discard)
+
+    async def resume_broadcasts(self) -> int:
+        """
+        Продолжает рассылки, прерванные перезапуском (в очереди или выполняются), с last_user_id.
+        Если рассылку продолжают несколько воркеров, пачки не дублируются:
+        каждая пачка создается под блокировкой строки рассылки.
+        """
+        def pending_ids() -> List[int]:
+            with self.session_factory() as db:
+                return [
+                    row.id
+                    for row in db.query(NotificationBroadcast.id)
+                    .filter(NotificationBroadcast.status.in_((BROADCAST_QUEUED, BROADCAST_RUNNING)))
+                    .order_by(NotificationBroadcast.id)
+                ]
+
+        broadcast_ids = await asyncio.to_thread(pending_ids)
+        for broadcast_id in broadcast_ids:
+            print(f"[Notifications] Продолжаем рассылку {broadcast_id} после перезапуска")
+            self.start_broadcast(broadcast_id)
+        return len(broadcast_ids)
+
+    def _insert_broadcast_chunk(self, broadcast_id: int, chunk_size: int) -> Optional[Dict[str, Any]]:
+        """
+        Создает уведомления для следующей пачки получателей одной транзакцией:
+        INSERT ... SELECT в notifications, notification_outbox и sync_changes по диапазону id пользователей.
+        Строки очереди создаются со статусом offline: пачка публикуется одним событием,
+        доставку в соединения подтверждают воркеры, остальные получат уведомление при подключении.
+        Строки получателей в тихих часах откладываются (pending до конца тихих часов) - их доставит диспетчер.
+        Возвращает пачку для доставки или None, если получатели закончились.
+        """
+        with self.session_factory() as db:
+            # Блокировка строки рассылки: воркеры, продолжающие одну рассылку, берут пачки по очереди
+            broadcast = db.get(NotificationBroadcast, broadcast_id, with_for_update=True)
+            if broadcast.status not in (BROADCAST_QUEUED, BROADCAST_RUNNING):
+                return None
+            targets = _broadcast_targets(broadcast)
+            cursor = broadcast.last_user_id
+
+            user_ids = [
+                row.id
+                for row in db.query(User.id)
+                .filter(*targets, User.id > cursor)
+                .order_by(User.id)
+                .limit(chunk_size)
+            ]
+            if not user_ids:
+                return None
+
+            now = datetime.utcnow()
+            db.execute(
+                insert(Notification).from_select(
+                    ["user_id", "title", "message", "type", "is_viewed", "broadcast_id", "collapse_count", "created_at"],
+                    select(
+                        User.id,
+                        literal(broadcast.title),
+                        literal(broadcast.message),
+                        literal(broadcast.type),
+                        literal(False),
+                        literal(broadcast.id),
+                        literal(1),
+                        literal(now),
+                    ).where(*targets, User.id > cursor, User.id <= user_ids[-1]),
+                )
+            )
+
+            in_chunk = (
+                Notification.broadcast_id == broadcast.id,
+                Notification.user_id > cursor,
+                Notification.user_id <= user_ids[-1],
+            )
+            db.execute(
+                insert(NotificationOutbox).from_select(
+                    ["notification_id", "user_id", "status", "attempts", "created_at"],
+                    select(Notification.id, Notification.user_id, literal(OUTBOX_OFFLINE), literal(0), literal(now)).where(*in_chunk),
+                )
+            )
+            db.execute(
+                insert(SyncChange).from_select(
+                    ["user_id", "entity_type", "entity_id", "created_at"],
+                    select(Notification.user_id, literal(CHANGE_NOTIFICATION), Notification.id, literal(now)).where(*in_chunk),
+                )
+            )
+            db.execute(
+                update(NotificationCounter)
+                .where(NotificationCounter.user_id.in_(select(Notification.user_id).where(*in_chunk)))
+                .values(unread_count=NotificationCounter.unread_count + 1, version=NotificationCounter.version + 1),
+                execution_options={"synchronize_session": False},
+            )
+            recipients = [
+                [user_id, notification_id, unread_count, outbox_id]
+                for user_id, notification_id, unread_count, outbox_id in db.query(
+                    Notification.user_id, Notification.id, NotificationCounter.unread_count, NotificationOutbox.id
+                )
+                .join(NotificationOutbox, NotificationOutbox.notification_id == Notification.id)
+                .outerjoin(NotificationCounter, NotificationCounter.user_id == Notification.user_id)
+                .filter(*in_chunk)
+            ]
+
+            # В сокеты - только тем, у кого включены мгновенные уведомления и не тихие часы.
+            # Остальные увидят рассылку в списке уведомлений
+            preferences = self.preferences.get_many(db, [recipient[0] for recipient in recipients])
+            suppressed = [recipient[3] for recipient in recipients if not preferences[recipient[0]].realtime]
+            if suppressed:
+                db.execute(
+                    update(NotificationOutbox)
+                    .where(NotificationOutbox.id.in_(suppressed))
+                    .values(status=OUTBOX_SUPPRESSED),
+                    execution_options={"synchronize_session": False},
+                )
+                self.filtered["suppressed"] += len(suppressed)
+
+            # Тихие часы: строка ждет диспетчера до их окончания, а не отправляется при подключении
+            deferred: Dict[datetime, List[int]] = {}
+            for recipient in recipients:
+                recipient_preferences = preferences[recipient[0]]
+                if recipient_preferences.realtime and recipient_preferences.in_quiet_hours(now):
+                    deferred.setdefault(recipient_preferences.quiet_hours_end_after(now), []).append(recipient[3])
+            for quiet_end, outbox_ids in deferred.items():
+                db.execute(
+                    update(NotificationOutbox)
+                    .where(NotificationOutbox.id.in_(outbox_ids))
+                    .values(status=OUTBOX_PENDING, next_attempt_at=quiet_end),
+                    execution_options={"synchronize_session": False},
+                )
+                self.filtered["deferred"] += len(outbox_ids)
+
+            broadcast.last_user_id = user_ids[-1]
+            broadcast.processed_users += len(recipients)
+            db.commit()
+
+            recipients = [
+                recipient for recipient in recipients
+                if preferences[recipient[0]].realtime and not preferences[recipient[0]].in_quiet_hours(now)
+            ]
+
+            return {
+                "notification": {
+                    "title": broadcast.title,
+                    "message": broadcast.message,
+                    "type": broadcast.type,
+                    "related_id": None,
+                    "created_at": now.isoformat(),
+                    "is_viewed": False,
+                    "collapse_count": 1,
+                    "updated_at": None,
+                },
+                "recipients": recipients,
+            }
+
+    def _set_broadcast_status(self, broadcast_id: int, status: str, delivered: int = 0, error: Optional[str] = None) -> None:
+        with self.session_factory() as db:
+            broadcast = db.get(NotificationBroadcast, broadcast_id, with_for_update=True)
+            broadcast.status = status
+            # Рассылку могли продолжать несколько воркеров (после перезапуска) - доставки суммируются
+            broadcast.delivered = (broadcast.delivered or 0) + delivered
+            broadcast.error = error
+            if status == BROADCAST_RUNNING:
+                broadcast.started_at = broadcast.started_at or datetime.utcnow()
+            else:
+                broadcast.finished_at = datetime.utcnow()
+            db.commit()
+
+    async def run_broadcast(self, broadcast_id: int, chunk_size: int = BROADCAST_CHUNK_SIZE) -> int:
+        """
+        Выполняет рассылку пачками. Каждая пачка публикуется в шину одним событием,
+        и воркеры доставляют его только подключенным получателям; остальные увидят
+        уведомление при подключении среди непрочитанных. Возвращает число доставок.
+        """
+        await asyncio.to_thread(self._set_broadcast_status, broadcast_id, BROADCAST_RUNNING)
+        delivered = 0
+        try:
+            while True:
+                chunk = await asyncio.to_thread(self._insert_broadcast_chunk, broadcast_id, chunk_size)
+                if chunk is None:
+                    break
+                delivered += await self.bus.publish(broadcast_channel(broadcast_id), chunk)
+        except Exception as e:
+            print(f"[Notifications] Ошибка рассылки {broadcast_id}: {str(e)}")
+            await asyncio.to_thread(self._set_broadcast_status, broadcast_id, BROADCAST_FAILED, delivered, str(e)[:1000])
+            return delivered
+
+        await asyncio.to_thread(self._set_broadcast_status, broadcast_id, BROADCAST_COMPLETED, delivered)
+        print(f"[Notifications] Рассылка {broadcast_id} завершена, доставлено в соединения: {delivered}")
+        return delivered
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "broadcasts_running": len(self._broadcasts),
+            "dedupe_cache_size": len(self.delivered_cache),
+            "dedupe_cache_hits": self.delivered_cache.hits,
+            "retry_queue_size": len(self.retry_scheduler),
+            "retries_scheduled": self.retry_scheduler.scheduled,
+            "retries_fired": self.retry_scheduler.fired,
+            "retries_cancelled": self.retry_scheduler.cancelled,
+            "preferences_cache_size": len(self.preferences),
+            "preferences_cache_hits": self.preferences.hits,
+            "preferences_cache_misses": self.preferences.misses,
+            **self.filtered,
+            **self._counters,
+        }
+
+
+# Диспетчер процесса: запускается при старте приложения
+notification_dispatcher = NotificationDispatcher()
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_dispatcher_after_commit(session: Session) -> None:
+    # Новые уведомления доставляются сразу после коммита, без ожидания таймера
+    if session.info.pop(_OUTBOX_SESSION_FLAG, False):
+        notification_dispatcher.wake()
+
+
+@event.listens_for(Session, "after_rollback")
+def _reset_outbox_flag(session: Session) -> None:
+    session.info.pop(_OUTBOX_SESSION_FLAG, None)
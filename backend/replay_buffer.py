@@ -0,0 +1,112 @@
+# backend/replay_buffer.py
+
+import os
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+# Сколько последних событий хранить на консультацию и сколько консультаций держать в памяти
+REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "200"))
+REPLAY_MAX_CONSULTATIONS = int(os.getenv("WS_REPLAY_MAX_CONSULTATIONS", "10000"))
+
+
+def with_seq(payload: str, seq: int) -> str:
+    """Добавляет номер события в уже закодированный JSON-объект, не перекодируя его"""
+    if not payload.startswith("{"):
+        return payload
+    if payload == "{}":
+        return '{"seq":%d}' % seq
+    return '{"seq":%d,' % seq + payload[1:]
+
+
+class ConsultationReplayBuffer:
+    """
+    Кольцевой буфер последних событий консультации: (seq, JSON-строка).
+    floor - номер, начиная с которого (не включая) буфер полон: все события консультации
+    с seq > floor в нем есть. Номера растут монотонно, но не обязаны идти подряд.
+    """
+
+    def __init__(self, floor: int, size: int = REPLAY_BUFFER_SIZE):
+        self.events: deque = deque(maxlen=size)
+        self.floor = floor
+
+    @property
+    def last_seq(self) -> int:
+        return self.events[-1][0] if self.events else self.floor
+
+    def append(self, seq: int, payload: str) -> None:
+        if len(self.events) == self.events.maxlen:
+            self.floor = self.events[0][0]
+        self.events.append((seq, payload))
+
+    def since(self, last_seq: int) -> List[str]:
+        return [payload for seq, payload in self.events if seq > last_seq]
+
+
+class ReplayRegistry:
+    """
+    Буферы повтора событий консультаций одного воркера.
+    Воркер видит все события консультаций (через шину), поэтому может отдать
+    переподключившемуся клиенту пропущенные события по ?last_seq=.
+    """
+
+    def __init__(self, size: int = REPLAY_BUFFER_SIZE, max_consultations: int = REPLAY_MAX_CONSULTATIONS):
+        self.size = size
+        self.max_consultations = max_consultations
+        self._buffers: "OrderedDict[int, ConsultationReplayBuffer]" = OrderedDict()
+        # Номер, с которого воркер видит события (старт шины)
+        self.start_seq = 0
+        # Наибольший seq среди вытесненных буферов: до него история консультаций без буфера неизвестна
+        self._evicted_floor = 0
+        self.latest_seq = 0
+
+    def reset(self, start_seq: int) -> None:
+        self._buffers.clear()
+        self.start_seq = start_seq
+        self.latest_seq = start_seq
+        self._evicted_floor = 0
+
+    def _unknown_floor(self) -> int:
+        return max(self.start_seq, self._evicted_floor)
+
+    def record(self, consultation_id: int, seq: int, payload: str) -> None:
+        buffer = self._buffers.get(consultation_id)
+        if buffer is None:
+            buffer = ConsultationReplayBuffer(self._unknown_floor(), self.size)
+            self._buffers[consultation_id] = buffer
+            if len(self._buffers) > self.max_consultations:
+                _, evicted = self._buffers.popitem(last=False)
+                self._evicted_floor = max(self._evicted_floor, evicted.last_seq)
+        else:
+            self._buffers.move_to_end(consultation_id)
+
+        buffer.append(seq, payload)
+        if seq > self.latest_seq:
+            self.latest_seq = seq
+
+    def current_seq(self, consultation_id: int) -> int:
+        """Номер последнего события консультации, известный воркеру (для клиента без last_seq)"""
+        buffer = self._buffers.get(consultation_id)
+        return buffer.last_seq if buffer is not None else self.latest_seq
+
+    def since(self, consultation_id: int, last_seq: int) -> Tuple[Optional[List[str]], int]:
+        """
+        События консультации после last_seq.
+        Возвращает (события, текущий seq); события = None, если разрыв больше буфера
+        (или last_seq выдан до перезапуска воркера) - клиенту нужно загрузить историю через API.
+        """
+        buffer = self._buffers.get(consultation_id)
+        current = self.current_seq(consultation_id)
+        floor = buffer.floor if buffer is not None else self._unknown_floor()
+
+        if last_seq < floor or last_seq > self.latest_seq:
+            return None, current
+        if buffer is None:
+            return [], current
+        return buffer.since(last_seq), current
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "consultations": len(self._buffers),
+            "events": sum(len(buffer.events) for buffer in self._buffers.values()),
+            "latest_seq": self.latest_seq,
+        }
@@ -0,0 +1,42 @@
+# backend/search_router.py
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from typing import Any, Dict, Optional
+
+from models import get_db, User, Consultation
+from auth import get_current_user
+from search_service import search_messages
+
+router = APIRouter(prefix="/api/search", tags=["search"])
+
+
+@router.get("/messages", response_model=Dict[str, Any])
+async def search_consultation_messages(
+    q: str = Query(..., min_length=2, max_length=200, description="Поисковый запрос"),
+    consultation_id: Optional[int] = Query(None, description="Искать только в этой консультации"),
+    before_id: Optional[int] = Query(None, ge=1, description="Курсор: next_cursor из предыдущего ответа"),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Поиск по сообщениям консультаций текущего пользователя.
+
+    Каждый элемент содержит фрагмент сообщения (snippet) и позиции найденных
+    слов внутри него (highlights: список [начало, конец)) для подсветки на клиенте.
+    """
+    if consultation_id is not None:
+        consultation = db.query(Consultation).filter(Consultation.id == consultation_id).first()
+        if not consultation:
+            raise HTTPException(status_code=404, detail="Консультация не найдена")
+        if current_user.id not in (consultation.patient_id, consultation.doctor_id):
+            raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+    return search_messages(
+        db,
+        current_user,
+        q,
+        consultation_id=consultation_id,
+        before_id=before_id,
+        limit=limit,
+    )
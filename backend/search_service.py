@@ -0,0 +1,306 @@
+# backend/search_service.py
+
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import select, or_, exists
+from sqlalchemy.orm import Session, aliased
+from models import Consultation, Message, MessageSearchTerm, ArchivedTranscript, User
+from transcript_archive import load_archived_messages
+
+# Минимальная и максимальная длина индексируемого слова
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+
+# Сколько слов запроса учитывать
+MAX_QUERY_TERMS = 5
+
+# Сколько символов контекста показывать вокруг найденного слова
+SNIPPET_RADIUS = 60
+
+# Слово: цифры, латиница (узбекский латинский алфавит с апострофом в o' и g'),
+# кириллица, включая узбекские ў, қ, ғ, ҳ
+_TOKEN_RE = re.compile(r"[0-9a-zа-яёўқғҳ']+")
+
+# Разные варианты апострофа в узбекском тексте приводим к одному
+_APOSTROPHES = {"ʻ": "'", "ʼ": "'", "‘": "'", "’": "'", "`": "'", "´": "'"}
+
+# Окончания для грубого отсечения в словах запроса (от длинных к коротким).
+# Поиск идет по префиксу, поэтому "давления" найдет "давление" и "давлению".
+_CYRILLIC_ENDINGS = sorted([
+    # русские
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ой", "ей", "ий", "ый",
+    "ая", "яя", "ое", "ее", "ые", "ие", "ов", "ев", "ах", "ях", "ам", "ям", "ом", "ем",
+    "ую", "юю", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь",
+    # узбекские (кириллица)
+    "ларнинг", "ларни", "ларда", "лардан", "ларга", "лар", "нинг", "даги", "дан", "да", "га", "ни",
+], key=len, reverse=True)
+
+_LATIN_ENDINGS = sorted([
+    # узбекские (латиница)
+    "larning", "larni", "larda", "lardan", "larga", "lar", "ning", "dagi", "dan", "da", "ga", "ni",
+], key=len, reverse=True)
+
+# Минимальная длина основы после отсечения окончания
+_MIN_STEM_LENGTH = 3
+
+
+def normalize_text(text: str) -> str:
+    """
+    Приводит текст к виду для поиска: нижний регистр, ё -> е, единый апостроф.
+    Длина строки не меняется, поэтому позиции в нормализованном тексте
+    совпадают с позициями в исходном (нужно для подсветки).
+    """
+    chars = []
+    for ch in text:
+        lowered = ch.lower()
+        if len(lowered) != 1:
+            lowered = ch
+        if lowered == "ё":
+            lowered = "е"
+        chars.append(_APOSTROPHES.get(lowered, lowered))
+    return "".join(chars)
+
+
+def tokenize(text: str) -> List[Tuple[str, int, int]]:
+    """Разбивает текст на слова. Возвращает список (слово, начало, конец)"""
+    tokens = []
+    if not text:
+        return tokens
+
+    for match in _TOKEN_RE.finditer(normalize_text(text)):
+        start, end = match.span()
+        token = match.group()
+
+        # Апостроф в начале или конце слова - это кавычка, а не часть слова
+        while token.startswith("'"):
+            token = token[1:]
+            start += 1
+        while token.endswith("'"):
+            token = token[:-1]
+            end -= 1
+
+        if len(token) >= MIN_TERM_LENGTH:
+            tokens.append((token[:MAX_TERM_LENGTH], start, end))
+
+    return tokens
+
+
+def extract_terms(text: str) -> set:
+    """Уникальные слова текста для инвертированного индекса"""
+    return {token for token, _, _ in tokenize(text)}
+
+
+def stem_query_term(term: str) -> str:
+    """Отсекает типичное окончание у слова запроса (русский и узбекский)"""
+    endings = _LATIN_ENDINGS if term[0].isascii() else _CYRILLIC_ENDINGS
+    for ending in endings:
+        if term.endswith(ending) and len(term) - len(ending) >= _MIN_STEM_LENGTH:
+            return term[:-len(ending)]
+    return term
+
+
+def query_stems(query: str) -> List[str]:
+    """Основы слов поискового запроса без повторов"""
+    stems = []
+    for token, _, _ in tokenize(query):
+        stem = stem_query_term(token)
+        if stem not in stems:
+            stems.append(stem)
+    return stems[:MAX_QUERY_TERMS]
+
+
+def index_message(db: Session, message_id: int, consultation_id: int, content: Optional[str]) -> None:
+    """
+    Добавляет слова сообщения в инвертированный индекс.
+    Строки попадают в текущую транзакцию вызывающего кода - commit делает он сам.
+    """
+    for term in extract_terms(content or ""):
+        db.add(MessageSearchTerm(term=term, message_id=message_id, consultation_id=consultation_id))
+
+
+def build_snippet(content: str, stems: Iterable[str]) -> Tuple[str, List[List[int]]]:
+    """
+    Вырезает фрагмент сообщения вокруг первого совпадения.
+
+    Returns:
+        tuple: (фрагмент, список [начало, конец) подсвечиваемых слов внутри фрагмента)
+    """
+    content = content or ""
+    stems = list(stems)
+    hits = [
+        (start, end)
+        for token, start, end in tokenize(content)
+        if any(token.startswith(stem) for stem in stems)
+    ]
+
+    if not hits:
+        snippet = content[:SNIPPET_RADIUS * 2]
+        return (snippet + "..." if len(content) > len(snippet) else snippet), []
+
+    first_start, first_end = hits[0]
+    window_start = max(0, first_start - SNIPPET_RADIUS)
+    window_end = min(len(content), first_end + SNIPPET_RADIUS)
+
+    prefix = "..." if window_start > 0 else ""
+    suffix = "..." if window_end < len(content) else ""
+    offset = len(prefix) - window_start
+
+    highlights = [
+        [start + offset, end + offset]
+        for start, end in hits
+        if start >= window_start and end <= window_end
+    ]
+
+    return prefix + content[window_start:window_end] + suffix, highlights
+
+
+def _load_messages(db: Session, hits: List[Tuple[int, int]]) -> Dict[int, Dict[str, Any]]:
+    """Загружает найденные сообщения из горячей таблицы, а недостающие - из архива"""
+    message_ids = [message_id for message_id, _ in hits]
+    messages = {
+        message.id: {
+            "id": message.id,
+            "consultation_id": message.consultation_id,
+            "sender_id": message.sender_id,
+            "content": message.content,
+            "sent_at": message.sent_at.isoformat() if message.sent_at else None,
+        }
+        for message in db.query(Message).filter(Message.id.in_(message_ids)).all()
+    }
+
+    # Сообщения, которых нет в таблице messages, уже перенесены в архив
+    archived_consultation_ids = {
+        consultation_id for message_id, consultation_id in hits if message_id not in messages
+    }
+    for consultation_id in archived_consultation_ids:
+        for archived in load_archived_messages(db, consultation_id, parse_dates=False):
+            if archived["id"] in message_ids:
+                messages[archived["id"]] = archived
+
+    return messages
+
+
+def search_messages(
+    db: Session,
+    user: User,
+    query: str,
+    consultation_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = 20,
+) -> Dict[str, Any]:
+    """
+    Ищет сообщения в консультациях пользователя. Все слова запроса должны
+    встречаться в сообщении (по префиксу основы). Результаты отсортированы
+    от новых к старым, курсор - id последнего сообщения страницы.
+    """
+    stems = query_stems(query)
+    if not stems:
+        return {"items": [], "next_cursor": None}
+
+    # Начинаем с самой длинной (обычно самой избирательной) основы,
+    # остальные проверяем точечно по message_id
+    ordered = sorted(stems, key=len, reverse=True)
+
+    stmt = (
+        select(MessageSearchTerm.message_id, MessageSearchTerm.consultation_id)
+        .join(Consultation, Consultation.id == MessageSearchTerm.consultation_id)
+        .where(
+            MessageSearchTerm.term.like(f"{ordered[0]}%"),
+            or_(Consultation.patient_id == user.id, Consultation.doctor_id == user.id),
+        )
+    )
+
+    for stem in ordered[1:]:
+        other = aliased(MessageSearchTerm)
+        stmt = stmt.where(
+            exists().where(
+                other.message_id == MessageSearchTerm.message_id,
+                other.term.like(f"{stem}%"),
+            )
+        )
+
+    if consultation_id is not None:
+        stmt = stmt.where(MessageSearchTerm.consultation_id == consultation_id)
+
+    if before_id is not None:
+        stmt = stmt.where(MessageSearchTerm.message_id < before_id)
+
+    hits = db.execute(
+        stmt.distinct()
+        .order_by(MessageSearchTerm.message_id.desc())
+        .limit(limit + 1)
+    ).all()
+
+    has_more = len(hits) > limit
+    hits = [(message_id, hit_consultation_id) for message_id, hit_consultation_id in hits[:limit]]
+
+    messages = _load_messages(db, hits)
+
+    items = []
+    for message_id, hit_consultation_id in hits:
+        message = messages.get(message_id)
+        if not message:
+            continue
+
+        snippet, highlights = build_snippet(message["content"], stems)
+        items.append({
+            "message_id": message_id,
+            "consultation_id": hit_consultation_id,
+            "sender_id": message["sender_id"],
+            "sent_at": message["sent_at"],
+            "snippet": snippet,
+            "highlights": highlights,
+        })
+
+    return {
+        "items": items,
+        "next_cursor": hits[-1][0] if has_more and hits else None,
+    }
+
+
+def backfill_search_index(db: Session, batch_size: int = 1000) -> int:
+    """
+    Строит индекс для уже существующих сообщений, включая архивные.
+    Сообщения, уже попавшие в индекс, пропускаются. Возвращает число проиндексированных сообщений.
+    """
+    indexed = 0
+    last_id = 0
+
+    while True:
+        batch = (
+            db.query(Message.id, Message.consultation_id, Message.content)
+            .filter(
+                Message.id > last_id,
+                ~exists().where(MessageSearchTerm.message_id == Message.id),
+            )
+            .order_by(Message.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+
+        for message_id, message_consultation_id, content in batch:
+            index_message(db, message_id, message_consultation_id, content)
+        db.commit()
+
+        indexed += len(batch)
+        last_id = batch[-1][0]
+
+    # Архивы распаковываем по одному, чтобы не держать в памяти все сразу
+    archived_consultation_ids = [
+        consultation_id for (consultation_id,) in db.query(ArchivedTranscript.consultation_id).all()
+    ]
+    for archived_consultation_id in archived_consultation_ids:
+        already_indexed = {
+            message_id for (message_id,) in db.query(MessageSearchTerm.message_id)
+            .filter(MessageSearchTerm.consultation_id == archived_consultation_id)
+            .distinct()
+        }
+        for message in load_archived_messages(db, archived_consultation_id, parse_dates=False):
+            if message["id"] not in already_indexed:
+                index_message(db, message["id"], archived_consultation_id, message.get("content"))
+                indexed += 1
+        db.commit()
+
+    return indexed
@@ -0,0 +1,244 @@
+# backend/sync_router.py
+from datetime import datetime, timedelta
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import func
+from sqlalchemy.orm import Session, selectinload
+from typing import Any, Dict, Optional
+
+from models import get_db, User, Consultation, Message, Notification, SyncChange
+from auth import get_current_user
+from sync_service import (
+    CHANGE_CONSULTATION,
+    CHANGE_MESSAGE,
+    CHANGE_READ,
+    CHANGE_NOTIFICATION,
+    CHANGE_NOTIFICATIONS_READ,
+    SYNC_CURSOR_LAG_SECONDS,
+    get_purge_watermark,
+)
+
+router = APIRouter(prefix="/api/sync", tags=["sync"])
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def _serialize_consultation(consultation: Consultation) -> Dict[str, Any]:
+    return {
+        "id": consultation.id,
+        "patient_id": consultation.patient_id,
+        "doctor_id": consultation.doctor_id,
+        "status": consultation.status,
+        "created_at": _iso(consultation.created_at),
+        "started_at": _iso(consultation.started_at),
+        "completed_at": _iso(consultation.completed_at),
+        "message_limit": consultation.message_limit,
+        "message_count": consultation.message_count,
+        "patient_note": consultation.patient_note,
+    }
+
+
+def _serialize_message(message: Message) -> Dict[str, Any]:
+    return {
+        "id": message.id,
+        "consultation_id": message.consultation_id,
+        "sender_id": message.sender_id,
+        "content": message.content,
+        "sent_at": _iso(message.sent_at),
+        "is_read": message.is_read,
+        "sender_role": message.sender_role,
+        "receiver_id": message.receiver_id,
+        "receiver_role": message.receiver_role,
+        "attachments": [
+            {
+                "id": att.id,
+                "filename": att.filename,
+                "file_path": att.file_path,
+                "file_size": att.file_size,
+                "content_type": att.content_type,
+                "uploaded_at": _iso(att.uploaded_at),
+            }
+            for att in message.attachments
+        ],
+    }
+
+
+def _serialize_notification(notification: Notification) -> Dict[str, Any]:
+    return {
+        "id": notification.id,
+        "title": notification.title,
+        "message": notification.message,
+        "type": notification.type,
+        "related_id": notification.related_id,
+        "created_at": _iso(notification.created_at),
+        "is_viewed": notification.is_viewed,
+        "collapse_count": notification.collapse_count,
+        "updated_at": _iso(notification.updated_at),
+    }
+
+
+def _settled_cursor(db: Session, user_id: int, horizon: datetime) -> int:
+    """Текущий курсор пользователя: перед ним нет записей моложе окна запаздывания"""
+    query = db.query(func.max(SyncChange.id)).filter(SyncChange.user_id == user_id)
+    youngest_id = (
+        db.query(func.min(SyncChange.id))
+        .filter(SyncChange.user_id == user_id, SyncChange.created_at > horizon)
+        .scalar()
+    )
+    if youngest_id is not None:
+        query = query.filter(SyncChange.id < youngest_id)
+    return query.scalar() or 0
+
+
+@router.get("", response_model=Dict[str, Any])
+async def sync_changes(
+    since: Optional[int] = Query(None, ge=0, description="Курсор, полученный в предыдущем ответе"),
+    limit: int = Query(500, ge=1, le=2000, description="Максимальное количество записей журнала за один ответ"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    Дельта-синхронизация для мобильных клиентов.
+
+    Возвращает все, что изменилось для текущего пользователя после курсора `since`:
+    новые и обновленные консультации, новые сообщения, изменения отметок о прочтении
+    и уведомления. Всё собирается фиксированным набором запросов, независимо от объема.
+
+    Без `since` возвращается только текущий курсор - клиент загружает начальное
+    состояние обычными эндпоинтами и дальше синхронизируется с этого курсора.
+    Если `has_more` равно true, нужно повторить запрос с новым курсором.
+
+    Курсор не сдвигается дальше изменений моложе SYNC_CURSOR_LAG_SECONDS: транзакция
+    с меньшим id могла еще не закоммититься. Такие изменения отдаются и в следующем
+    ответе - клиент должен применять их идемпотентно (по id объектов).
+
+    Если курсор старше хранимой части журнала, возвращается `full_resync: true`
+    и новый курсор: клиент загружает состояние заново, как при первом запуске.
+    """
+    response = {
+        "cursor": since or 0,
+        "has_more": False,
+        "full_resync": False,
+        "consultations": [],
+        "messages": [],
+        "read_watermarks": [],
+        "notifications": [],
+        "notifications_read_up_to": None,
+    }
+
+    horizon = datetime.utcnow() - timedelta(seconds=SYNC_CURSOR_LAG_SECONDS)
+
+    if since is None:
+        response["cursor"] = _settled_cursor(db, current_user.id, horizon)
+        return response
+
+    # Записи после курсора уже удалены очисткой журнала - дельту собрать нельзя.
+    # Граница хранится отдельно: минимальный id оставшихся записей ее не дает (записи
+    # удаляются по created_at, а пустой журнал не означает, что изменения были удалены)
+    if since < get_purge_watermark(db):
+        response["full_resync"] = True
+        response["cursor"] = _settled_cursor(db, current_user.id, horizon)
+        return response
+
+    changes = (
+        db.query(SyncChange)
+        .filter(SyncChange.user_id == current_user.id, SyncChange.id > since)
+        .order_by(SyncChange.id)
+        .limit(limit + 1)
+        .all()
+    )
+
+    truncated = len(changes) > limit
+    changes = changes[:limit]
+
+    if not changes:
+        return response
+
+    # Курсор - последняя запись, перед которой нет записей моложе окна запаздывания
+    settled = True
+    for change in changes:
+        if change.created_at is not None and change.created_at > horizon:
+            settled = False
+            break
+        response["cursor"] = change.id
+    response["has_more"] = truncated and settled
+
+    # Группируем записи журнала по типам, чтобы загрузить данные пакетно
+    consultation_ids = set()
+    message_ids = set()
+    read_pairs = set()
+    notification_ids = set()
+    notifications_read_up_to = None
+
+    for change in changes:
+        if change.entity_type == CHANGE_CONSULTATION:
+            consultation_ids.add(change.entity_id)
+        elif change.entity_type == CHANGE_MESSAGE:
+            message_ids.add(change.entity_id)
+        elif change.entity_type == CHANGE_READ:
+            read_pairs.add((change.consultation_id, change.entity_id))
+        elif change.entity_type == CHANGE_NOTIFICATION:
+            notification_ids.add(change.entity_id)
+        elif change.entity_type == CHANGE_NOTIFICATIONS_READ:
+            notifications_read_up_to = max(notifications_read_up_to or 0, change.entity_id)
+
+    if consultation_ids:
+        consultations = (
+            db.query(Consultation)
+            .filter(Consultation.id.in_(consultation_ids))
+            .all()
+        )
+        response["consultations"] = [_serialize_consultation(c) for c in consultations]
+
+    if message_ids:
+        messages = (
+            db.query(Message)
+            .options(selectinload(Message.attachments))
+            .filter(Message.id.in_(message_ids))
+            .order_by(Message.id)
+            .all()
+        )
+        response["messages"] = [_serialize_message(m) for m in messages]
+
+    if read_pairs:
+        # Отметка о прочтении передается как "водяной знак": до какого сообщения прочитал участник
+        read_consultation_ids = {consultation_id for consultation_id, _ in read_pairs}
+        watermarks = (
+            db.query(
+                Message.consultation_id,
+                Message.receiver_id,
+                func.max(Message.id),
+            )
+            .filter(
+                Message.consultation_id.in_(read_consultation_ids),
+                Message.is_read == True,
+            )
+            .group_by(Message.consultation_id, Message.receiver_id)
+            .all()
+        )
+        response["read_watermarks"] = [
+            {
+                "consultation_id": consultation_id,
+                "reader_id": reader_id,
+                "last_read_message_id": last_read_id,
+            }
+            for consultation_id, reader_id, last_read_id in watermarks
+            if (consultation_id, reader_id) in read_pairs
+        ]
+
+    if notification_ids:
+        notifications = (
+            db.query(Notification)
+            .filter(
+                Notification.id.in_(notification_ids),
+                Notification.user_id == current_user.id,
+            )
+            .order_by(Notification.id)
+            .all()
+        )
+        response["notifications"] = [_serialize_notification(n) for n in notifications]
+
+    response["notifications_read_up_to"] = notifications_read_up_to
+
+    return response
@@ -0,0 +1,73 @@
+# backend/sync_service.py
+import os
+from typing import Iterable, Optional
+from sqlalchemy.orm import Session
+from models import SyncChange, SyncRetentionState, Consultation
+
+# Сколько дней хранится журнал изменений. Клиент с курсором старше хранимого
+# диапазона получает full_resync и загружает состояние заново
+SYNC_RETENTION_DAYS = int(os.getenv("SYNC_RETENTION_DAYS", "30"))
+
+# Окно запаздывания курсора в секундах. id записи журнала выдается при вставке,
+# а видна она становится после коммита, поэтому транзакции могут стать видимыми
+# не в порядке id. Курсор не сдвигается дальше записей моложе этого окна: они
+# отдаются повторно, пока не "устоятся". Окно должно быть больше времени самой долгой транзакции
+SYNC_CURSOR_LAG_SECONDS = int(os.getenv("SYNC_CURSOR_LAG_SECONDS", "10"))
+
+# Типы записей журнала изменений
+CHANGE_CONSULTATION = "consultation"
+CHANGE_MESSAGE = "message"
+CHANGE_READ = "read"
+CHANGE_NOTIFICATION = "notification"
+CHANGE_NOTIFICATIONS_READ = "notifications_read"
+
+
+def record_change(
+    db: Session,
+    user_ids: Iterable[int],
+    entity_type: str,
+    entity_id: int,
+    consultation_id: Optional[int] = None,
+) -> None:
+    """
+    Добавляет запись в журнал изменений для каждого из пользователей.
+    Запись попадает в текущую транзакцию вызывающего кода - commit делает он сам,
+    поэтому журнал всегда согласован с изменением данных.
+    """
+    for user_id in set(user_ids):
+        if user_id is None:
+            continue
+        db.add(SyncChange(
+            user_id=user_id,
+            entity_type=entity_type,
+            entity_id=entity_id,
+            consultation_id=consultation_id,
+        ))
+
+
+def record_consultation_change(db: Session, consultation: Consultation, entity_type: str = CHANGE_CONSULTATION, entity_id: Optional[int] = None) -> None:
+    """Записывает изменение для обоих участников консультации"""
+    record_change(
+        db,
+        [consultation.patient_id, consultation.doctor_id],
+        entity_type,
+        consultation.id if entity_id is None else entity_id,
+        consultation_id=consultation.id,
+    )
+
+
+def get_purge_watermark(db: Session) -> int:
+    """Наибольший id записи журнала, удаленной очисткой (0 - журнал еще не очищался)"""
+    return db.query(SyncRetentionState.purged_up_to_id).filter(SyncRetentionState.id == 1).scalar() or 0
+
+
+def advance_purge_watermark(db: Session, purged_up_to_id: int) -> None:
+    """
+    Сдвигает границу удаленной части журнала в текущей транзакции (только вперед).
+    Вызывается в той же транзакции, что и удаление записей.
+    """
+    state = db.get(SyncRetentionState, 1, with_for_update=True)
+    if state is None:
+        db.add(SyncRetentionState(id=1, purged_up_to_id=purged_up_to_id))
+    elif state.purged_up_to_id < purged_up_to_id:
+        state.purged_up_to_id = purged_up_to_id
@@ -0,0 +1,11 @@
+# backend/tests/conftest.py
+
+import os
+import sys
+
+# Тесты работают с базой SQLite в памяти: models читает TEST_DATABASE_URL при импорте,
+# поэтому переменная задается до импорта модулей бэкенда
+os.environ.setdefault("TEST_DATABASE_URL", "sqlite://")
+
+# Модули бэкенда импортируются по имени (from event_bus import ...), как в main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,244 @@
+# backend/tests/test_event_bus.py
+
+import asyncio
+import pytest
+from fast_json import dumps, loads
+from event_bus import (
+    EventBus,
+    InProcessEventBus,
+    MySQLPollingEventBus,
+    RedisEventBus,
+    user_channel,
+    consultation_channel,
+    call_channel,
+)
+
+
+class FakeManager:
+    """ConnectionManager без сокетов: запоминает, что и куда было отправлено"""
+
+    def __init__(self, connected_users=()):
+        self.connected_users = set(connected_users)
+        self.sent = []
+
+    async def send_to_user(self, user_id, payload, kinds=None):
+        if user_id not in self.connected_users:
+            return 0
+        self.sent.append(("user", user_id, payload))
+        return 1
+
+    async def send_to_consultation(self, consultation_id, payload):
+        self.sent.append(("consultation", consultation_id, payload))
+        return 1
+
+    async def send_to_call(self, call_id, user_id, payload):
+        self.sent.append(("call", call_id, user_id, payload))
+        return 1
+
+    def user_connections(self, user_id, kinds=None):
+        return ["ws"] if user_id in self.connected_users else []
+
+    async def send_to_connections(self, connections, payload):
+        return len(list(connections))
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.queue = asyncio.Queue()
+        self.patterns = []
+
+    async def psubscribe(self, pattern):
+        self.patterns.append(pattern)
+        self.redis.subscribers.append(self)
+
+    async def punsubscribe(self):
+        self.redis.subscribers.remove(self)
+
+    async def close(self):
+        pass
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+
+class FakeRedis:
+    """Минимальный клиент redis.asyncio: get/incr и pub/sub по шаблону"""
+
+    def __init__(self):
+        self.values = {}
+        self.subscribers = []
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def incr(self, key):
+        self.values[key] = int(self.values.get(key) or 0) + 1
+        return self.values[key]
+
+    async def publish(self, channel, data):
+        for pubsub in self.subscribers:
+            pubsub.queue.put_nowait({"type": "pmessage", "channel": channel, "data": data})
+        return len(self.subscribers)
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+
+async def _settle():
+    # Слушатель Redis доставляет события в отдельной задаче
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_event_bus_is_abstract():
+    with pytest.raises(TypeError):
+        EventBus(FakeManager())
+
+
+def test_in_process_publish_and_seq():
+    async def scenario():
+        manager = FakeManager(connected_users={1})
+        bus = InProcessEventBus(manager)
+
+        assert await bus.publish(user_channel(1), {"type": "ping"}) == 1
+        assert await bus.publish(user_channel(2), {"type": "ping"}) == 0
+        assert await bus.publish(call_channel(5), {"type": "offer"}, user_id=1) == 1
+
+        await bus.publish(consultation_channel(7), {"type": "message", "id": 1})
+        await bus.publish(consultation_channel(7), {"type": "message", "id": 2})
+        return manager, bus
+
+    manager, bus = asyncio.run(scenario())
+
+    assert manager.sent[0] == ("user", 1, '{"type":"ping"}')
+    assert manager.sent[1][:3] == ("call", 5, 1)
+
+    seqs = [loads(payload)["seq"] for scope, _, payload in manager.sent[2:]]
+    assert seqs[1] == seqs[0] + 1
+
+    events, current = bus.replay.since(7, seqs[0])
+    assert current == seqs[1]
+    assert [loads(payload)["id"] for payload in events] == [2]
+
+
+def test_ephemeral_events_skip_seq_and_replay():
+    async def scenario():
+        manager = FakeManager()
+        bus = InProcessEventBus(manager)
+        await bus.publish(consultation_channel(7), {"type": "message", "id": 1})
+        await bus.publish(consultation_channel(7), {"type": "ephemeral_update"}, ephemeral=True)
+        return manager, bus
+
+    manager, bus = asyncio.run(scenario())
+
+    first_seq = loads(manager.sent[0][2])["seq"]
+    assert "seq" not in loads(manager.sent[1][2])
+    events, current = bus.replay.since(7, first_seq - 1)
+    assert current == first_seq
+    assert [loads(payload)["type"] for payload in events] == ["message"]
+
+
+def test_in_process_confirms_only_local_delivery():
+    async def scenario():
+        bus = InProcessEventBus(FakeManager(connected_users={1}))
+        confirmed = []
+
+        async def handler(acks):
+            confirmed.extend(acks)
+
+        bus.delivery_handler = handler
+        await bus.publish(user_channel(1), {"type": "new_notification"}, acks=[[10, 100, 1, "claim"]])
+        await bus.publish(user_channel(2), {"type": "new_notification"}, acks=[[11, 101, 1, "claim"]])
+        return confirmed
+
+    assert asyncio.run(scenario()) == [[10, 100, 1, "claim"]]
+
+
+def test_redis_publish_subscribe_and_seq():
+    async def scenario():
+        client = FakeRedis()
+        client.values["test:seq"] = 41
+        manager = FakeManager(connected_users={1})
+        bus = RedisEventBus(client=client, prefix="test:", manager=manager)
+        await bus.start()
+
+        published = [
+            await bus.publish(user_channel(1), {"type": "ping"}),
+            await bus.publish(user_channel(2), {"type": "ping"}),
+            await bus.publish(consultation_channel(7), {"type": "message", "id": 1}),
+            await bus.publish(consultation_channel(7), {"type": "message", "id": 2}),
+        ]
+        await _settle()
+        await bus.stop()
+        return client, manager, bus, published
+
+    client, manager, bus, published = asyncio.run(scenario())
+
+    # Распределенная шина сообщает только о передаче события, а не о доставке
+    assert published == [1, 1, 1, 1]
+    assert bus.distributed
+    assert manager.sent[0] == ("user", 1, '{"type":"ping"}')
+
+    # seq выдается общим счетчиком Redis и продолжает его значение на момент старта
+    seqs = [loads(payload)["seq"] for scope, _, payload in manager.sent[1:]]
+    assert seqs == [42, 43]
+    assert client.values["test:seq"] == 43
+
+    events, current = bus.replay.since(7, 42)
+    assert current == 43
+    assert [loads(payload)["id"] for payload in events] == [2]
+
+
+def test_redis_confirms_on_delivering_worker():
+    async def scenario():
+        client = FakeRedis()
+        sender = RedisEventBus(client=client, prefix="test:", manager=FakeManager())
+        receiver = RedisEventBus(client=client, prefix="test:", manager=FakeManager(connected_users={1}))
+        confirmed = {"sender": [], "receiver": []}
+
+        def handler(name):
+            async def confirm(acks):
+                confirmed[name].extend(acks)
+            return confirm
+
+        sender.delivery_handler = handler("sender")
+        receiver.delivery_handler = handler("receiver")
+        await sender.start()
+        await receiver.start()
+
+        await sender.publish(user_channel(1), {"type": "new_notification"}, acks=[[10, 100, 1, "claim"]])
+        await _settle()
+        await sender.stop()
+        await receiver.stop()
+        return confirmed
+
+    assert asyncio.run(scenario()) == {"sender": [], "receiver": [[10, 100, 1, "claim"]]}
+
+
+def test_mysql_poller_rereads_late_committed_ids():
+    # Таблица realtime_events, в которой строка 2 закоммичена позже строки 3
+    visible = {1: {"type": "a"}, 3: {"type": "c"}}
+    manager = FakeManager(connected_users={1})
+    bus = MySQLPollingEventBus(session_factory=None, manager=manager)
+
+    def fetch(after_id, gap_ids):
+        return [
+            (event_id, dumps(bus.build_event(user_channel(1), payload)))
+            for event_id, payload in sorted(visible.items())
+            if event_id > after_id or event_id in gap_ids
+        ]
+
+    bus._fetch = fetch
+
+    async def scenario():
+        await bus.poll_once()
+        visible[2] = {"type": "b"}
+        await bus.poll_once()
+        await bus.poll_once()
+
+    asyncio.run(scenario())
+
+    assert [loads(payload)["type"] for _, _, payload in manager.sent] == ["a", "c", "b"]
+    assert bus._gaps == {}
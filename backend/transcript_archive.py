@@ -0,0 +1,236 @@
+# backend/transcript_archive.py
+
+import os
+import json
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from sqlalchemy.orm import Session, selectinload
+from models import Consultation, Message, MessageAttachment, ArchivedTranscript, SessionLocal
+
+# zstandard - необязательная зависимость: без нее архив сжимается через zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Через сколько дней после завершения консультации переписка переносится в архив
+ARCHIVE_AFTER_DAYS = int(os.getenv("TRANSCRIPT_ARCHIVE_AFTER_DAYS", "90"))
+
+# Сколько консультаций архивировать за один проход
+ARCHIVE_BATCH_SIZE = int(os.getenv("TRANSCRIPT_ARCHIVE_BATCH_SIZE", "50"))
+
+# Интервал фоновой архивации в секундах (по умолчанию раз в 6 часов)
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("TRANSCRIPT_ARCHIVE_INTERVAL_SECONDS", str(6 * 60 * 60)))
+
+# Уровень сжатия zstd
+ZSTD_LEVEL = 10
+
+# Длина превью последнего сообщения, сохраняемого рядом с архивом
+PREVIEW_LENGTH = 255
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def compress_transcript(messages: List[Dict[str, Any]]) -> tuple:
+    """
+    Сериализует сообщения в JSON и сжимает их.
+
+    Returns:
+        tuple: (кодек, сжатые байты, размер JSON до сжатия)
+    """
+    raw = json.dumps(messages, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw), len(raw)
+
+    return "zlib", zlib.compress(raw, 9), len(raw)
+
+
+def decompress_transcript(codec: str, payload: bytes) -> List[Dict[str, Any]]:
+    """Распаковывает архив переписки обратно в список сообщений"""
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Для чтения архива требуется пакет zstandard")
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == "zlib":
+        raw = zlib.decompress(payload)
+    else:
+        raise ValueError(f"Неизвестный кодек архива: {codec}")
+
+    return json.loads(raw.decode("utf-8"))
+
+
+def serialize_message(message: Message) -> Dict[str, Any]:
+    """Преобразует сообщение с вложениями в словарь для архива"""
+    return {
+        "id": message.id,
+        "consultation_id": message.consultation_id,
+        "sender_id": message.sender_id,
+        "content": message.content,
+        "sent_at": _iso(message.sent_at),
+        "is_read": message.is_read,
+        "sender_role": message.sender_role,
+        "receiver_id": message.receiver_id,
+        "receiver_role": message.receiver_role,
+        "attachments": [
+            {
+                "id": att.id,
+                "filename": att.filename,
+                "file_path": att.file_path,
+                "file_size": att.file_size,
+                "content_type": att.content_type,
+                "uploaded_at": _iso(att.uploaded_at),
+            }
+            for att in message.attachments
+            if att.message_id != 0
+        ],
+    }
+
+
+def archive_consultation(db: Session, consultation: Consultation) -> Optional[ArchivedTranscript]:
+    """
+    Переносит переписку консультации в архив и удаляет ее из горячих таблиц.
+    Все изменения выполняются в текущей транзакции, commit делает вызывающий код.
+    """
+    messages = (
+        db.query(Message)
+        .options(selectinload(Message.attachments))
+        .filter(Message.consultation_id == consultation.id)
+        .order_by(Message.id)
+        .all()
+    )
+
+    serialized = [serialize_message(message) for message in messages]
+    codec, payload, original_size = compress_transcript(serialized)
+
+    last_message = messages[-1] if messages else None
+
+    archive = ArchivedTranscript(
+        consultation_id=consultation.id,
+        codec=codec,
+        payload=payload,
+        message_count=len(serialized),
+        attachment_count=sum(len(item["attachments"]) for item in serialized),
+        original_size=original_size,
+        compressed_size=len(payload),
+        last_message_at=last_message.sent_at if last_message else None,
+        last_message_preview=last_message.content[:PREVIEW_LENGTH] if last_message else None,
+        last_message_sender_id=last_message.sender_id if last_message else None,
+    )
+    db.add(archive)
+
+    # Удаляем горячие данные одним запросом на таблицу
+    if messages:
+        message_ids = [message.id for message in messages]
+        db.query(MessageAttachment).filter(
+            MessageAttachment.message_id.in_(message_ids)
+        ).delete(synchronize_session=False)
+        db.query(Message).filter(
+            Message.id.in_(message_ids)
+        ).delete(synchronize_session=False)
+
+    consultation.archived_at = datetime.utcnow()
+    return archive
+
+
+def archive_completed_consultations(
+    db: Session,
+    older_than_days: int = ARCHIVE_AFTER_DAYS,
+    batch_size: int = ARCHIVE_BATCH_SIZE,
+) -> Dict[str, int]:
+    """
+    Архивирует переписку консультаций, завершенных более older_than_days дней назад.
+    Каждая консультация архивируется в отдельной транзакции, чтобы не держать долгих блокировок.
+
+    Returns:
+        dict: статистика прохода (консультации, сообщения, байты до и после сжатия, ошибки)
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+    candidates = (
+        db.query(Consultation.id)
+        .filter(
+            Consultation.status == "completed",
+            Consultation.completed_at < cutoff,
+            Consultation.archived_at.is_(None),
+        )
+        .order_by(Consultation.completed_at)
+        .limit(batch_size)
+        .all()
+    )
+
+    stats = {
+        "consultations": 0,
+        "messages": 0,
+        "attachments": 0,
+        "original_bytes": 0,
+        "compressed_bytes": 0,
+        "errors": 0,
+    }
+
+    for (consultation_id,) in candidates:
+        try:
+            # Повторно берем консультацию с блокировкой: она могла измениться
+            consultation = (
+                db.query(Consultation)
+                .filter(Consultation.id == consultation_id, Consultation.archived_at.is_(None))
+                .with_for_update()
+                .first()
+            )
+            if not consultation:
+                db.rollback()
+                continue
+
+            archive = archive_consultation(db, consultation)
+            db.commit()
+
+            stats["consultations"] += 1
+            stats["messages"] += archive.message_count
+            stats["attachments"] += archive.attachment_count
+            stats["original_bytes"] += archive.original_size
+            stats["compressed_bytes"] += archive.compressed_size
+        except Exception as e:
+            db.rollback()
+            stats["errors"] += 1
+            print(f"[Archive] Ошибка при архивации консультации {consultation_id}: {str(e)}")
+
+    return stats
+
+
+def run_archive_batch(older_than_days: int = ARCHIVE_AFTER_DAYS) -> Dict[str, int]:
+    """Выполняет один проход архивации в собственной сессии (для фоновых задач)"""
+    with SessionLocal() as db:
+        return archive_completed_consultations(db, older_than_days=older_than_days)
+
+
+def load_archived_messages(db: Session, consultation_id: int, parse_dates: bool = True) -> List[Dict[str, Any]]:
+    """
+    Восстанавливает сообщения консультации из архива.
+    По умолчанию даты возвращаются объектами datetime, как у сообщений из таблицы messages;
+    при parse_dates=False остаются ISO-строками (для ответов, которые и так сериализуют даты).
+    """
+    archive = (
+        db.query(ArchivedTranscript)
+        .filter(ArchivedTranscript.consultation_id == consultation_id)
+        .first()
+    )
+    if not archive:
+        return []
+
+    messages = decompress_transcript(archive.codec, archive.payload)
+    if not parse_dates:
+        return messages
+
+    for message in messages:
+        message["sent_at"] = _parse_datetime(message.get("sent_at"))
+        for attachment in message.get("attachments", []):
+            attachment["uploaded_at"] = _parse_datetime(attachment.get("uploaded_at"))
+
+    return messages
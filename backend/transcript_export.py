@@ -0,0 +1,173 @@
+# backend/transcript_export.py
+
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import Consultation, Message, MessageAttachment, SessionLocal
+from transcript_archive import load_archived_messages
+
+# Сколько строк забирать с сервера БД за раз (серверный курсор)
+EXPORT_YIELD_PER = 500
+
+# Размер отправляемого клиенту куска. Отдавать каждую строку отдельно дорого:
+# StreamingResponse вызывает синхронный генератор через пул потоков на каждый элемент
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def _dumps(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _serialize_consultation(consultation: Consultation) -> Dict[str, Any]:
+    return {
+        "id": consultation.id,
+        "patient_id": consultation.patient_id,
+        "doctor_id": consultation.doctor_id,
+        "status": consultation.status,
+        "created_at": _iso(consultation.created_at),
+        "started_at": _iso(consultation.started_at),
+        "completed_at": _iso(consultation.completed_at),
+        "message_count": consultation.message_count,
+        "archived": consultation.archived_at is not None,
+    }
+
+
+def _iter_live_messages(db: Session, consultation_id: int) -> Iterator[Dict[str, Any]]:
+    """
+    Потоково читает сообщения консультации вместе с вложениями одним запросом.
+    Строки приходят через серверный курсор, поэтому память не зависит от размера переписки.
+    Пока курсор открыт, другие запросы в этой сессии выполнять нельзя.
+    """
+    stmt = (
+        select(
+            Message.id,
+            Message.sender_id,
+            Message.sender_role,
+            Message.receiver_id,
+            Message.receiver_role,
+            Message.content,
+            Message.sent_at,
+            Message.is_read,
+            MessageAttachment.id,
+            MessageAttachment.filename,
+            MessageAttachment.file_path,
+            MessageAttachment.file_size,
+            MessageAttachment.content_type,
+            MessageAttachment.uploaded_at,
+        )
+        .outerjoin(MessageAttachment, MessageAttachment.message_id == Message.id)
+        .where(Message.consultation_id == consultation_id)
+        .order_by(Message.id, MessageAttachment.id)
+        .execution_options(stream_results=True, yield_per=EXPORT_YIELD_PER)
+    )
+
+    current = None
+    for row in db.execute(stmt):
+        (
+            message_id, sender_id, sender_role, receiver_id, receiver_role, content, sent_at, is_read,
+            attachment_id, filename, file_path, file_size, content_type, uploaded_at,
+        ) = row
+
+        if current is None or current["id"] != message_id:
+            if current is not None:
+                yield current
+            current = {
+                "id": message_id,
+                "consultation_id": consultation_id,
+                "sender_id": sender_id,
+                "content": content,
+                "sent_at": _iso(sent_at),
+                "is_read": is_read,
+                "sender_role": sender_role,
+                "receiver_id": receiver_id,
+                "receiver_role": receiver_role,
+                "attachments": [],
+            }
+
+        if attachment_id is not None:
+            current["attachments"].append({
+                "id": attachment_id,
+                "filename": filename,
+                "file_path": file_path,
+                "file_size": file_size,
+                "content_type": content_type,
+                "uploaded_at": _iso(uploaded_at),
+            })
+
+    if current is not None:
+        yield current
+
+
+def _iter_messages(db: Session, consultation: Consultation) -> Iterable[Dict[str, Any]]:
+    """Сообщения консультации из горячих таблиц или из архива"""
+    if consultation.archived_at:
+        return load_archived_messages(db, consultation.id, parse_dates=False)
+    return _iter_live_messages(db, consultation.id)
+
+
+def _iter_ndjson(db: Session, consultation_ids: List[int]) -> Iterator[str]:
+    """Одна JSON-строка на консультацию и на каждое ее сообщение"""
+    for consultation_id in consultation_ids:
+        consultation = db.get(Consultation, consultation_id)
+        if not consultation:
+            continue
+
+        yield _dumps({"type": "consultation", **_serialize_consultation(consultation)}) + "\n"
+        for message in _iter_messages(db, consultation):
+            yield _dumps({"type": "message", **message}) + "\n"
+
+
+def _iter_json(db: Session, consultation_ids: List[int]) -> Iterator[str]:
+    """
+    Один JSON-документ {"exported_at", "consultations": [{..., "messages": [...]}]},
+    удобный для генерации PDF. Документ собирается по частям, а не в памяти.
+    """
+    yield '{"exported_at":' + _dumps(datetime.utcnow().isoformat()) + ',"consultations":['
+
+    first_consultation = True
+    for consultation_id in consultation_ids:
+        consultation = db.get(Consultation, consultation_id)
+        if not consultation:
+            continue
+
+        header = _dumps(_serialize_consultation(consultation))
+        yield ("" if first_consultation else ",") + header[:-1] + ',"messages":['
+        first_consultation = False
+
+        first_message = True
+        for message in _iter_messages(db, consultation):
+            yield ("" if first_message else ",") + _dumps(message)
+            first_message = False
+
+        yield "]}"
+
+    yield "]}"
+
+
+def stream_transcript_export(consultation_ids: List[int], export_format: str = "ndjson") -> Iterator[bytes]:
+    """
+    Генератор экспорта переписки для StreamingResponse.
+    Открывает собственную сессию: сессия из Depends(get_db) закрывается до того,
+    как начнется отправка тела ответа.
+    """
+    iter_lines = _iter_json if export_format == "json" else _iter_ndjson
+
+    with SessionLocal() as db:
+        buffer = []
+        buffered = 0
+        for line in iter_lines(db, consultation_ids):
+            buffer.append(line)
+            buffered += len(line)
+            if buffered >= EXPORT_CHUNK_SIZE:
+                yield "".join(buffer).encode("utf-8")
+                buffer = []
+                buffered = 0
+
+        if buffer:
+            yield "".join(buffer).encode("utf-8")
@@ -0,0 +1,385 @@
+# backend/websocket_manager.py
+
+import os
+import time
+import asyncio
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Set, Union
+from fastapi import WebSocket, status
+from starlette.websockets import WebSocketState
+from fast_json import dumps
+
+# Типы WebSocket соединений
+KIND_CONSULTATION = "consultation"      # /ws/consultations/{id}
+KIND_NOTIFICATIONS = "notifications"    # /ws/notifications/{user_id}
+KIND_CALL = "call"                      # /api/calls/ws/{call_id}
+KIND_INCOMING_CALL = "incoming_call"    # /api/calls/ws/incoming/{user_id}
+
+# Соединения, которые получают пользовательские события (уведомления, новые сообщения)
+USER_EVENT_KINDS = (KIND_CONSULTATION, KIND_NOTIFICATIONS)
+
+# Максимальная длина очереди исходящих сообщений одного соединения.
+# Клиент, который не успевает забирать сообщения и переполняет очередь, отключается.
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+
+# Серверный heartbeat: раз в HEARTBEAT_INTERVAL секунд сервер шлет {"type": "ping"},
+# соединение без входящих сообщений (pong или любых других) дольше IDLE_TIMEOUT секунд
+# считается мертвым или полуоткрытым и закрывается
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT", "75"))
+
+# Сколько ждать закрытия соединения: у полуоткрытого сокета close может зависнуть
+CLOSE_TIMEOUT_SECONDS = 5
+
+
+@dataclass
+class ConnectionInfo:
+    """Обратный индекс: кому принадлежит соединение и на что оно подписано"""
+    user_id: int
+    kind: str
+    consultation_ids: Set[int] = field(default_factory=set)
+    call_id: Optional[int] = None
+    # Очередь исходящих сообщений и задача, которая ее отправляет
+    queue: Optional[asyncio.Queue] = None
+    writer: Optional[asyncio.Task] = None
+    sent: int = 0
+    # Время последнего входящего сообщения (time.monotonic)
+    last_seen: float = field(default_factory=time.monotonic)
+
+
+class ConnectionManager:
+    """
+    Реестр WebSocket соединений с индексами в обе стороны:
+    пользователь -> соединения, консультация -> соединения, звонок -> соединения
+    и соединение -> (пользователь, консультации, звонок).
+    Регистрация, удаление и поиск работают за O(1) без перебора всех пользователей.
+
+    У каждого соединения своя ограниченная очередь исходящих сообщений и своя задача-писатель,
+    поэтому рассылка не ждет медленных клиентов: отправка только кладет сообщение в очереди.
+
+    Живость соединений проверяет сервер (heartbeat_loop): он рассылает ping и закрывает
+    соединения, от которых давно ничего не приходило.
+    """
+
+    def __init__(
+        self,
+        send_queue_size: int = SEND_QUEUE_SIZE,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL_SECONDS,
+        idle_timeout: float = IDLE_TIMEOUT_SECONDS,
+    ):
+        self._by_user: Dict[int, Set[WebSocket]] = {}
+        self._by_consultation: Dict[int, Set[WebSocket]] = {}
+        self._by_call: Dict[int, Set[WebSocket]] = {}
+        self._info: Dict[WebSocket, ConnectionInfo] = {}
+        self._send_queue_size = send_queue_size
+        self._heartbeat_interval = heartbeat_interval
+        self._idle_timeout = idle_timeout
+
+        # Счетчики для метрик
+        self._counters = {
+            "enqueued": 0,       # поставлено в очереди
+            "sent": 0,           # фактически отправлено
+            "send_errors": 0,    # ошибки отправки (соединение удалено)
+            "dropped": 0,        # сообщения, потерянные из-за переполнения или закрытия соединения
+            "evicted": 0,        # медленные клиенты, отключенные из-за переполнения очереди
+            "pings_sent": 0,     # серверные ping
+            "reaped": 0,         # соединения, закрытые по таймауту heartbeat
+        }
+        self._max_queue_depth = 0
+
+    # --- Регистрация ---
+
+    def connect(
+        self,
+        websocket: WebSocket,
+        user_id: int,
+        kind: str,
+        consultation_id: Optional[int] = None,
+        call_id: Optional[int] = None,
+    ) -> ConnectionInfo:
+        """Регистрирует уже принятое (accept) соединение. Повторный вызов безопасен."""
+        info = self._info.get(websocket)
+        if info is None:
+            info = ConnectionInfo(user_id=user_id, kind=kind)
+            info.queue = asyncio.Queue(maxsize=self._send_queue_size)
+            info.writer = asyncio.create_task(self._writer(websocket, info))
+            self._info[websocket] = info
+            self._by_user.setdefault(user_id, set()).add(websocket)
+
+        if consultation_id is not None:
+            self.subscribe_consultation(websocket, consultation_id)
+
+        if call_id is not None and info.call_id is None:
+            info.call_id = call_id
+            self._by_call.setdefault(call_id, set()).add(websocket)
+
+        return info
+
+    def touch(self, websocket: WebSocket) -> None:
+        """Отмечает входящее сообщение от клиента: соединение живо"""
+        info = self._info.get(websocket)
+        if info is not None:
+            info.last_seen = time.monotonic()
+
+    def subscribe_consultation(self, websocket: WebSocket, consultation_id: int) -> None:
+        """Подписывает соединение на события консультации"""
+        info = self._info.get(websocket)
+        if info is None:
+            return
+        info.consultation_ids.add(consultation_id)
+        self._by_consultation.setdefault(consultation_id, set()).add(websocket)
+
+    def disconnect(self, websocket: WebSocket) -> Optional[ConnectionInfo]:
+        """Удаляет соединение из всех индексов. Возвращает сведения о нем или None, если его не было."""
+        info = self._info.pop(websocket, None)
+        if info is None:
+            return None
+
+        self._discard(self._by_user, info.user_id, websocket)
+        for consultation_id in info.consultation_ids:
+            self._discard(self._by_consultation, consultation_id, websocket)
+        if info.call_id is not None:
+            self._discard(self._by_call, info.call_id, websocket)
+
+        # Останавливаем писателя; неотправленные сообщения теряются
+        if info.queue is not None:
+            self._counters["dropped"] += info.queue.qsize()
+        if info.writer is not None and info.writer is not asyncio.current_task():
+            info.writer.cancel()
+
+        return info
+
+    @staticmethod
+    def _discard(index: Dict[int, Set[WebSocket]], key: int, websocket: WebSocket) -> None:
+        connections = index.get(key)
+        if connections is None:
+            return
+        connections.discard(websocket)
+        if not connections:
+            del index[key]
+
+    # --- Поиск ---
+
+    def get_info(self, websocket: WebSocket) -> Optional[ConnectionInfo]:
+        return self._info.get(websocket)
+
+    def user_connections(self, user_id: int, kinds: Iterable[str] = USER_EVENT_KINDS) -> List[WebSocket]:
+        """Соединения пользователя указанных типов (копия - ее можно обходить во время await)"""
+        kinds = tuple(kinds)
+        return [
+            websocket for websocket in self._by_user.get(user_id, ())
+            if self._info[websocket].kind in kinds
+        ]
+
+    def consultation_connections(self, consultation_id: int, user_id: Optional[int] = None) -> List[WebSocket]:
+        """Соединения консультации; если указан user_id - только соединения этого участника"""
+        return [
+            websocket for websocket in self._by_consultation.get(consultation_id, ())
+            if user_id is None or self._info[websocket].user_id == user_id
+        ]
+
+    def call_connections(self, call_id: int, user_id: Optional[int] = None) -> List[WebSocket]:
+        """Соединения звонка; если указан user_id - только соединения этого участника"""
+        return [
+            websocket for websocket in self._by_call.get(call_id, ())
+            if user_id is None or self._info[websocket].user_id == user_id
+        ]
+
+    def is_user_connected(self, user_id: int, kinds: Iterable[str] = USER_EVENT_KINDS) -> bool:
+        return bool(self.user_connections(user_id, kinds))
+
+    def connected_user_ids(self) -> List[int]:
+        return list(self._by_user.keys())
+
+    def stats(self) -> Dict[str, Any]:
+        """Сводка для диагностики"""
+        by_kind: Dict[str, int] = {}
+        for info in self._info.values():
+            by_kind[info.kind] = by_kind.get(info.kind, 0) + 1
+        return {
+            "connections": len(self._info),
+            "users": len(self._by_user),
+            "consultations": len(self._by_consultation),
+            "calls": len(self._by_call),
+            "by_kind": by_kind,
+        }
+
+    def metrics(self, top: int = 10) -> Dict[str, Any]:
+        """Метрики очередей отправки: глубина, потери, отключенные медленные клиенты"""
+        depths = [
+            (info.queue.qsize(), info)
+            for info in self._info.values()
+            if info.queue is not None
+        ]
+        depths.sort(key=lambda item: item[0], reverse=True)
+        return {
+            **self.stats(),
+            **self._counters,
+            "queue_capacity": self._send_queue_size,
+            "heartbeat_interval": self._heartbeat_interval,
+            "idle_timeout": self._idle_timeout,
+            "queued_total": sum(depth for depth, _ in depths),
+            "queue_depth_max": depths[0][0] if depths else 0,
+            "queue_depth_max_observed": self._max_queue_depth,
+            "deepest_queues": [
+                {"user_id": info.user_id, "kind": info.kind, "depth": depth, "sent": info.sent}
+                for depth, info in depths[:top]
+                if depth > 0
+            ],
+        }
+
+    # --- Отправка ---
+
+    async def _writer(self, websocket: WebSocket, info: ConnectionInfo) -> None:
+        """Задача-писатель соединения: по одному отправляет сообщения из его очереди"""
+        while True:
+            payload = await info.queue.get()
+            try:
+                # В очереди лежат уже закодированные JSON-строки
+                await websocket.send_text(payload)
+                info.sent += 1
+                self._counters["sent"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._counters["send_errors"] += 1
+                if self.disconnect(websocket) is not None:
+                    print(f"[WebSocket] Удалено мертвое соединение пользователя {info.user_id} ({info.kind}): {str(e)}")
+                return
+
+    async def _close_slow_consumer(self, websocket: WebSocket, info: ConnectionInfo) -> None:
+        print(f"[WebSocket] Отключаем медленного клиента: пользователь {info.user_id} ({info.kind}), "
+              f"очередь переполнена ({self._send_queue_size})")
+        try:
+            await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Slow consumer")
+        except Exception:
+            pass
+
+    async def _close_quietly(self, websocket: WebSocket, code: int, reason: str) -> None:
+        try:
+            await asyncio.wait_for(websocket.close(code=code, reason=reason), CLOSE_TIMEOUT_SECONDS)
+        except Exception:
+            pass
+
+    def enqueue(self, websocket: WebSocket, payload: Union[str, Dict[str, Any]]) -> bool:
+        """
+        Ставит сообщение в очередь соединения, не дожидаясь отправки.
+        Словарь кодируется в JSON, строка отправляется как есть.
+        Если очередь переполнена, соединение отключается как медленный клиент.
+        """
+        info = self._info.get(websocket)
+        if info is None:
+            return False
+
+        if getattr(websocket, "client_state", None) == WebSocketState.DISCONNECTED:
+            self.disconnect(websocket)
+            return False
+
+        if not isinstance(payload, str):
+            payload = dumps(payload)
+
+        try:
+            info.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self._counters["dropped"] += 1
+            self._counters["evicted"] += 1
+            self.disconnect(websocket)
+            asyncio.create_task(self._close_slow_consumer(websocket, info))
+            return False
+
+        self._counters["enqueued"] += 1
+        depth = info.queue.qsize()
+        if depth > self._max_queue_depth:
+            self._max_queue_depth = depth
+        return True
+
+    async def send_to_connections(self, connections: Iterable[WebSocket], payload: Union[str, Dict[str, Any]]) -> int:
+        """
+        Рассылает сообщение по списку соединений без ожидания медленных клиентов.
+        Словарь кодируется в JSON один раз, и одна и та же строка уходит всем получателям.
+        Возвращает число соединений, в очереди которых попало сообщение.
+        """
+        if not isinstance(payload, str):
+            connections = list(connections)
+            if not connections:
+                return 0
+            payload = dumps(payload)
+
+        delivered = 0
+        for websocket in connections:
+            if self.enqueue(websocket, payload):
+                delivered += 1
+        return delivered
+
+    async def send_to_user(
+        self,
+        user_id: int,
+        payload: Union[str, Dict[str, Any]],
+        kinds: Iterable[str] = USER_EVENT_KINDS,
+    ) -> int:
+        return await self.send_to_connections(self.user_connections(user_id, kinds), payload)
+
+    async def send_to_consultation(
+        self,
+        consultation_id: int,
+        payload: Union[str, Dict[str, Any]],
+        exclude: Optional[WebSocket] = None,
+    ) -> int:
+        connections = [
+            websocket for websocket in self.consultation_connections(consultation_id)
+            if websocket is not exclude
+        ]
+        return await self.send_to_connections(connections, payload)
+
+    async def send_to_call(self, call_id: int, user_id: int, payload: Union[str, Dict[str, Any]]) -> int:
+        return await self.send_to_connections(self.call_connections(call_id, user_id), payload)
+
+    # --- Heartbeat ---
+
+    async def heartbeat_once(self, now: Optional[float] = None) -> Dict[str, int]:
+        """
+        Один проход heartbeat: закрывает соединения без входящих сообщений дольше idle_timeout,
+        остальным ставит в очередь ping. Возвращает число отправленных ping и закрытых соединений.
+        """
+        now = time.monotonic() if now is None else now
+
+        stale = [
+            (websocket, info) for websocket, info in self._info.items()
+            if now - info.last_seen > self._idle_timeout
+        ]
+
+        # Сначала разом убираем мертвые соединения из индексов (и отменяем их писателей),
+        # затем закрываем сокеты параллельно с ограничением по времени
+        for websocket, info in stale:
+            self.disconnect(websocket)
+        if stale:
+            self._counters["reaped"] += len(stale)
+            await asyncio.gather(*(
+                self._close_quietly(websocket, status.WS_1001_GOING_AWAY, "Heartbeat timeout")
+                for websocket, _ in stale
+            ))
+            print(f"[WebSocket] Heartbeat: закрыто неактивных соединений: {len(stale)}")
+
+        # ping кодируется один раз на весь проход
+        ping = dumps({"type": "ping", "timestamp": datetime.utcnow().isoformat()})
+        pings = 0
+        for websocket in list(self._info):
+            if self.enqueue(websocket, ping):
+                pings += 1
+        self._counters["pings_sent"] += pings
+
+        return {"pings": pings, "reaped": len(stale)}
+
+    async def heartbeat_loop(self) -> None:
+        """Фоновая задача heartbeat (запускается при старте приложения)"""
+        while True:
+            await asyncio.sleep(self._heartbeat_interval)
+            try:
+                await self.heartbeat_once()
+            except Exception as e:
+                print(f"[WebSocket] Ошибка heartbeat: {str(e)}")
+
+
+# Общий реестр соединений процесса: используется уведомлениями, чатом консультаций и звонками
+connection_manager = ConnectionManager()
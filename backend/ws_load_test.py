@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест WebSocket в одном процессе.
+
+Поднимает приложение (uvicorn) внутри процесса, открывает тысячи клиентов к
+/ws/consultations/{id}, /ws/notifications/{user_id} и /api/calls/ws/{call_id},
+генерирует события через шину и (по желанию) настоящие сообщения чата и измеряет:
+- задержку доставки от публикации до получения клиентом (p50/p95/p99/max);
+- долю доставленных событий;
+- память на соединение (прирост RSS процесса: сервер + клиенты);
+- задержку event loop.
+
+Результат - JSON-отчет, который можно сравнивать между релизами (--baseline):
+при ухудшении сверх допуска скрипт завершается с кодом 1.
+
+Нужны существующие консультация (и, для звонков, звонок) в БД из DATABASE_URL/models.py.
+
+Примеры:
+    python ws_load_test.py --consultation-id 12 --consultation-clients 2000 --notification-clients 2000
+    python ws_load_test.py --consultation-id 12 --call-id 7 --call-clients 200 --report ws_report.json
+    python ws_load_test.py --consultation-id 12 --report ws_report.json --baseline ws_report_prev.json
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import statistics
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения
+load_dotenv()
+
+# Добавляем путь к проекту
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import uvicorn
+import websockets
+
+from main import app
+from models import SessionLocal, Consultation, Call, User
+from auth import create_access_token
+from ws_tokens import issue_ws_token
+from event_bus import event_bus, consultation_channel, user_channel, call_channel
+from websocket_manager import connection_manager, KIND_NOTIFICATIONS
+
+LOAD_TEST_TYPE = "load_test"
+KINDS = ("consultation", "notification", "call", "chat")
+
+
+# --- Измерения ---
+
+def rss_bytes() -> int:
+    """Текущий RSS процесса (Linux: /proc, иначе - пиковый RSS из getrusage)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        if resource is None:
+            return 0
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.fmean(ordered), 3),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1], 3),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {kind: [] for kind in KINDS}
+        self.expected: Dict[str, int] = {kind: 0 for kind in KINDS}
+        self.received: Dict[str, int] = {kind: 0 for kind in KINDS}
+        self.chat_sent: Dict[str, float] = {}
+        self.connect_errors: List[str] = []
+        self.disconnects = 0
+
+    def record(self, kind: str, sent: float) -> None:
+        self.latencies[kind].append((time.perf_counter() - sent) * 1000)
+        self.received[kind] += 1
+
+
+class LoopLagMonitor:
+    """Задержка event loop: насколько позже запланированного просыпается короткий sleep"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, (time.perf_counter() - started - self.interval) * 1000))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+
+# --- Клиенты ---
+
+async def run_client(url: str, kind: str, stats: Stats, ready: asyncio.Event, stop: asyncio.Event, outbox: Optional[asyncio.Queue] = None):
+    try:
+        connection = await websockets.connect(url, max_size=None, ping_interval=None, open_timeout=30)
+    except Exception as e:
+        stats.connect_errors.append(f"{kind}: {type(e).__name__}: {e}")
+        ready.set()
+        return
+
+    ready.set()
+    sender = asyncio.create_task(_send_outbox(connection, outbox)) if outbox is not None else None
+    try:
+        while not stop.is_set():
+            try:
+                raw = await asyncio.wait_for(connection.recv(), timeout=0.5)
+            except asyncio.TimeoutError:
+                continue
+            data = json.loads(raw)
+            message_type = data.get("type")
+
+            if message_type == "ping":
+                await connection.send(json.dumps({"type": "pong"}))
+            elif message_type == LOAD_TEST_TYPE:
+                stats.record(data["kind"], data["sent"])
+            elif message_type == "message" and "temp_id" not in data:
+                # Настоящее сообщение чата: задержка от отправки до рассылки участникам
+                sent = stats.chat_sent.get((data.get("message") or {}).get("content"))
+                if sent is not None:
+                    stats.record("chat", sent)
+    except websockets.ConnectionClosed:
+        stats.disconnects += 1
+    finally:
+        if sender is not None:
+            sender.cancel()
+        await connection.close()
+
+
+async def _send_outbox(connection, outbox: asyncio.Queue) -> None:
+    while True:
+        await connection.send(json.dumps(await outbox.get()))
+
+
+async def open_clients(specs: List[Dict[str, Any]], stats: Stats, stop: asyncio.Event, concurrency: int) -> List[asyncio.Task]:
+    """Открывает клиентов партиями, чтобы не упереться в backlog сокета сервера"""
+    tasks = []
+    for offset in range(0, len(specs), concurrency):
+        batch = specs[offset:offset + concurrency]
+        events = [asyncio.Event() for _ in batch]
+        for spec, ready in zip(batch, events):
+            tasks.append(asyncio.create_task(run_client(spec["url"], spec["kind"], stats, ready, stop, spec.get("outbox"))))
+        await asyncio.gather(*(ready.wait() for ready in events))
+    return tasks
+
+
+# --- Нагрузка ---
+
+def load_fixtures(consultation_id: int, call_id: Optional[int]) -> Dict[str, Any]:
+    with SessionLocal() as db:
+        consultation = db.get(Consultation, consultation_id)
+        if consultation is None:
+            raise SystemExit(f"Консультация {consultation_id} не найдена")
+        fixtures = {"patient_id": consultation.patient_id, "doctor_id": consultation.doctor_id, "call": None}
+
+        if call_id is not None:
+            call = db.get(Call, call_id)
+            if call is None:
+                raise SystemExit(f"Звонок {call_id} не найден")
+            emails = dict(db.query(User.id, User.email).filter(User.id.in_([call.caller_id, call.receiver_id])).all())
+            fixtures["call"] = {
+                "caller_id": call.caller_id,
+                "receiver_id": call.receiver_id,
+                "tokens": {
+                    user_id: create_access_token(data={"sub": email})
+                    for user_id, email in emails.items()
+                },
+            }
+    return fixtures
+
+
+def build_client_specs(args, base_url: str, fixtures: Dict[str, Any]) -> List[Dict[str, Any]]:
+    participants = [fixtures["patient_id"], fixtures["doctor_id"]]
+    specs = []
+
+    for i in range(args.consultation_clients):
+        user_id = participants[i % 2]
+        specs.append({
+            "kind": "consultation",
+            "url": f"{base_url}/ws/consultations/{args.consultation_id}?token={issue_ws_token(user_id, ttl=3600)}",
+        })
+
+    for i in range(args.notification_clients):
+        user_id = participants[i % 2]
+        specs.append({
+            "kind": "notification",
+            "url": f"{base_url}/ws/notifications/{user_id}?token={issue_ws_token(user_id, ttl=3600)}",
+        })
+
+    call = fixtures["call"]
+    if call is not None:
+        call_users = [call["caller_id"], call["receiver_id"]]
+        for i in range(args.call_clients):
+            user_id = call_users[i % 2]
+            specs.append({
+                "kind": "call",
+                "url": f"{base_url}/api/calls/ws/{args.call_id}?token={call['tokens'][user_id]}",
+            })
+
+    # Через первого клиента консультации отправляются настоящие сообщения чата
+    if args.chat_messages and args.consultation_clients:
+        specs[0]["outbox"] = asyncio.Queue()
+    return specs
+
+
+async def generate_traffic(args, fixtures: Dict[str, Any], specs: List[Dict[str, Any]], stats: Stats) -> None:
+    participants = [fixtures["patient_id"], fixtures["doctor_id"]]
+    # Сколько соединений получает каждое событие
+    notification_fanout = {
+        user_id: sum(
+            1 for i in range(args.notification_clients) if participants[i % 2] == user_id
+        )
+        for user_id in participants
+    }
+    call = fixtures["call"]
+    call_fanout = {}
+    if call is not None:
+        call_users = [call["caller_id"], call["receiver_id"]]
+        call_fanout = {user_id: sum(1 for i in range(args.call_clients) if call_users[i % 2] == user_id) for user_id in call_users}
+
+    chat_outbox = specs[0].get("outbox") if specs else None
+    chat_every = max(1, int(args.rate * args.duration / args.chat_messages)) if chat_outbox is not None else 0
+
+    interval = 1.0 / args.rate
+    deadline = time.perf_counter() + args.duration
+    tick = 0
+    while time.perf_counter() < deadline:
+        tick += 1
+
+        if args.consultation_clients:
+            await event_bus.publish(consultation_channel(args.consultation_id), {
+                "type": LOAD_TEST_TYPE, "kind": "consultation", "sent": time.perf_counter()
+            })
+            stats.expected["consultation"] += args.consultation_clients
+
+        if args.notification_clients:
+            user_id = participants[tick % 2]
+            await event_bus.publish(user_channel(user_id), {
+                "type": LOAD_TEST_TYPE, "kind": "notification", "sent": time.perf_counter()
+            }, kinds=(KIND_NOTIFICATIONS,))
+            stats.expected["notification"] += notification_fanout[user_id]
+
+        if call_fanout:
+            user_id = list(call_fanout)[tick % 2]
+            await event_bus.publish(call_channel(args.call_id), {
+                "type": LOAD_TEST_TYPE, "kind": "call", "sent": time.perf_counter()
+            }, user_id=user_id)
+            stats.expected["call"] += call_fanout[user_id]
+
+        if chat_every and tick % chat_every == 0 and len(stats.chat_sent) < args.chat_messages:
+            content = f"[load-test] {tick} {time.time()}"
+            stats.chat_sent[content] = time.perf_counter()
+            chat_outbox.put_nowait({"type": "message", "content": content})
+            stats.expected["chat"] += args.consultation_clients
+
+        await asyncio.sleep(interval)
+
+
+# --- Отчет ---
+
+def build_report(args, stats: Stats, lag: LoopLagMonitor, opened: int, connect_seconds: float, rss_before: int, rss_after: int) -> Dict[str, Any]:
+    return {
+        "generated_at": datetime.utcnow().isoformat(),
+        "params": {
+            "consultation_clients": args.consultation_clients,
+            "notification_clients": args.notification_clients,
+            "call_clients": args.call_clients if args.call_id is not None else 0,
+            "rate": args.rate,
+            "duration": args.duration,
+            "chat_messages": args.chat_messages,
+        },
+        "connections": {
+            "opened": opened,
+            "failed": len(stats.connect_errors),
+            "connect_seconds": round(connect_seconds, 3),
+            "unexpected_disconnects": stats.disconnects,
+            "errors_sample": stats.connect_errors[:10],
+        },
+        "memory": {
+            "rss_before_bytes": rss_before,
+            "rss_after_bytes": rss_after,
+            "per_connection_bytes": int((rss_after - rss_before) / opened) if opened else 0,
+        },
+        "latency_ms": {kind: percentiles(values) for kind, values in stats.latencies.items() if stats.expected[kind]},
+        "delivery": {
+            kind: {
+                "expected": stats.expected[kind],
+                "received": stats.received[kind],
+                "ratio": round(stats.received[kind] / stats.expected[kind], 4),
+            }
+            for kind in KINDS if stats.expected[kind]
+        },
+        "loop_lag_ms": percentiles(lag.samples),
+        "server": connection_manager.metrics(top=0),
+    }
+
+
+def compare_with_baseline(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Список ухудшений относительно прошлого отчета (пустой - все в пределах допуска)"""
+    regressions = []
+
+    def check_higher(name: str, current: float, previous: float, floor: float) -> None:
+        # Небольшие абсолютные значения не сравниваем: шум измерений больше самой величины
+        if previous and current > max(previous * (1 + tolerance), floor):
+            regressions.append(f"{name}: {previous} -> {current}")
+
+    for kind, current in report["latency_ms"].items():
+        previous = baseline.get("latency_ms", {}).get(kind)
+        if previous:
+            for key in ("p95", "p99"):
+                check_higher(f"latency_ms.{kind}.{key}", current[key], previous[key], floor=5.0)
+
+    for kind, current in report["delivery"].items():
+        previous = baseline.get("delivery", {}).get(kind)
+        if previous and current["ratio"] < previous["ratio"] - 0.01:
+            regressions.append(f"delivery.{kind}.ratio: {previous['ratio']} -> {current['ratio']}")
+
+    check_higher("loop_lag_ms.p99", report["loop_lag_ms"]["p99"], baseline.get("loop_lag_ms", {}).get("p99", 0), floor=5.0)
+    check_higher(
+        "memory.per_connection_bytes",
+        report["memory"]["per_connection_bytes"],
+        baseline.get("memory", {}).get("per_connection_bytes", 0),
+        floor=4096,
+    )
+    return regressions
+
+
+def print_summary(report: Dict[str, Any]) -> None:
+    connections = report["connections"]
+    memory = report["memory"]
+    print("=" * 72)
+    print(f"Соединений: {connections['opened']} (ошибок: {connections['failed']}, "
+          f"обрывов: {connections['unexpected_disconnects']}), открыты за {connections['connect_seconds']} с")
+    print(f"Память: {memory['per_connection_bytes']} байт на соединение "
+          f"(RSS {memory['rss_before_bytes'] // 1024} -> {memory['rss_after_bytes'] // 1024} КБ)")
+    print(f"{'Канал':<14}{'доставлено':>12}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    for kind, latency in report["latency_ms"].items():
+        delivery = report["delivery"][kind]
+        print(f"{kind:<14}{delivery['ratio'] * 100:>11.2f}%{latency['p50']:>10}{latency['p95']:>10}"
+              f"{latency['p99']:>10}{latency['max']:>10}")
+    lag = report["loop_lag_ms"]
+    print(f"Задержка event loop: p50 {lag['p50']} мс, p99 {lag['p99']} мс, max {lag['max']} мс")
+    print(f"Потеряно в очередях: {report['server']['dropped']}, отключено медленных: {report['server']['evicted']}")
+    print("=" * 72)
+
+
+# --- Запуск ---
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def raise_file_limit() -> None:
+    """Тысячи соединений (по два сокета на каждое) упираются в лимит открытых файлов"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def run(args) -> Dict[str, Any]:
+    raise_file_limit()
+    fixtures = load_fixtures(args.consultation_id, args.call_id)
+
+    port = args.port or free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", ws="websockets"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    lag = LoopLagMonitor()
+    lag.start()
+    stats = Stats()
+    stop = asyncio.Event()
+
+    specs = build_client_specs(args, f"ws://127.0.0.1:{port}", fixtures)
+    rss_before = rss_bytes()
+    connect_started = time.perf_counter()
+    clients = await open_clients(specs, stats, stop, args.connect_concurrency)
+    connect_seconds = time.perf_counter() - connect_started
+    opened = len(specs) - len(stats.connect_errors)
+    rss_after = rss_bytes()
+    print(f"Открыто соединений: {opened} из {len(specs)} за {connect_seconds:.2f} с")
+
+    # Даем серверу разослать стартовые сообщения (непрочитанные уведомления, replay)
+    await asyncio.sleep(1)
+    await generate_traffic(args, fixtures, specs, stats)
+    await asyncio.sleep(args.drain)
+
+    stop.set()
+    await asyncio.gather(*clients, return_exceptions=True)
+    lag.stop()
+
+    report = build_report(args, stats, lag, opened, connect_seconds, rss_before, rss_after)
+    server.should_exit = True
+    await server_task
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест WebSocket соединений")
+    parser.add_argument("--consultation-id", type=int, required=True, help="Существующая консультация для теста")
+    parser.add_argument("--call-id", type=int, default=None, help="Существующий звонок (для клиентов /api/calls/ws)")
+    parser.add_argument("--consultation-clients", type=int, default=1000)
+    parser.add_argument("--notification-clients", type=int, default=1000)
+    parser.add_argument("--call-clients", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=20, help="Событий в секунду на каждый тип канала")
+    parser.add_argument("--duration", type=float, default=20, help="Длительность генерации нагрузки, с")
+    parser.add_argument("--drain", type=float, default=3, help="Ожидание доставки после генерации, с")
+    parser.add_argument("--chat-messages", type=int, default=0,
+                        help="Сколько настоящих сообщений чата отправить (сохраняются в БД!)")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--report", help="Куда сохранить JSON-отчет")
+    parser.add_argument("--baseline", help="JSON-отчет прошлого релиза для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение (доля), по умолчанию 20%%")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_summary(report)
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, ensure_ascii=False, indent=2)
+        print(f"Отчет сохранен: {args.report}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare_with_baseline(report, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print("Ухудшения относительно базового отчета:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            return 1
+        print("Ухудшений относительно базового отчета нет")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
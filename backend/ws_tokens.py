@@ -0,0 +1,184 @@
+# backend/ws_tokens.py
+
+import os
+import hmac
+import math
+import time
+import asyncio
+import base64
+import hashlib
+import secrets
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional
+from sqlalchemy.orm import Session
+from auth import SECRET_KEY
+from fast_json import dumps, loads
+from models import RevokedWebSocketToken, SessionLocal
+
+# Подписанные WebSocket токены: <payload>.<подпись>, оба в base64url.
+# payload = {"uid": id пользователя, "exp": unix-время истечения, "scp": область, "jti": id токена}.
+# Токен проверяется в памяти, без обращения к БД.
+
+WS_TOKEN_SCOPE = "ws"
+WS_TOKEN_TTL_SECONDS = int(os.getenv("WS_TOKEN_TTL", "300"))
+# Токен, выдаваемый при регистрации (подтверждение email, вход через Google), живет 30 минут:
+# клиент получает его вместе с ответом регистрации и не запрашивает новый перед первым подключением
+WS_SIGNUP_TOKEN_TTL_SECONDS = int(os.getenv("WS_SIGNUP_TOKEN_TTL", "1800"))
+
+# Отдельный ключ для WebSocket токенов, производный от SECRET_KEY (или WS_TOKEN_SECRET)
+_SIGNING_KEY = hashlib.sha256(
+    b"ws-token:" + os.getenv("WS_TOKEN_SECRET", SECRET_KEY).encode("utf-8")
+).digest()
+
+# Проверка отзыва: выключена по умолчанию. Если включена, каждый воркер держит
+# bloom-фильтр отозванных jti; в БД идем только при срабатывании фильтра.
+WS_TOKEN_REVOCATION_ENABLED = os.getenv("WS_TOKEN_REVOCATION", "0") == "1"
+REVOCATION_FILTER_CAPACITY = int(os.getenv("WS_TOKEN_REVOCATION_CAPACITY", "100000"))
+REVOCATION_FILTER_ERROR_RATE = 0.01
+REVOCATION_REFRESH_SECONDS = 30
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload_part: str) -> str:
+    return _b64encode(hmac.new(_SIGNING_KEY, payload_part.encode("ascii"), hashlib.sha256).digest())
+
+
+def issue_ws_token(user_id: int, scope: str = WS_TOKEN_SCOPE, ttl: int = WS_TOKEN_TTL_SECONDS) -> str:
+    """Выпускает подписанный WebSocket токен. БД не используется."""
+    payload = {
+        "uid": user_id,
+        "exp": int(time.time()) + ttl,
+        "scp": scope,
+        "jti": secrets.token_hex(8),
+    }
+    payload_part = _b64encode(dumps(payload).encode("utf-8"))
+    return f"{payload_part}.{_sign(payload_part)}"
+
+
+def decode_ws_token(token: str, scope: str = WS_TOKEN_SCOPE) -> Optional[Dict[str, Any]]:
+    """
+    Проверяет подпись, срок действия и область токена.
+    Возвращает payload или None, если токен недействителен. Отзыв здесь не проверяется.
+    """
+    # Выпущенные токены состоят из base64url и точки. Не-ASCII символы отбрасываются сразу:
+    # compare_digest со строками и кодирование полезной нагрузки в ascii на них падают
+    if not token or not token.isascii() or token.count(".") != 1:
+        return None
+
+    payload_part, signature = token.split(".")
+    if not hmac.compare_digest(signature, _sign(payload_part)):
+        return None
+
+    try:
+        payload = loads(_b64decode(payload_part))
+    except Exception:
+        return None
+
+    if not isinstance(payload, dict) or payload.get("scp") != scope:
+        return None
+    if not isinstance(payload.get("exp"), int) or payload["exp"] < time.time():
+        return None
+    if not isinstance(payload.get("uid"), int):
+        return None
+    return payload
+
+
+class BloomFilter:
+    """Bloom-фильтр фиксированного размера: ложноположительные ответы возможны, ложноотрицательные - нет"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str) -> Iterable[int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationList:
+    """
+    Отозванные токены: bloom-фильтр в памяти воркера поверх таблицы revoked_ws_tokens.
+    Фильтр периодически перестраивается из БД (так в него попадают отзывы из других воркеров).
+    """
+
+    def __init__(self, capacity: int = REVOCATION_FILTER_CAPACITY, session_factory=SessionLocal):
+        self.capacity = capacity
+        self.session_factory = session_factory
+        self.filter = BloomFilter(capacity, REVOCATION_FILTER_ERROR_RATE)
+        self.db_checks = 0
+
+    def revoke(self, db: Session, payload: Dict[str, Any]) -> None:
+        """Отзывает токен: запись в БД (в транзакции вызывающего) и сразу в локальный фильтр"""
+        if db.get(RevokedWebSocketToken, payload["jti"]) is None:
+            db.add(RevokedWebSocketToken(
+                jti=payload["jti"],
+                user_id=payload["uid"],
+                expires_at=datetime.utcfromtimestamp(payload["exp"]),
+            ))
+        self.filter.add(payload["jti"])
+
+    async def is_revoked(self, jti: str) -> bool:
+        # Фильтр отвечает "точно нет" без БД; при срабатывании подтверждаем по таблице
+        # в отдельном потоке, чтобы рукопожатие WebSocket не блокировало цикл событий
+        if jti not in self.filter:
+            return False
+        self.db_checks += 1
+        return await asyncio.to_thread(self._lookup, jti)
+
+    def _lookup(self, jti: str) -> bool:
+        with self.session_factory() as db:
+            return db.get(RevokedWebSocketToken, jti) is not None
+
+    def refresh(self) -> int:
+        """Удаляет истекшие записи одним запросом и перестраивает фильтр. Возвращает число отозванных токенов."""
+        with self.session_factory() as db:
+            db.query(RevokedWebSocketToken).filter(
+                RevokedWebSocketToken.expires_at < datetime.utcnow()
+            ).delete(synchronize_session=False)
+            db.commit()
+            jtis = [jti for (jti,) in db.query(RevokedWebSocketToken.jti).all()]
+
+        new_filter = BloomFilter(max(self.capacity, len(jtis)), REVOCATION_FILTER_ERROR_RATE)
+        for jti in jtis:
+            new_filter.add(jti)
+        self.filter = new_filter
+        return len(jtis)
+
+
+revocation_list = RevocationList()
+
+
+async def verify_ws_token(token: str, user_id: Optional[int] = None, scope: str = WS_TOKEN_SCOPE) -> Optional[int]:
+    """
+    Проверяет WebSocket токен и возвращает ID пользователя или None.
+    Если указан user_id, токен должен принадлежать этому пользователю.
+    """
+    payload = decode_ws_token(token, scope)
+    if payload is None:
+        return None
+    if user_id is not None and payload["uid"] != user_id:
+        return None
+    if WS_TOKEN_REVOCATION_ENABLED and await revocation_list.is_revoked(payload["jti"]):
+        return None
+    return payload["uid"]
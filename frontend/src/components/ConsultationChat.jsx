@@ -1185,16 +1185,19 @@ function ConsultationChat({
           }
           break;
           
-        case 'read_receipt':
-          // Сообщение прочитано
-          const messageId = data.message_id;
-          
-          // Обновляем статус прочтения в сообщениях
-          setMessages(prevMessages => 
-            prevMessages.map(msg => 
-              msg.id === messageId ? { ...msg, is_read: true } : msg
-            )
-          );
+        case 'ephemeral_update':
+          // Объединенные события: прочитано до сообщения X (набор текста и присутствие пока не отображаются)
+          if (Array.isArray(data.read)) {
+            data.read.forEach(({ reader_id, up_to_message_id }) => {
+              setMessages(prevMessages => 
+                prevMessages.map(msg => 
+                  msg.id <= up_to_message_id && msg.sender_id !== reader_id && !msg.is_read
+                    ? { ...msg, is_read: true }
+                    : msg
+                )
+              );
+            });
+          }
           break;
           
         case 'status_update':
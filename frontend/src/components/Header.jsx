@@ -85,7 +85,6 @@ function Header() {
       return;
     }
     
-    let notificationInterval;
     let chatInterval;
     
     // Загружаем начальные данные
@@ -135,25 +134,52 @@ function Header() {
       // НЕ отправляем браузерное уведомление отсюда - это делается в NotificationWebSocket
       // Это предотвращает дублирование push-уведомлений
       
-      // Обновляем счетчик непрочитанных уведомлений
-      setUnreadCount(prev => prev + 1);
+      // Счетчик непрочитанных приходит от сервера отдельным значением (notificationUnreadCount)
     };
 
-    // Добавляем слушатель кастомного события
+    // Актуальный счетчик непрочитанных уведомлений из WebSocket
+    const handleUnreadCount = (event) => {
+      setUnreadCount(event.detail);
+    };
+
+    // Уведомления до up_to_id отмечены прочитанными (на этом или другом устройстве)
+    const handleNotificationsRead = (event) => {
+      const upToId = event.detail;
+      setNotifications(prev => prev.map(n => (n.id <= upToId && !n.is_viewed ? { ...n, is_viewed: true } : n)));
+    };
+
+    // Свернутое уведомление обновилось: меняем текст и счетчик, поднимаем запись наверх
+    const handleNotificationUpdated = (event) => {
+      const update = event.detail;
+      setNotifications(prev => {
+        const existing = prev.find(n => n.id === update.id);
+        if (!existing) {
+          return prev;
+        }
+        return [{ ...existing, ...update }, ...prev.filter(n => n.id !== update.id)];
+      });
+    };
+
+    // Добавляем слушатели кастомных событий
     window.addEventListener('newNotificationReceived', handleNewNotification);
+    window.addEventListener('notificationUnreadCount', handleUnreadCount);
+    window.addEventListener('notificationUpdated', handleNotificationUpdated);
+    window.addEventListener('notificationsRead', handleNotificationsRead);
     
-    // Периодическая проверка уведомлений и сообщений (как резервный вариант)
-    notificationInterval = setInterval(fetchNotifications, 120000); // 2 минуты
+    // Периодическая проверка сообщений (как резервный вариант).
+    // Уведомления и их счетчик сервер присылает через WebSocket - опрос не нужен
     chatInterval = setInterval(fetchUnreadCounts, 120000); // 2 минуты
     
     // Очищаем интервалы при размонтировании
     return () => {
       
-      if (notificationInterval) clearInterval(notificationInterval);
       if (chatInterval) clearInterval(chatInterval);
       
-      // Убираем слушатель кастомного события
+      // Убираем слушатели кастомных событий
       window.removeEventListener('newNotificationReceived', handleNewNotification);
+      window.removeEventListener('notificationUnreadCount', handleUnreadCount);
+      window.removeEventListener('notificationUpdated', handleNotificationUpdated);
+      window.removeEventListener('notificationsRead', handleNotificationsRead);
     };
   }, [user?.id]); // Зависимость только от user.id, а не от всего объекта user
   
@@ -442,8 +468,14 @@ function Header() {
                         color="primary"
                         onPress={async () => {
                           try {
-                            await api.post('/api/notifications/mark-all-read');
-                            fetchNotifications();
+                            const response = await api.post('/api/notifications/mark-all-read');
+                            // Сервер возвращает границу и новый счетчик - список не перезагружаем
+                            if (response.data && typeof response.data.up_to_id === 'number') {
+                              window.dispatchEvent(new CustomEvent('notificationsRead', {
+                                detail: response.data.up_to_id
+                              }));
+                              setUnreadCount(response.data.unread_count);
+                            }
                           } catch (error) {
                             // Игнорируем ошибки отметки всех как прочитанные
                           }
@@ -478,7 +510,12 @@ function Header() {
                       >
                         <div className="flex flex-col gap-1">
                           <div className="flex justify-between">
-                            <p className="font-medium">{notification.title}</p>
+                            <p className="font-medium">
+                              {notification.title}
+                              {notification.collapse_count > 1 && (
+                                <span className="text-gray-500 font-normal"> ×{notification.collapse_count}</span>
+                              )}
+                            </p>
                             {!notification.is_viewed && (
                               <Badge color="primary" variant="flat" size="sm">{t('newNotification')}</Badge>
                             )}
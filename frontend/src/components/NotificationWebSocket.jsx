@@ -4,6 +4,7 @@ import { toast } from 'react-hot-toast';
 import { useNavigate } from 'react-router-dom';
 import notificationService from '../services/notificationService';
 import soundService from '../services/soundService';
+import { attachServerHeartbeat } from '../utils/wsHeartbeat';
 
 const NotificationWebSocket = () => {
   const { user, isAuthenticated, token } = useAuthStore();
@@ -53,6 +54,20 @@ const NotificationWebSocket = () => {
       try {
         let notification = null;
         
+        // Обновление свернутого уведомления: только Toast с последним сообщением
+        if (data.type === 'notification_updated' && data.notification) {
+          toast(data.notification.message, {
+            duration: 4000,
+            position: 'top-right',
+            style: {
+              background: '#363636',
+              color: '#fff',
+            },
+            className: 'will-change-transform',
+          });
+          return;
+        }
+        
         // Обрабатываем разные типы сообщений от сервера
         if (data.type === 'new_notification' && data.notification) {
           notification = data.notification;
@@ -259,6 +274,7 @@ const NotificationWebSocket = () => {
         const wsUrl = `${import.meta.env.VITE_WS_URL || 'wss://healzy.uz'}/ws/notifications/${user.id}?token=${encodeURIComponent(wsToken)}`;
         
         const ws = new WebSocket(wsUrl);
+        attachServerHeartbeat(ws);
         wsRef.current = ws;
 
         ws.onopen = () => {
@@ -268,6 +284,30 @@ const NotificationWebSocket = () => {
         ws.onmessage = (event) => {
           try {
             const data = JSON.parse(event.data);
+            
+            // Счетчик непрочитанных сервер присылает сам при каждом изменении -
+            // передаем его в Header без throttling, чтобы не потерять последнее значение
+            if (typeof data.unread_count === 'number') {
+              window.dispatchEvent(new CustomEvent('notificationUnreadCount', {
+                detail: data.unread_count
+              }));
+            }
+            
+            // Свернутое уведомление (повторные сообщения в консультации): сервер присылает
+            // только изменившиеся поля - Header обновляет существующую запись
+            if (data.type === 'notification_updated' && data.notification) {
+              window.dispatchEvent(new CustomEvent('notificationUpdated', {
+                detail: data.notification
+              }));
+            }
+            
+            // Уведомления до up_to_id прочитаны на другом устройстве или вкладке
+            if (data.type === 'notifications_read' && typeof data.up_to_id === 'number') {
+              window.dispatchEvent(new CustomEvent('notificationsRead', {
+                detail: data.up_to_id
+              }));
+            }
+            
             handleWebSocketMessage(data);
           } catch (error) {
             // Игнорируем ошибки парсинга WebSocket сообщения
@@ -2,6 +2,7 @@ import React, { createContext, useContext, useEffect, useState, useRef } from 'r
 import { toast } from 'react-hot-toast';
 import useAuthStore from '../stores/authStore';
 import api from '../api';
+import { attachServerHeartbeat } from '../utils/wsHeartbeat';
 
 const CallsContext = createContext();
 
@@ -72,6 +73,7 @@ export const CallsProvider = ({ children }) => {
       }
 
       const ws = new WebSocket(wsUrl);
+      attachServerHeartbeat(ws);
       currentWs = ws; // Сохраняем локальную ссылку
       setGlobalCallsWebSocket(ws); // Обновляем состояние
 
@@ -1,5 +1,6 @@
 import { useEffect, useRef, useCallback, useState } from 'react';
 import { throttle, debounce } from '../utils/performanceUtils';
+import { attachServerHeartbeat } from '../utils/wsHeartbeat';
 
 // ОПТИМИЗАЦИЯ: Глобальный пул WebSocket соединений
 const connectionPool = new Map();
@@ -33,6 +34,7 @@ class WebSocketManager {
     return new Promise((resolve, reject) => {
       try {
         this.ws = new WebSocket(this.url);
+        attachServerHeartbeat(this.ws);
         
         // ОПТИМИЗАЦИЯ: Устанавливаем таймауты
         this.ws.timeout = 10000;
@@ -557,6 +557,11 @@ function AdminPage() {
         successMessage += ` пользователю с ID ${specificUserId}`;
       }
       
+      // Массовая рассылка выполняется на сервере в фоне
+      if (response.data?.broadcast_id) {
+        successMessage = `Рассылка запущена: ${response.data.count} получателей (ID рассылки ${response.data.broadcast_id})`;
+      }
+      
       setNotificationResult({
         success: true,
         message: successMessage
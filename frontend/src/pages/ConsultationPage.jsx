@@ -12,6 +12,7 @@ import VideoCallModal from '../components/calls/VideoCallModal';
 import useWebRTC from '../hooks/useWebRTC';
 import IncomingCallNotification from '../components/calls/IncomingCallNotification';
 import { useCalls } from '../contexts/CallsContext';
+import { attachServerHeartbeat } from '../utils/wsHeartbeat';
 
 // Страница консультации
 function ConsultationPage() {
@@ -104,6 +105,7 @@ function ConsultationPage() {
     
     // Открываем WebSocket для сигнализации
     const ws = new WebSocket(wsUrl);
+    attachServerHeartbeat(ws);
     setSignalingSocket(ws);
     
     ws.onopen = () => {
@@ -725,6 +727,7 @@ function ConsultationPage() {
     const callsWsUrl = `${protocol}//${host}/api/calls/ws/incoming/${user?.id}?token=${localStorage.getItem('auth_token')}`;
     
     const callsWs = new WebSocket(callsWsUrl);
+    attachServerHeartbeat(callsWs);
     setIncomingCallWebSocket(callsWs);
     
     callsWs.onopen = () => {
@@ -1,6 +1,7 @@
 // WebSocket сервис для централизованного управления WebSocket соединениями
 import api from '../api';
 import { WS_BASE_URL } from '../api';
+import { attachServerHeartbeat } from '../utils/wsHeartbeat';
 
 // Синглтон для хранения соединений
 class WebSocketService {
@@ -21,6 +22,10 @@ class WebSocketService {
     // Интервалы пинга
     this.pingIntervals = {};
     
+    // seq последнего полученного события консультации: при переподключении
+    // сервер присылает только пропущенные события
+    this.lastSeq = {};
+    
     // Объект для хранения обработчиков сообщений
     this.messageHandlers = {};
     
@@ -261,6 +266,7 @@ class WebSocketService {
       
       // Создаем новое соединение
       const socket = new WebSocket(wsUrl);
+      attachServerHeartbeat(socket);
       
       // Сохраняем соединение (даже до полного открытия, чтобы предотвратить дублирование)
       this.connections[connectionKey] = socket;
@@ -428,11 +434,26 @@ class WebSocketService {
       }
       
       // Создаем новое соединение
-      const wsUrl = `${this.wsProtocol}//${this.wsHost}/ws/consultations/${consultationId}?token=${token}`;
+      const lastSeq = this.lastSeq[consultationId];
+      const wsUrl = `${this.wsProtocol}//${this.wsHost}/ws/consultations/${consultationId}?token=${token}` +
+        (lastSeq !== undefined ? `&last_seq=${lastSeq}` : '');
       
       
       // Создаем WebSocket соединение
       const socket = new WebSocket(wsUrl);
+      attachServerHeartbeat(socket);
+      
+      // Запоминаем seq событий консультации для повтора после переподключения
+      socket.addEventListener('message', (event) => {
+        try {
+          const data = JSON.parse(event.data);
+          if (data && typeof data.seq === 'number') {
+            this.lastSeq[consultationId] = data.seq;
+          }
+        } catch (error) {
+          // Игнорируем нераспознанные сообщения
+        }
+      });
       
       // Сохраняем соединение
       this.connections[connectionKey] = socket;
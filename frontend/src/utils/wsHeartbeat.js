@@ -0,0 +1,21 @@
+// Ответ на серверный heartbeat WebSocket
+
+/**
+ * Сервер периодически присылает {"type": "ping"} и закрывает соединения,
+ * от которых долго ничего не приходит. Подключаем ответ pong к любому сокету.
+ */
+export const attachServerHeartbeat = (ws) => {
+  ws.addEventListener('message', (event) => {
+    if (typeof event.data !== 'string' || !event.data.includes('"ping"')) return;
+
+    try {
+      const data = JSON.parse(event.data);
+      if (data && data.type === 'ping' && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({ type: 'pong' }));
+      }
+    } catch (error) {
+      // Игнорируем нераспознанные сообщения
+    }
+  });
+  return ws;
+};